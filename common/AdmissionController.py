@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2002 Bryce "Zooko" Wilcox-O'Hearn
+#  This file is licensed under the
+#    GNU Lesser General Public License v2.1.
+#    See the file COPYING or visit http://www.gnu.org/ for details.
+#
+
+# standard modules
+import math
+import time
+
+# pyutil modules
+import DoQ
+from debugprint import debugprint
+import humanreadable
+
+true = 1
+false = None
+
+# Shedding priorities of message types.  Under load, BULK ones are shed first and CONTROL ones
+# last.
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# The load (as a fraction of the budget) at or above which each priority is shed.
+SHED_LOAD = {
+    PRIORITY_BULK: 0.75,
+    PRIORITY_NORMAL: 1.0,
+    PRIORITY_CONTROL: 2.0,
+    }
+
+class AdmissionController:
+    """
+    Decides whether to handle an incoming initiating message or to shed it -- answer it at once
+    with a cheap failure so that the sender can fail over instead of waiting for its timeout.
+
+    The load is the bigger of two fractions: the number of requests in flight over
+    `maxinflight', and how late tasks on the DoQ are running over `maxqueuedelay' seconds.  The
+    DoQ's lateness is measured by a probe task that runs every `probeinterval' seconds while
+    the controller is started.
+
+    Message types have shedding priorities (see `set_priority()').  A type with no priority
+    set is NORMAL, unless its handler has been taking at least `expensive' seconds on average,
+    in which case it is BULK.
+    """
+    def __init__(self, maxinflight=256, maxqueuedelay=2.0, probeinterval=1.0, expensive=0.05, time=time.time):
+        """
+        @param maxinflight the number of incoming requests which can be in flight at once
+            without being overloaded
+        @param maxqueuedelay the number of seconds late that DoQ tasks can be running without
+            being overloaded
+        @param expensive the average handler time in seconds above which a message type with
+            no priority set is treated as BULK
+
+        @precondition `maxinflight' must be positive.: maxinflight > 0: "maxinflight: %s" % humanreadable.hr(maxinflight)
+        @precondition `maxqueuedelay' must be positive.: maxqueuedelay > 0: "maxqueuedelay: %s" % humanreadable.hr(maxqueuedelay)
+        """
+        assert maxinflight > 0, "precondition: `maxinflight' must be positive." + " -- " + "maxinflight: %s" % humanreadable.hr(maxinflight)
+        assert maxqueuedelay > 0, "precondition: `maxqueuedelay' must be positive." + " -- " + "maxqueuedelay: %s" % humanreadable.hr(maxqueuedelay)
+
+        self._maxinflight = maxinflight
+        self._maxqueuedelay = float(maxqueuedelay)
+        self._probeinterval = probeinterval
+        self._expensive = expensive
+        self._time = time
+        self._priorities = {} # maps msgtype to priority
+        self._costs = {} # maps msgtype to the weighted average number of seconds its handler takes
+        self._queuedelay = 0.0 # weighted average of how late the probe runs
+        self._running = false
+        self._stats = {'admitted': 0, 'shed': 0}
+        self._shedbytype = {} # maps msgtype to number shed
+
+    def __repr__(self):
+        return "<%s queuedelay: %0.2f, admitted: %d, shed: %d, %x>" % (self.__class__.__name__, self._queuedelay, self._stats['admitted'], self._stats['shed'], id(self),)
+
+    def start(self):
+        if not self._running:
+            self._running = true
+            self._schedule_probe()
+
+    def stop(self):
+        self._running = false
+
+    def _schedule_probe(self):
+        DoQ.doq.add_task(self._probe, args=(self._time() + self._probeinterval,), delay=self._probeinterval)
+
+    def _probe(self, due):
+        if not self._running:
+            return
+        self.update_queue_delay(max(0.0, self._time() - due))
+        self._schedule_probe()
+
+    def update_queue_delay(self, delay, HISTORYWEIGHT=0.5):
+        """
+        @param delay how many seconds late a task on the DoQ ran
+        """
+        # Go up fast but come down gradually, so that we start shedding as soon as the queue
+        # backs up and don't stop at the first lucky probe.
+        if delay > self._queuedelay:
+            self._queuedelay = delay
+        else:
+            self._queuedelay = (HISTORYWEIGHT * self._queuedelay) + ((1.0 - HISTORYWEIGHT) * delay)
+
+    def record_cost(self, msgtype, seconds, HISTORYWEIGHT=0.9):
+        """
+        @param seconds how long the handler for a message of type `msgtype' took
+        """
+        cost = self._costs.get(msgtype)
+        if cost is None:
+            self._costs[msgtype] = seconds
+        else:
+            self._costs[msgtype] = (HISTORYWEIGHT * cost) + ((1.0 - HISTORYWEIGHT) * seconds)
+
+    def set_priority(self, msgtype, priority):
+        """
+        @precondition `priority' must be one of PRIORITY_CONTROL, PRIORITY_NORMAL, or PRIORITY_BULK.: priority in (PRIORITY_CONTROL, PRIORITY_NORMAL, PRIORITY_BULK,): "priority: %s" % humanreadable.hr(priority)
+        """
+        assert priority in (PRIORITY_CONTROL, PRIORITY_NORMAL, PRIORITY_BULK,), "precondition: `priority' must be one of PRIORITY_CONTROL, PRIORITY_NORMAL, or PRIORITY_BULK." + " -- " + "priority: %s" % humanreadable.hr(priority)
+
+        self._priorities[msgtype] = priority
+
+    def get_priority(self, msgtype):
+        priority = self._priorities.get(msgtype)
+        if priority is not None:
+            return priority
+        if self._costs.get(msgtype, 0) >= self._expensive:
+            return PRIORITY_BULK
+        return PRIORITY_NORMAL
+
+    def get_load(self, numinflight):
+        """
+        @returns the load as a fraction of the budget;  1.0 is fully loaded
+        """
+        return max(float(numinflight) / self._maxinflight, self._queuedelay / self._maxqueuedelay)
+
+    def admit(self, msgtype, numinflight):
+        """
+        @param numinflight the number of incoming requests which are in flight now
+
+        @returns `None' if the message should be handled, else the number of seconds after
+            which the sender may try again
+        """
+        load = self.get_load(numinflight)
+        if load < SHED_LOAD[self.get_priority(msgtype)]:
+            self._stats['admitted'] = self._stats['admitted'] + 1
+            return None
+        self._stats['shed'] = self._stats['shed'] + 1
+        self._shedbytype[msgtype] = self._shedbytype.get(msgtype, 0) + 1
+        debugprint("%s: shedding a %s message, load: %0.2f\n", args=(self, msgtype, load,), v=5, vs="Conversation")
+        # Long enough for the backlog to clear, if no more arrived.
+        return int(math.ceil(max(1.0, self._queuedelay, numinflight * self._costs.get(msgtype, 0))))
+
+    def get_stats(self):
+        return {
+            'admitted': self._stats['admitted'],
+            'shed': self._stats['shed'],
+            'shed by type': self._shedbytype.copy(),
+            'queue delay': self._queuedelay,
+            }
+
+def test_sheds_bulk_before_normal_before_control():
+    ac = AdmissionController(maxinflight=100)
+    ac.set_priority('hello', PRIORITY_CONTROL)
+    ac.set_priority('get blob', PRIORITY_BULK)
+    for msgtype in ('hello', 'get blob', 'lookup',):
+        assert ac.admit(msgtype, 10) is None, "msgtype: %s" % msgtype
+
+    assert ac.admit('get blob', 80) is not None
+    assert ac.admit('lookup', 80) is None
+    assert ac.admit('lookup', 100) is not None
+    assert ac.admit('hello', 100) is None
+    assert ac.admit('hello', 200) is not None
+
+    stats = ac.get_stats()
+    assert stats['admitted'] == 5, "stats: %s" % humanreadable.hr(stats)
+    assert stats['shed by type'] == {'get blob': 1, 'lookup': 1, 'hello': 1,}, "stats: %s" % humanreadable.hr(stats)
+
+def test_expensive_types_are_bulk():
+    ac = AdmissionController(maxinflight=100, expensive=0.05)
+    ac.record_cost('cheap', 0.001)
+    ac.record_cost('dear', 0.5)
+    assert ac.get_priority('cheap') == PRIORITY_NORMAL
+    assert ac.get_priority('dear') == PRIORITY_BULK
+    retryafter = ac.admit('dear', 80)
+    assert retryafter == 40, "retryafter: %s" % humanreadable.hr(retryafter)
+    ac.set_priority('dear', PRIORITY_NORMAL)
+    assert ac.admit('dear', 80) is None
+
+def test_queue_delay():
+    clock = [1000.0]
+    ac = AdmissionController(maxinflight=100, maxqueuedelay=2.0, probeinterval=1.0, time=lambda clock=clock: clock[0])
+    probes = []
+    ac._schedule_probe = lambda probes=probes, clock=clock: probes.append(clock[0] + 1.0)
+    ac.start()
+    assert ac.admit('lookup', 0) is None
+
+    # The DoQ is 3 seconds behind.
+    clock[0] = probes[-1] + 3.0
+    ac._probe(probes[-1])
+    retryafter = ac.admit('lookup', 0)
+    assert retryafter == 3, "retryafter: %s" % humanreadable.hr(retryafter)
+
+    # It takes a few timely probes before it stops shedding.
+    ac.set_priority('get blob', PRIORITY_BULK)
+    clock[0] = probes[-1]
+    ac._probe(probes[-1])
+    assert ac.admit('lookup', 0) is None
+    assert ac.admit('get blob', 0) is not None
+    for i in range(3):
+        clock[0] = probes[-1]
+        ac._probe(probes[-1])
+    assert ac.admit('get blob', 0) is None
+
+    ac.stop()
+    numprobes = len(probes)
+    ac._probe(probes[-1])
+    assert len(probes) == numprobes
+
+mojo_test_flag = 1
+
+def run():
+    import RunTests
+    RunTests.runTests(["AdmissionController"])
+
+if __name__ == '__main__':
+    run()
@@ -12,8 +12,11 @@ __cvsid = '$Id: BandwidthThrottler.py,v 1.1 2002/01/29 20:07:07 zooko Exp $'
 # standard modules
 
 # pyutil modules
+import DoQ
 from debugprint import debugprint
 from config import DEBUG_MODE
+import humanreadable
+import pyutilasync
 import timeutil
 
 true = 1
@@ -70,3 +73,223 @@ class BandwidthThrottler:
             debugprint("BandwidthThrottler maxed out: %s bytes in %s seconds (%s Kbps); throttling\n", args=(self._used, "%0.0f" % (now - self._lasttick), "%0.3f" % (((self._used * 8.0) / 1024.0) / self._granularity)), v=7, vs="TCPCommsHandler") ### for faster operation, comment this line out.  --Zooko 2000-12-11
             for throttlecb in self._throttlecbs:
                 throttlecb()
+
+class TokenBucketThrottler:
+    """
+    Keeps track of how much bandwidth you're using with a "token bucket", and turns off comms
+    just long enough to stay under the recommended maximum.
+
+    The bucket fills up at `Kbps' and holds at most `burst' bytes.  Every byte used takes a
+    token out of it.  When fewer than a "quantum" of tokens are left, all of the registered
+    connections are throttled, and a timer unthrottles them as soon as the bucket holds a
+    quantum again.  That is usually a fraction of a second, instead of the rest of a
+    `granularity'-second period as with `BandwidthThrottler', so traffic flows smoothly and
+    a small message that is queued behind a throttle doesn't wait long.
+
+    `allowance()' tells a connection how many bytes it may read or write right now: never more
+    than a quantum, so that while the bucket is low each connection gets its turn at a share
+    of it instead of one big `send()' using it all up.
+
+    A throttler can have a parent.  Everything used is then also used from the parent, and the
+    connections are throttled whenever either bucket is low.  TCPCommsHandler uses this to give
+    each connection its own limit underneath the overall one.
+
+    All methods except `__init__()', `register()' and `unregister()' must be called on the
+    pyutilasync thread.
+    """
+    def __init__(self, Kbps, throttle=false, burst=None, parent=None, time=timeutil.timer.time):
+        """
+        @param Kbps max throughput in kilobits/second
+        @param throttle `true' if and only if comms should be throttled when the bucket is low;
+            if `false' then only `parent' (if any) throttles
+        @param burst the most bytes that can be used at once after a quiet spell, or `None'
+            for one second's worth
+        @param parent the TokenBucketThrottler that limits this one together with others, or
+            `None'
+
+        @precondition `Kbps' must be positive.: Kbps > 0: "Kbps: %s" % humanreadable.hr(Kbps)
+        """
+        assert Kbps > 0, "precondition: `Kbps' must be positive." + " -- " + "Kbps: %s" % humanreadable.hr(Kbps)
+
+        self._rate = (Kbps / 8.0) * 1024.0 # bytes per second
+        if burst is None:
+            burst = self._rate
+        self._burst = float(max(burst, 1))
+        self._quantum = min(self._burst, max(self._rate / 10.0, 1024.0))
+        self._throttle = throttle
+        self._parent = parent
+        self._time = time
+        self._tokens = self._burst
+        self._lastrefill = time()
+        self._low = false # `true' from when the bucket gets low until the timer finds it refilled
+        self._parentthrottled = false
+        self._throttlecbs = []
+        self._unthrottlecbs = []
+
+    def register(self, throttle_callback, unthrottle_callback):
+        if (self._parent is not None) and (len(self._throttlecbs) == 0):
+            self._parent.register(self._parent_throttle, self._parent_unthrottle)
+        self._throttlecbs.append(throttle_callback)
+        self._unthrottlecbs.append(unthrottle_callback)
+
+    def unregister(self, throttle_callback, unthrottle_callback):
+        self._throttlecbs.remove(throttle_callback)
+        self._unthrottlecbs.remove(unthrottle_callback)
+        if (self._parent is not None) and (len(self._throttlecbs) == 0):
+            self._parent.unregister(self._parent_throttle, self._parent_unthrottle)
+
+    def is_throttled(self):
+        return self._low or self._parentthrottled
+
+    def allowance(self):
+        """
+        @returns the number of bytes that may be read or written now, or `None' if there is no
+            limit; If this is 0 then the caller should throttle itself -- it will be
+            unthrottled along with the others when the bucket is refilled.
+        """
+        if self._low or self._parentthrottled:
+            return 0
+        if self._parent is not None:
+            parentallowance = self._parent.allowance()
+        else:
+            parentallowance = None
+        if not self._throttle:
+            return parentallowance
+        self._refill(self._time())
+        allowance = int(min(self._tokens, self._quantum))
+        if (parentallowance is not None) and (parentallowance < allowance):
+            return parentallowance
+        return allowance
+
+    def used(self, bytes):
+        """
+        @param bytes the number of bytes (not bits!) you just used
+        """
+        if self._parent is not None:
+            self._parent.used(bytes)
+        if not self._throttle:
+            return
+
+        self._refill(self._time())
+        self._tokens = self._tokens - bytes
+        if (not self._low) and (self._tokens < self._quantum):
+            # debugprint("TokenBucketThrottler low: %s bytes left, %s Kbps; throttling\n", args=(self._tokens, (self._rate * 8.0) / 1024.0), v=7, vs="TCPCommsHandler") ### for faster operation, comment this line out.  --Zooko 2000-12-11
+            self._low = true
+            if not self._parentthrottled:
+                for throttlecb in self._throttlecbs:
+                    throttlecb()
+            self._schedule_refill((self._quantum - self._tokens) / self._rate)
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + ((now - self._lastrefill) * self._rate))
+        self._lastrefill = now
+
+    def _schedule_refill(self, delay):
+        DoQ.doq.add_task(self._refill_timer_on_doq, delay=delay)
+
+    def _refill_timer_on_doq(self):
+        pyutilasync.selector.add_task(self._refill_timer)
+        pyutilasync.selector.wake_select()
+
+    def _refill_timer(self):
+        self._refill(self._time())
+        if self._tokens < self._quantum:
+            # Woke up a bit early.
+            self._schedule_refill((self._quantum - self._tokens) / self._rate)
+            return
+        self._low = false
+        if not self._parentthrottled:
+            for unthrottlecb in self._unthrottlecbs:
+                unthrottlecb()
+
+    def _parent_throttle(self):
+        if self._parentthrottled:
+            return
+        self._parentthrottled = true
+        if not self._low:
+            for throttlecb in self._throttlecbs:
+                throttlecb()
+
+    def _parent_unthrottle(self):
+        self._parentthrottled = false
+        if not self._low:
+            for unthrottlecb in self._unthrottlecbs:
+                unthrottlecb()
+
+def _help_make_token_bucket(Kbps, clock, burst=None, parent=None):
+    t = TokenBucketThrottler(Kbps=Kbps, throttle=true, burst=burst, parent=parent, time=lambda clock=clock: clock[0])
+    # Instead of setting timers, just remember the delays.
+    t._refilldelays = []
+    t._schedule_refill = t._refilldelays.append
+    return t
+
+def _help_register(t, events, name):
+    t.register(lambda events=events, name=name: events.append((name, 'throttle',)), lambda events=events, name=name: events.append((name, 'unthrottle',)))
+
+def test_token_bucket_throttles_until_refilled():
+    clock = [1000.0]
+    events = []
+    t = _help_make_token_bucket(80, clock) # 10240 bytes per second, so the quantum is 1024 bytes
+    _help_register(t, events, 'a')
+    _help_register(t, events, 'b')
+
+    assert t.allowance() == 1024, "t.allowance(): %s" % humanreadable.hr(t.allowance())
+    t.used(9000)
+    assert not t.is_throttled()
+    assert events == []
+    t.used(300)
+    assert t.is_throttled()
+    assert events == [('a', 'throttle',), ('b', 'throttle',)], "events: %s" % humanreadable.hr(events)
+    assert t.allowance() == 0
+    assert len(t._refilldelays) == 1
+    delay = t._refilldelays[0]
+    assert abs(delay - (84 / 10240.0)) < 0.0001, "delay: %s" % humanreadable.hr(delay)
+
+    # If the timer goes off early then it just waits some more.
+    clock[0] = clock[0] + (delay / 2)
+    t._refill_timer()
+    assert t.is_throttled()
+    assert len(t._refilldelays) == 2
+
+    clock[0] = clock[0] + delay
+    t._refill_timer()
+    assert not t.is_throttled()
+    assert events[2:] == [('a', 'unthrottle',), ('b', 'unthrottle',)], "events: %s" % humanreadable.hr(events)
+    assert t.allowance() == 1024
+
+def test_token_bucket_child_is_throttled_by_either_bucket():
+    clock = [1000.0]
+    events = []
+    parent = _help_make_token_bucket(80, clock)
+    child = _help_make_token_bucket(800, clock, burst=12000, parent=parent) # it refills much faster than its parent
+    _help_register(child, events, 'child')
+    assert child.allowance() == 1024, "child.allowance(): %s" % humanreadable.hr(child.allowance())
+
+    # This gets both buckets low, and the connections are throttled once.
+    child.used(9500)
+    assert child.is_throttled() and parent.is_throttled()
+    assert events == [('child', 'throttle',)], "events: %s" % humanreadable.hr(events)
+    assert child.allowance() == 0
+
+    # The parent being refilled isn't enough.
+    clock[0] = clock[0] + 1
+    parent._refill_timer()
+    assert not parent.is_throttled()
+    assert child.is_throttled()
+    assert events == [('child', 'throttle',)], "events: %s" % humanreadable.hr(events)
+
+    child._refill_timer()
+    assert not child.is_throttled()
+    assert events == [('child', 'throttle',), ('child', 'unthrottle',)], "events: %s" % humanreadable.hr(events)
+
+    child.unregister(child._throttlecbs[0], child._unthrottlecbs[0])
+    assert parent._throttlecbs == []
+
+mojo_test_flag = 1
+
+def run():
+    import RunTests
+    RunTests.runTests(["BandwidthThrottler"])
+
+if __name__ == '__main__':
+    run()
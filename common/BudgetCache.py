@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2002 Bryce "Zooko" Wilcox-O'Hearn
+#  This file is licensed under the
+#    GNU Lesser General Public License v2.1.
+#    See the file COPYING or visit http://www.gnu.org/ for details.
+#
+
+# standard modules
+import time
+import types
+import weakref
+
+# pyutil modules
+import humanreadable
+
+true = 1
+false = None
+
+def approx_size(thing, depth=2):
+    """
+    @returns a cheap estimate of the number of bytes of memory used by `thing' and the things
+        it contains, looking no more than `depth' levels down;  Instances are asked their
+        `get_size()' if they have one, else they are guessed at.
+    """
+    t = type(thing)
+    if t is types.StringType:
+        return 24 + len(thing)
+    if t in (types.IntType, types.FloatType, types.NoneType,):
+        return 16
+    if t is types.LongType:
+        return 16 + (len(hex(thing)) / 2)
+    if t in (types.TupleType, types.ListType,):
+        size = 32 + (4 * len(thing))
+        if depth > 0:
+            for x in thing:
+                size = size + approx_size(x, depth - 1)
+        return size
+    if t is types.DictType:
+        size = 64 + (24 * len(thing))
+        if depth > 0:
+            for (k, v,) in thing.items():
+                size = size + approx_size(k, depth - 1) + approx_size(v, depth - 1)
+        return size
+    if hasattr(thing, 'get_size'):
+        return thing.get_size()
+    return 64
+
+class MemoryBudget:
+    """
+    A limit on the total bytes used by a set of BudgetCaches.  When they use more than
+    `maxbytes' between them, the least recently used item in any of them is evicted, until
+    they fit again.
+    """
+    def __init__(self, maxbytes=None):
+        """
+        @param maxbytes the most bytes to use, or `None' for no limit
+        """
+        self._maxbytes = maxbytes
+        self._bytes = 0
+        self._caches = {} # maps id of cache to weakref to cache
+        self._nextstamp = 0L
+
+    def __repr__(self):
+        return "<%s caches: %d, bytes: %d, maxbytes: %s, %x>" % (self.__class__.__name__, len(self._caches), self._bytes, self._maxbytes, id(self),)
+
+    def set_maxbytes(self, maxbytes):
+        self._maxbytes = maxbytes
+        self._make_room()
+
+    def get_maxbytes(self):
+        return self._maxbytes
+
+    def _register(self, cache):
+        key = id(cache)
+        self._caches[key] = weakref.ref(cache, lambda ref, self=self, key=key: self._unregister(key))
+
+    def _unregister(self, key):
+        # (The cache is gone, so its bytes are too.  Its `_bytes' were subtracted as its items
+        # were removed, but a cache that was dropped while it still held items never got the
+        # chance, so recount.)
+        del self._caches[key]
+        total = 0
+        for ref in self._caches.values():
+            cache = ref()
+            if cache is not None:
+                total = total + cache._bytes
+        self._bytes = total
+
+    def _next_stamp(self):
+        self._nextstamp = self._nextstamp + 1
+        return self._nextstamp
+
+    def _added(self, numbytes):
+        self._bytes = self._bytes + numbytes
+
+    def _make_room(self):
+        if self._maxbytes is None:
+            return
+        while self._bytes > self._maxbytes:
+            oldestcache = None
+            oldeststamp = None
+            for ref in self._caches.values():
+                cache = ref()
+                if cache is None:
+                    continue
+                stamp = cache._oldest_stamp()
+                if (stamp is not None) and ((oldeststamp is None) or (stamp < oldeststamp)):
+                    oldestcache = cache
+                    oldeststamp = stamp
+            if oldestcache is None:
+                return
+            oldestcache._evict_oldest()
+
+    def get_stats(self):
+        """
+        @returns a dict of the total bytes in use, the budget, and the stats of each cache by
+            name (summed over caches with the same name)
+        """
+        caches = {}
+        for ref in self._caches.values():
+            cache = ref()
+            if cache is None:
+                continue
+            stats = cache.get_stats()
+            sofar = caches.get(cache._name)
+            if sofar is None:
+                caches[cache._name] = stats
+            else:
+                for (k, v,) in stats.items():
+                    sofar[k] = sofar[k] + v
+        return {
+            'bytes': self._bytes,
+            'maxbytes': self._maxbytes,
+            'caches': caches,
+            }
+
+# The MemoryBudget shared by all the caches of a node, unless they are given another.  It has no
+# limit until somebody sets one -- see `MojoTransactionManager.__init__()'.
+budget = MemoryBudget()
+
+class BudgetCache:
+    """
+    A least-recently-used cache which keeps track of how many bytes it uses (estimated by
+    `sizefunc' on each key and value when it is inserted), so that it can be limited by bytes
+    rather than only by number of items, and so that it can share a MemoryBudget with other
+    caches.  Items can also expire `ttl' seconds after they were inserted.
+
+    An item too big to fit in the cache at all is just not cached.
+
+    This is not thread-safe.
+    """
+    def __init__(self, name, maxbytes=None, maxitems=None, ttl=None, budget=budget, sizefunc=approx_size, time=time.time):
+        """
+        @param name the name under which this cache's stats are reported by `budget'
+        @param maxbytes the most bytes for this cache to use, or `None' for no limit of its
+            own
+        @param maxitems the most items for this cache to hold, or `None' for no limit of its
+            own
+        @param ttl the number of seconds after which items are forgotten, or `None' for never
+        @param budget the MemoryBudget to share, or `None' for none
+
+        @precondition `maxbytes' must be `None' or positive.: (maxbytes is None) or (maxbytes > 0): "maxbytes: %s" % humanreadable.hr(maxbytes)
+        @precondition `maxitems' must be `None' or positive.: (maxitems is None) or (maxitems > 0): "maxitems: %s" % humanreadable.hr(maxitems)
+        @precondition `ttl' must be `None' or positive.: (ttl is None) or (ttl > 0): "ttl: %s" % humanreadable.hr(ttl)
+        """
+        assert (maxbytes is None) or (maxbytes > 0), "precondition: `maxbytes' must be `None' or positive." + " -- " + "maxbytes: %s" % humanreadable.hr(maxbytes)
+        assert (maxitems is None) or (maxitems > 0), "precondition: `maxitems' must be `None' or positive." + " -- " + "maxitems: %s" % humanreadable.hr(maxitems)
+        assert (ttl is None) or (ttl > 0), "precondition: `ttl' must be `None' or positive." + " -- " + "ttl: %s" % humanreadable.hr(ttl)
+
+        self._name = name
+        self._maxbytes = maxbytes
+        self._maxitems = maxitems
+        self._ttl = ttl
+        self._budget = budget
+        self._sizefunc = sizefunc
+        self._time = time
+        self._d = {} # maps key to [value, size, stamp, expirytime,]
+        # (stamp, key,) in the order they were last used;  An item is stale if `_d' no longer has
+        # that key with that stamp.
+        self._order = []
+        self._orderstart = 0
+        self._bytes = 0
+        self._nextsweep = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        if budget is not None:
+            budget._register(self)
+        else:
+            # Just for the stamps.
+            self._budget = MemoryBudget()
+
+    def __repr__(self):
+        return "<%s %s items: %d, bytes: %d, %x>" % (self.__class__.__name__, self._name, len(self._d), self._bytes, id(self),)
+
+    def __len__(self):
+        return len(self._d)
+
+    def _get_entry(self, key):
+        """
+        @returns the entry for `key', or `None' if it isn't there or has expired
+        """
+        entry = self._d.get(key)
+        if entry is None:
+            return None
+        if (entry[3] is not None) and (entry[3] <= self._time()):
+            self._expirations = self._expirations + 1
+            self._remove(key)
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._get_entry(key)
+        if entry is None:
+            self._misses = self._misses + 1
+            return default
+        self._hits = self._hits + 1
+        entry[2] = self._budget._next_stamp()
+        self._append_order(entry[2], key)
+        return entry[0]
+
+    def __getitem__(self, key):
+        entry = self._get_entry(key)
+        if entry is None:
+            raise KeyError, key
+        return self.get(key)
+
+    def has_key(self, key):
+        return self._get_entry(key) is not None
+
+    def insert(self, key, value):
+        now = self._time()
+        if (self._nextsweep is not None) and (now >= self._nextsweep):
+            self._forget_expired(now)
+        if self._d.has_key(key):
+            self._remove(key)
+
+        size = self._sizefunc(key) + self._sizefunc(value)
+        if ((self._maxbytes is not None) and (size > self._maxbytes)) or ((self._budget.get_maxbytes() is not None) and (size > self._budget.get_maxbytes())):
+            # Too big to cache at all.
+            return
+
+        if self._ttl is None:
+            expirytime = None
+        else:
+            expirytime = now + self._ttl
+            if self._nextsweep is None:
+                self._nextsweep = now + self._ttl
+        stamp = self._budget._next_stamp()
+        self._d[key] = [value, size, stamp, expirytime,]
+        self._append_order(stamp, key)
+        self._bytes = self._bytes + size
+        self._budget._added(size)
+
+        while ((self._maxbytes is not None) and (self._bytes > self._maxbytes)) or ((self._maxitems is not None) and (len(self._d) > self._maxitems)):
+            self._evict_oldest()
+        self._budget._make_room()
+
+    __setitem__ = insert
+
+    def remove(self, key):
+        """
+        @returns the value that was removed
+        """
+        entry = self._get_entry(key)
+        if entry is None:
+            raise KeyError, key
+        self._remove(key)
+        return entry[0]
+
+    def __delitem__(self, key):
+        self.remove(key)
+
+    def empty(self):
+        self._budget._added(-self._bytes)
+        self._d.clear()
+        self._order = []
+        self._orderstart = 0
+        self._bytes = 0
+
+    def keys(self):
+        return self._d.keys()
+
+    def values(self):
+        return map(lambda entry: entry[0], self._d.values())
+
+    def items(self):
+        return map(lambda (key, entry,): (key, entry[0],), self._d.items())
+
+    def get_stats(self):
+        return {
+            'items': len(self._d),
+            'bytes': self._bytes,
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'expirations': self._expirations,
+            }
+
+    def _remove(self, key):
+        entry = self._d[key]
+        del self._d[key]
+        self._bytes = self._bytes - entry[1]
+        self._budget._added(-entry[1])
+
+    def _oldest(self):
+        """
+        @returns (stamp, key,) of the least recently used item, or `None' if there are none
+        """
+        order = self._order
+        i = self._orderstart
+        lenorder = len(order)
+        result = None
+        while i < lenorder:
+            (stamp, key,) = order[i]
+            entry = self._d.get(key)
+            if (entry is not None) and (entry[2] == stamp):
+                result = (stamp, key,)
+                break
+            i = i + 1
+        if i > (lenorder / 2):
+            del order[:i]
+            i = 0
+        self._orderstart = i
+        return result
+
+    def _oldest_stamp(self):
+        oldest = self._oldest()
+        if oldest is None:
+            return None
+        return oldest[0]
+
+    def _evict_oldest(self):
+        oldest = self._oldest()
+        if oldest is not None:
+            self._evictions = self._evictions + 1
+            self._remove(oldest[1])
+
+    def _append_order(self, stamp, key):
+        self._order.append((stamp, key,))
+        # Items used or inserted again leave stale entries behind, so don't let them pile up.
+        if len(self._order) > ((2 * len(self._d)) + 32):
+            self._compact_order()
+
+    def _compact_order(self):
+        order = []
+        for (key, entry,) in self._d.items():
+            order.append((entry[2], key,))
+        order.sort()
+        self._order = order
+        self._orderstart = 0
+
+    def _forget_expired(self, now):
+        for (key, entry,) in self._d.items():
+            if entry[3] <= now:
+                self._expirations = self._expirations + 1
+                self._remove(key)
+        # Look again after half a ttl, so that nothing stays more than half a ttl past its time
+        # unless it is asked for (in which case it is noticed then).
+        self._nextsweep = now + (self._ttl / 2.0)
+
+def test_lru_by_bytes():
+    c = BudgetCache('test', maxbytes=1000, budget=None)
+    for i in range(10):
+        c.insert(i, "x" * 160)
+    assert len(c) == 5, "c: %s" % humanreadable.hr(c)
+    assert c.get(4) is None
+    assert c.get(5) is not None
+    # 5 was just used, so 6 goes first.
+    c.insert(10, "x" * 160)
+    assert c.has_key(5)
+    assert not c.has_key(6)
+    assert c.get_stats()['evictions'] == 6, "c.get_stats(): %s" % humanreadable.hr(c.get_stats())
+
+    # Too big to keep at all.
+    c.insert('big', "x" * 2000)
+    assert not c.has_key('big')
+    assert len(c) == 5
+
+def test_maxitems_and_dict_interface():
+    c = BudgetCache('test', maxitems=3, budget=None)
+    c['a'] = 1
+    c['b'] = 2
+    c['c'] = 3
+    c['d'] = 4
+    assert not c.has_key('a')
+    assert c['b'] == 2
+    del c['b']
+    try:
+        c['b']
+    except KeyError:
+        pass
+    else:
+        assert false, "should have raised KeyError"
+    assert c.remove('c') == 3
+    assert c.items() == [('d', 4,)]
+    c.empty()
+    assert len(c) == 0
+    assert c.get_stats()['bytes'] == 0
+
+def test_reinserting_does_not_grow_order():
+    c = BudgetCache('test', budget=None)
+    for i in range(10000):
+        c.insert(i % 10, i)
+    assert len(c) == 10
+    assert len(c._order) <= ((2 * len(c)) + 32), "len(c._order): %s" % len(c._order)
+    assert c.get(9) == 9999
+
+def test_ttl():
+    clock = [1000.0]
+    c = BudgetCache('test', ttl=10, budget=None, time=lambda clock=clock: clock[0])
+    c['a'] = 1
+    clock[0] = 1005.0
+    c['b'] = 2
+    clock[0] = 1010.0
+    assert c.get('a') is None
+    assert c.get('b') == 2
+    clock[0] = 1030.0
+    c['c'] = 3
+    # `b' was swept out when `c' went in.
+    assert len(c) == 1
+    assert c.get_stats()['expirations'] == 2, "c.get_stats(): %s" % humanreadable.hr(c.get_stats())
+
+def test_shared_budget_evicts_oldest_anywhere():
+    b = MemoryBudget(maxbytes=1000)
+    c1 = BudgetCache('one', budget=b)
+    c2 = BudgetCache('two', budget=b)
+    c1.insert('a', "x" * 200)
+    c2.insert('b', "x" * 200)
+    c1.insert('c', "x" * 200)
+    c2.insert('d', "x" * 200)
+    assert c1.has_key('a')
+    c1.get('a')
+    c2.insert('e', "x" * 200)
+    # `b' was the least recently used of all.
+    assert not c2.has_key('b')
+    assert c1.has_key('a')
+    stats = b.get_stats()
+    assert stats['bytes'] <= 1000, "stats: %s" % humanreadable.hr(stats)
+    assert stats['caches']['two']['evictions'] == 1, "stats: %s" % humanreadable.hr(stats)
+
+    # Dropping a cache gives its bytes back.
+    del c2
+    assert b.get_stats()['bytes'] == c1.get_stats()['bytes'], "b.get_stats(): %s" % humanreadable.hr(b.get_stats())
+
+    b.set_maxbytes(300)
+    assert len(c1) == 1
+
+def _bench_it_insert_and_get(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    c = BudgetCache('bench', maxbytes=2**20, budget=None)
+    for i in xrange(n):
+        c.insert(i, "x" * 100)
+        c.get(i / 2)
+
+def _profile_test_cache_speed():
+    import mojoutil
+    profit = mojoutil._dont_enable_if_you_want_speed_profit
+    profit(_real_test_cache_speed)
+
+def _real_test_cache_speed():
+    for n in (1000, 10000, 100000,):
+        t1 = time.time()
+        _bench_it_insert_and_get(n)
+        t2 = time.time()
+        print '_bench_it_insert_and_get(%d): %3.3f seconds' % (n, t2 - t1,)
+
+mojo_test_flag = 1
+
+def run():
+    import RunTests
+    RunTests.runTests(["BudgetCache"])
+
+if __name__ == '__main__':
+    run()
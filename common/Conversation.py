@@ -24,7 +24,7 @@ from traceback import print_exc
 from debugprint import debugprint
 
 # EGTP/Mnet modules
-import Cache
+import BudgetCache
 from CommHints import HINT_EXPECT_RESPONSE, HINT_EXPECT_MORE_TRANSACTIONS, HINT_EXPECT_NO_MORE_COMMS, HINT_EXPECT_TO_RESPOND, HINT_THIS_IS_A_RESPONSE, HINT_NO_HINT
 import CommStrat
 import DoQ
@@ -39,6 +39,7 @@ import mojosixbit
 import mojoutil
 import randsource
 import std
+import TimerWheel
 from MojoHandicapper import DISQUALIFIED
 
 true = 1
@@ -49,22 +50,70 @@ EXPECTING_RESPONSE = 1
 
 TUNING_FACTOR=float(2**8)
 
+try:
+    _RecordBase = object
+except NameError:
+    # Before Python 2.2 there is no `object' and no `__slots__', so there the records each have
+    # a __dict__ like any other instance.
+    class _RecordBase: pass
+
+# A rough estimate of the bytes of memory used per outstanding conversation, not counting its
+# first message id: the record itself, its entries in the ConversationManager's dict and on the
+# TimerWheel, and the floats and tuples that those refer to.
+RECORD_OVERHEAD = 160
+
+class ConversationRecord(_RecordBase):
+    """
+    What we keep about a conversation that we initiated, from when we send the first message
+    until the response arrives or we stop waiting for it.  It doesn't keep any message bodies,
+    so that a node can have a great many conversations outstanding at once.
+
+    `counterparty_id', `conversationtype', `outcome_func', `post_timeout_outcome_func',
+    `timerhandle', `timeouttime' and `firstmsgId' are the ConversationManager's; the rest are for
+    the use of whoever initiated the conversation.  The record is passed to the outcome funcs as
+    their `notes' argument.
+    """
+    __slots__ = ('counterparty_id', 'conversationtype', 'outcome_func', 'post_timeout_outcome_func', 'timerhandle', 'timeouttime', 'firstmsgId', 'starttime', 'outer_outcome_func', 'outer_post_timeout_outcome_func',)
+
+    def __init__(self, counterparty_id, conversationtype):
+        self.counterparty_id = counterparty_id
+        self.conversationtype = conversationtype
+        self.outcome_func = None
+        self.post_timeout_outcome_func = None
+        self.timerhandle = None
+        self.timeouttime = None # when it timed out, or `None' if it hasn't
+        self.firstmsgId = None
+        self.starttime = None
+        self.outer_outcome_func = None
+        self.outer_post_timeout_outcome_func = None
+
+    def __repr__(self):
+        return "<%s %s to %s, firstmsgId: %s, %x>" % (self.__class__.__name__, self.conversationtype, humanreadable.hr(self.counterparty_id), humanreadable.hr(self.firstmsgId), id(self),)
+
+    def get_size(self):
+        """
+        @returns an estimate of the number of bytes of memory kept alive by this record while
+            its conversation is outstanding
+        """
+        return RECORD_OVERHEAD + len(self.firstmsgId or "")
+
 def is_mojo_message(thingie):
     return (type(thingie) is types.DictType) and (thingie.has_key('mojo header') or thingie.has_key('mojo message'))
 
 class ConversationManager:
     def __init__(self, MTM):
         self._MTM = MTM
-        # maps first message ids to (counterparty_id, callback function, notes for callback, conversation type, post_timeout_callback_func, timeoutcheckerschedtime,)
+        # maps first message ids to ConversationRecords
         self.__callback_functions = {}
 
-        # maps message id's of messages who's responses have timed out to (recipient_id, conversation type, time of timeout, post timeout callback function, notes [only if post timeout callback function])
-        # Reminder: this indirectly holds references to the original outgoing message body as well as the metainfo used to send it.  That is often large.
-        self.__posttimeout_callback_functions = Cache.StatsCacheSingleThreaded(maxitems=200, autoexpireinterval=61, autoexpireparams={'maxage':900})
+        # maps message id's of messages who's responses have timed out to their ConversationRecords
+        # (This is state rather than a cache, so it is kept out of the shared BudgetCache.budget:
+        # only its own limits may drop entries.)
+        self.__posttimeout_callback_functions = BudgetCache.BudgetCache('post-timeout conversations', maxitems=200, ttl=900, budget=None)
 
         # maps binary counterparty_id to number of response messages that have not been received
-        # (used for the pending_responses_handicapper)
-        self.__outstanding_messages = Cache.StatsCacheSingleThreaded(autoexpireinterval=61, autoexpireparams={'maxage':1200})
+        # (used for the pending_responses_handicapper;  also state, so not under the shared budget)
+        self.__outstanding_messages = BudgetCache.BudgetCache('outstanding messages', ttl=1200, budget=None)
 
         # maps message id to (binary counterparty_id, message type, response status)
         # where status is HANDLED or EXPECTING_RESPONSE
@@ -79,7 +128,7 @@ class ConversationManager:
         # freshness proofs, but this code ensures that when we ship a new, replay-attack-proof
         # version which _does_ verify freshness proofs, then older apps which are running _this_
         # version of our software will be able to interoperate with it.
-        self._map_cid_to_freshness_proof = Cache.CacheSingleThreaded(maxitems=1000)
+        self._map_cid_to_freshness_proof = BudgetCache.BudgetCache('freshness proofs', maxitems=1000)
 
         self._in_message_num = 0L   # used only in debugging
 
@@ -107,15 +156,19 @@ class ConversationManager:
         XXX This is hopefully fixed by late-response processing and more clever timeout values.  This handicapper can cause serious harm by disqualifying all of the block servers that you most want to use, if it is the case that you can generate queries faster than the queries can travel to the BS, get processed, and travel back.  Anyway, I'm just adjusting it to be a handicap instead of DISQ.  --Zooko 2001-04-29
 
         timed out messages count for a while after they were first initiated.  The exact time is controlled
-        by the expire time for the __outstanding_messages StatsCache in the constructor.
+        by the expire time for the __outstanding_messages BudgetCache in the constructor.
 
         If more than 4 messages are outstanding this counterparty is temporarily disqualified from further business.
         If it is still unreliable after that, the persistent unreliability handicapper will eventually take care of it.
         """
         return self.__outstanding_messages.get(counterparty_id, 0) * TUNING_FACTOR
 
-    def initiate_and_return_first_message(self, counterparty_id, conversationtype, firstmsgbody, outcome_func, timeout = 300, notes = None, mymetainfo=None, post_timeout_outcome_func=None):
+    def initiate_and_return_first_message(self, counterparty_id, conversationtype, firstmsgbody, outcome_func, timeout = 300, record = None, mymetainfo=None, post_timeout_outcome_func=None):
         """
+        @param mymetainfo our metainfo dict (or a mencode.PreEncodedThing of it, which is
+            spliced into the message without encoding it again), or `None'
+        @param record a ConversationRecord with the caller's fields filled in, or `None'
+
         @precondition `counterparty_id' must be  an id.: idlib.is_sloppy_id(counterparty_id): "id: %s" % humanreadable.hr(id)
 
         returns a tuple of (message_id, binary_message_string)
@@ -144,33 +197,71 @@ class ConversationManager:
         # only keep track of the message details if we have a response message handler
         if outcome_func:
             # Schedule a timeout checker.
-            timeoutcheckerschedtime = DoQ.doq.add_task(self.fail_conversation, kwargs={'msgId': msgId, 'failure_reason': 'timeout', 'istimeout': 1}, delay=timeout)
-            self.__callback_functions[msgId] = (counterparty_id, outcome_func, notes, conversationtype, post_timeout_outcome_func, timeoutcheckerschedtime ,)
+            # (This is on the TimerWheel rather than the DoQ since nearly all of them get cancelled.)
+            if record is None:
+                record = ConversationRecord(counterparty_id, conversationtype)
+            record.outcome_func = outcome_func
+            record.post_timeout_outcome_func = post_timeout_outcome_func
+            record.firstmsgId = msgId
+            record.timerhandle = TimerWheel.wheel.schedule(self.fail_conversation, args=(msgId, 'timeout', 1,), delay=timeout)
+            self.__callback_functions[msgId] = record
             num = self.__outstanding_messages.get(counterparty_id, 0)
             self.__outstanding_messages[counterparty_id] = num + 1
 
         return msgId, message
 
     def fail_conversation(self, msgId, failure_reason='generic failure', istimeout=0):
-        initial = self.__callback_functions.get(msgId)
-        if initial is None :
+        record = self.__callback_functions.get(msgId)
+        if record is None :
             # This means that a response has been received, so it shouldn't fail.
             return
         del self.__callback_functions[msgId]
-        (recipient_id, callback_function, notes, conversationtype, post_timeout_callback_function, timeoutcheckerschedtime,) = initial
+        callback_function = record.outcome_func
+        record.outcome_func = None
         if not istimeout:
+            TimerWheel.wheel.cancel(record.timerhandle)
             # only include these in the failed_conversation map for later calling if it was a timeout
-            post_timeout_callback_function = None
-        if post_timeout_callback_function is None:
-            # only needed for post timeout callback functions
-            post_timeout_notes = None
-        else:
-            post_timeout_notes = notes
-        self.__posttimeout_callback_functions[msgId] = (recipient_id, conversationtype, time(), post_timeout_callback_function, post_timeout_notes,)
+            record.post_timeout_outcome_func = None
+        record.timerhandle = None
+        record.timeouttime = time()
+        self.__posttimeout_callback_functions[msgId] = record
         if DoQ.doq.is_currently_doq():
-            callback_function(failure_reason=failure_reason, notes=notes)
+            callback_function(failure_reason=failure_reason, notes=record)
         else:
-            DoQ.doq.add_task(callback_function, kwargs = {'failure_reason': failure_reason, 'notes': notes})
+            DoQ.doq.add_task(callback_function, kwargs = {'failure_reason': failure_reason, 'notes': record})
+
+    def abandon_conversation(self, msgId):
+        """
+        Forgets the outstanding conversation begun by the message `msgId' without calling its
+        outcome func, now or ever.  This is for when nobody cares about the response any more.
+        A response that arrives anyway is dropped, and there is no timeout or post-timeout
+        bookkeeping left behind.
+
+        @returns `true' if and only if the conversation was outstanding
+        """
+        record = self.__callback_functions.get(msgId)
+        if record is None:
+            return false
+        del self.__callback_functions[msgId]
+        TimerWheel.wheel.cancel(record.timerhandle)
+        # keep track of the number of outstanding response messages for handicapping purposes
+        num = self.__outstanding_messages.get(record.counterparty_id, 0)
+        if num > 0:
+            self.__outstanding_messages[record.counterparty_id] = num - 1
+        return true
+
+    def get_memory_stats(self):
+        """
+        @returns a dict of the number of conversations we are waiting for a response to, and an
+            estimate of the total bytes of memory they use
+        """
+        numbytes = 0
+        for record in self.__callback_functions.values():
+            numbytes = numbytes + record.get_size()
+        return {
+            'outstanding': len(self.__callback_functions),
+            'bytes': numbytes,
+            }
 
     def is_unsatisfied_message(self, msgId):
         """
@@ -190,6 +281,8 @@ class ConversationManager:
     def send_response(self, prevmsgId, msgbody, mymetainfo=None, hint=HINT_NO_HINT):
         """
         @param msgbody the message body to be sent back
+        @param mymetainfo our metainfo dict (or a mencode.PreEncodedThing of it, which is
+            spliced into the message without encoding it again), or `None'
         
         @precondition `prevmsgId' must be a binary id.: idlib.is_binary_id(prevmsgId): "prevmsgId: %s" % humanreadable.hr(prevmsgId)
         @precondition `msgbody' must be either None or else the full msg dict, containing either a "mojo header" subdict or a "mojo message" subdict or both.: (not msgbody) or is_mojo_message(msgbody): "msgbody: %s" % humanreadable.hr(msgbody)
@@ -212,16 +305,15 @@ class ConversationManager:
         msgstr = MojoMessage.makeResponseMessage(inmsgtype + ' response', msgbody, prevmsgId, freshnessproof=self._map_cid_to_freshness_proof.get(counterparty_id), mymetainfo=mymetainfo, extrametainfo=None)
         self._MTM.send_message_with_lookup(counterparty_id, msgstr, hint=hint | HINT_THIS_IS_A_RESPONSE)
 
-    def _process(self, msg, msgId, counterparty_id, commstrat=None):
+    def _process(self, parsedmsg, msgId, counterparty_id, commstrat=None):
         """
         This gets called for all incoming messages, by `handle_raw_message()'.  It verifies the
-        message's integrity and either send it to a handler func to generate a response or send
-        it to the appropriate callback func.
+        message's conversation markers and either send it to a handler func to generate a
+        response or send it to the appropriate callback func.
 
-        @returns a tuple whose first element is the full msg body (containing a 'mojo header' and/or 'mojo message' subdict) in dict form and whose second element is a CommHint, or std.NO_RESPONSE or std.ASYNC_RESPONSE
+        @param parsedmsg the MojoMessage.ParsedMessage of the incoming message
 
-        @throws MojoMessage.BadFormatError if the message isn't properly formatted in
-            MojoMessage format
+        @returns a tuple whose first element is the full msg body (containing a 'mojo header' and/or 'mojo message' subdict) in dict form and whose second element is a CommHint, or std.NO_RESPONSE or std.ASYNC_RESPONSE
 
         @precondition `counterparty_id' must be an id.: idlib.is_sloppy_id(counterparty_id): "counterparty_id: %s" % humanreadable.hr(counterparty_id)
 
@@ -238,16 +330,16 @@ class ConversationManager:
         # (note: this writes them in the current directory, normally localweb/webroot)
         ##_dbg_fname = 'message.%05d' % self._in_message_num
         ##_dbg_f = open(_dbg_fname, 'wb')
-        ##_dbg_f.write(msg)
+        ##_dbg_f.write(parsedmsg.msgString)
         ##_dbg_f.close()
         ##self._in_message_num += 1  # note: python 2.0 syntax
         # end DEBUG
 
-        reference = MojoMessage.getReference(msg)
-        nonce = MojoMessage.getNonce(msg)
-        recipient_id = MojoMessage.getRecipient(msg)
-        senders_metainfo = MojoMessage.getSendersMetaInfo(msg)
-        extra_metainfo = MojoMessage.getExtraMetaInfo(msg)
+        reference = parsedmsg.reference
+        nonce = parsedmsg.nonce
+        recipient_id = parsedmsg.recipient
+        senders_metainfo = parsedmsg.metainfo
+        extra_metainfo = parsedmsg.extra_metainfo
 
         if nonce is not None :
             # this is a first message
@@ -257,7 +349,7 @@ class ConversationManager:
             if not idlib.is_sloppy_id(nonce) :
                 debugprint("WARNING: a Mojo Message arrived with badly formed nonce: %s\n", args=(nonce,), v=1, vs="conversation")
                 return std.NO_RESPONSE
-            conversationtype = MojoMessage.getType(msg)
+            conversationtype = parsedmsg.msgtype
 
             # We now have a hint -- we're expecting to respond to this.
             if commstrat:
@@ -267,10 +359,10 @@ class ConversationManager:
             if self._map_inmsgid_to_info.has_key(msgId):
                 # This can only happen if we have already started processing this unique message.
                 return std.ASYNC_RESPONSE
-            self._map_inmsgid_to_info[msgId] = (counterparty_id, MojoMessage.getType(msg), EXPECTING_RESPONSE)
+            self._map_inmsgid_to_info[msgId] = (counterparty_id, conversationtype, EXPECTING_RESPONSE)
             # Reminder: do not somehow change this handle_initiating_message call to be on the DoQ in the future without changing
             # the MTM.__in_message_for_you logic used in fast relay to prevent nested 'message for you' messages.  -greg
-            result = self._MTM.handle_initiating_message(counterparty_id, conversationtype, MojoMessage.getBody(msg), firstmsgId=msgId) 
+            result = self._MTM.handle_initiating_message(counterparty_id, conversationtype, parsedmsg.body, firstmsgId=msgId) 
             if result is std.NO_RESPONSE:
                 self.drop_request_state(msgId)
             if result is None:
@@ -293,29 +385,30 @@ class ConversationManager:
                 debugprint("WARNING: a Mojo Message arrived with inconsistent conversation markers: nonce: %s, reference: %s, recipient_id: %s\n", args=(nonce, reference, recipient_id), v=1, vs="conversation")
                 return std.NO_RESPONSE
 
-            responsetype = MojoMessage.getType(msg)
+            responsetype = parsedmsg.msgtype
 
             # Make sure that this is a response to a message that we sent, from the person to whom we sent it.
-            initial = self.__callback_functions.get(reference)
-            if initial is not None:
-                (recipient_id, callback_function, notes, conversationtype, post_timeout_callback_function, timeoutcheckerschedtime,) = initial
+            record = self.__callback_functions.get(reference)
+            if record is not None:
                 del self.__callback_functions[reference]
-                DoQ.doq.remove_task(timeoutcheckerschedtime)
+                TimerWheel.wheel.cancel(record.timerhandle)
+                record.timerhandle = None
+                recipient_id = record.counterparty_id
+                callback_function = record.outcome_func
             else:
                 # If it wasn't in the `__callback_functions' dict, it might be in the `__posttimeout_callback_functions' dict.
-                recipient_id, conversationtype, msgtimeout, post_timeout_callback_function, post_timeout_notes = self.__posttimeout_callback_functions.get(reference, (None, None, None, None, None,))
-                if recipient_id is not None:
-                    del self.__posttimeout_callback_functions[reference]  # proactively clean up this cache
+                record = self.__posttimeout_callback_functions.get(reference)
+                if record is None:
+                    return std.NO_RESPONSE
+                del self.__posttimeout_callback_functions[reference]  # proactively clean up this cache
+                recipient_id = record.counterparty_id
                 if not idlib.equal(recipient_id, counterparty_id):
                     return std.NO_RESPONSE
                 # log the late response
-                if conversationtype is not None:
-                    debugprint("received %s to msgId %s %s from %s %s seconds after the timeout\n", args=(responsetype, reference, conversationtype, counterparty_id, "%0.2f" % (time() - msgtimeout)), v=2, vs='Conversation')
+                debugprint("received %s to msgId %s %s from %s %s seconds after the timeout\n", args=(responsetype, reference, record.conversationtype, counterparty_id, "%0.2f" % (time() - record.timeouttime)), v=2, vs='Conversation')
 
-                if post_timeout_callback_function:
-                    # recipient_id and conversationtype were set above
-                    callback_function = post_timeout_callback_function
-                    notes = post_timeout_notes
+                if record.post_timeout_outcome_func:
+                    callback_function = record.post_timeout_outcome_func
                     debugprint("post timeout callback for response of type %s to msgId %s\n", args=(responsetype, reference,), v=5, vs='Conversation')
                 else:
                     # keep track of the number of outstanding response messages for handicapping purposes
@@ -332,8 +425,8 @@ class ConversationManager:
             if num > 0:  # make sure it stays >= 0 just in case threaded access happened somehow and messed it up
                 self.__outstanding_messages[recipient_id] = num - 1
 
-            if conversationtype + ' response' != responsetype:
-                debugprint("message of unexpected type %s from %s in response to a %s\n", args=(responsetype, counterparty_id, conversationtype), v=3, vs='Conversation')
+            if record.conversationtype + ' response' != responsetype:
+                debugprint("message of unexpected type %s from %s in response to a %s\n", args=(responsetype, counterparty_id, record.conversationtype), v=3, vs='Conversation')
                 return std.NO_RESPONSE
 
             # Do hints about expecting responses...
@@ -346,7 +439,9 @@ class ConversationManager:
                     else:
                         pass
 
-            callback_function(outcome=MojoMessage.getBody(msg), notes=notes)
+            record.outcome_func = None
+            record.post_timeout_outcome_func = None
+            callback_function(outcome=parsedmsg.body, notes=record)
             return std.NO_RESPONSE
 
     def handle_raw_message(self, counterparty_id, inmsg, commstrat=None):
@@ -382,7 +477,10 @@ class ConversationManager:
 
             self._map_cid_to_freshness_proof[counterparty_id] = msgId
 
-            result = self._process(inmsg, msgId, counterparty_id, commstrat)
+            # Decode and check the message once, here, instead of in each of the steps below.
+            parsedmsg = MojoMessage.parse(inmsg)
+
+            result = self._process(parsedmsg, msgId, counterparty_id, commstrat)
             assert result is not None, "Result must not be `None'." + " -- " + "result: %s" % humanreadable.hr(result)
             assert (result is std.NO_RESPONSE) or (result is std.ASYNC_RESPONSE) or ((type(result) in (types.TupleType, types.ListType,)) and (len(result) == 2) and is_mojo_message(result[0]) and CommHints.is_hint(result[1])), "postcondition: Result must be either std.NO_RESPONSE or std.ASYNC_RESPONSE or else a tuple whose first element is the full msg body dict, containing either a \"mojo header\" subdict or a \"mojo message\" subdict or both." + "--" + "result: %s" % humanreadable.hr(result)
 
@@ -24,6 +24,7 @@ import CommStrat
 from CommHints import HINT_EXPECT_RESPONSE, HINT_EXPECT_MORE_TRANSACTIONS, HINT_EXPECT_NO_MORE_COMMS, HINT_EXPECT_TO_RESPOND, HINT_THIS_IS_A_RESPONSE, HINT_NO_HINT
 import DoQ
 import MojoKey
+import PKOpPool
 import confutils
 import humanreadable
 import idlib
@@ -74,8 +75,22 @@ class CryptoCommsHandler:
         self._tcpch = tcpch
         # map cid to instance of CommStrat
         self._cid_to_cs = {}
+
+        # If PK_OP_THREADS is set, the public key operations needed to parse a message with an
+        # unfamiliar header are done in a pool of threads instead of on the DoQ.
+        numpkopthreads = int(confutils.confman.get('PK_OP_THREADS', '0'))
+        if numpkopthreads > 0:
+            self._pkoppool = PKOpPool.PKOpPool(numpkopthreads, maxqueued=int(confutils.confman.get('PK_OP_MAX_QUEUED', str(numpkopthreads * 4))))
+        else:
+            self._pkoppool = None
+        # maps header to a list of (msg, lowerstrategy, strategy_id_for_debug,) for the incoming messages which are waiting for the pool to parse that header
+        self._pending_headers = {}
  
     def shutdown(self):
+        if self._pkoppool is not None:
+            self._pkoppool.shutdown()
+            self._pkoppool = None
+        self._pending_headers = {}
         if hasattr(self, '_cid_to_cs'):
             del self._cid_to_cs
         if hasattr(self, '_mesgen'):
@@ -160,6 +175,19 @@ class CryptoCommsHandler:
         assert type(msg) == types.StringType, "precondition: `msg' must be a string." + " -- " + "msg: %s :: %s" % (humanreadable.hr(msg), humanreadable.hr(type(msg)))
         assert (strategy_id_for_debug is None) == (lowerstrategy is None), "precondition: `strategy_id_for_debug' must be None if and only if `lowerstrategy' is None." + " -- " + "strategy_id_for_debug: %s, lowerstrategy: %s" % (humanreadable.hr(strategy_id_for_debug), humanreadable.hr(lowerstrategy))
 
+        if self._pkoppool is not None:
+            header = self._mesgen.get_uncached_header(msg)
+            if header is not None:
+                waiting = self._pending_headers.get(header)
+                if waiting is not None:
+                    # The pool is already parsing this header.
+                    waiting.append((msg, lowerstrategy, strategy_id_for_debug,))
+                    return
+                if self._pkoppool.submit(self._mesgen.undo_header_pk_ops, args=(header,), resultfunc=lambda parsed, self=self, header=header: self._header_pk_ops_done(header, parsed), errorfunc=lambda le, self=self, header=header: self._header_pk_ops_failed(header, le)):
+                    self._pending_headers[header] = [(msg, lowerstrategy, strategy_id_for_debug,)]
+                    return
+                # Else the pool is full, so we'll do the PK ops right here (in `parse()').
+
         try:
             counterparty_pub_key, cleartext = self._mesgen.parse(msg)
         except mesgen.Error, e:
@@ -218,6 +246,45 @@ class CryptoCommsHandler:
             self.use_comm_strategy(counterparty_id, CommStrat.Crypto(counterparty_pub_key, lowerstrategy))
         self._upward_inmsg_handler(counterparty_id, decomptext, self._cid_to_cs.get(counterparty_id))
 
+    def _header_pk_ops_done(self, header, parsed):
+        """
+        Stores the result of the pool's parsing of `header' and then processes the messages that
+        were waiting for it (now without any public key operations).
+
+        @precondition This thread must be the DoQ thread.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This thread must be the DoQ thread."
+
+        waiting = self._pending_headers.get(header)
+        if waiting is None:
+            # We've been shut down.
+            return
+        del self._pending_headers[header]
+        try:
+            self._mesgen.store_parsed_header(header, parsed)
+        except mesgen.Error, le:
+            self._header_pk_ops_failed(header, le, waiting)
+            return
+        for (msg, lowerstrategy, strategy_id_for_debug,) in waiting:
+            self.inmsg_handler(msg, lowerstrategy, strategy_id_for_debug)
+
+    def _header_pk_ops_failed(self, header, le, waiting=None):
+        """
+        Drops the messages that were waiting for the pool to parse `header'.
+
+        @precondition This thread must be the DoQ thread.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This thread must be the DoQ thread."
+
+        if waiting is None:
+            waiting = self._pending_headers.get(header)
+            if waiting is None:
+                # We've been shut down.
+                return
+            del self._pending_headers[header]
+        for (msg, lowerstrategy, strategy_id_for_debug,) in waiting:
+            debugprint("WARNING: a message arrived with suggested strategy_id_for_debug %s that couldn't be decrypted.  Perhaps it was cleartext, or garbled.  The message was %s.  The error was: %s\n", args=(strategy_id_for_debug, msg, le), v=1, vs="crypto")
+
     def _forget_comm_strategy(self, counterparty_id, commstrat=None):
         """
         @precondition This thread must be the DoQ thread.: DoQ.doq.is_currently_doq()
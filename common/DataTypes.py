@@ -128,6 +128,8 @@ def AndMarker(templs):
                 inner_check_verbose(thing, templ)
             else:
                 inner_check_noverbose(thing, templ)
+    # for `compile_template()'
+    func.marker = ('and', templs,)
     return func
 
 def NotMarker(template):
@@ -140,6 +142,8 @@ def NotMarker(template):
         except BadFormatError:
             return
         raise BadFormatError, "got match when should not have"
+    # for `compile_template()'
+    func.marker = ('not', template,)
     return func
 
 NOT_PRESENT = OptionMarker(NotMarker(NONEMPTY))
@@ -165,6 +169,8 @@ def ListMarker(template, ListType=types.ListType, TupleType=types.TupleType):
                     inner_check_verbose(i, template)
                 else:
                     inner_check_noverbose(i, template)
+    # for `compile_template()'
+    func.marker = ('list', template,)
     return func
 
 def is_template_matching(thing, templ):
@@ -183,6 +189,14 @@ def check_template(thing, templ):
         return
     except BadFormatError, reason:
         pass
+    _explain_failure(thing, templ)
+
+def _explain_failure(thing, templ):
+    """
+    Re-checks `thing' verbosely in order to raise a BadFormatError which says why it didn't
+    match.  Only call this after a quick check has already failed, since building the reason
+    is slow.
+    """
     try:
         inner_check_verbose(thing, templ)
     except BadFormatError, reason:
@@ -306,6 +320,227 @@ def inner_check_noverbose(thing, templ, FunctionType=types.FunctionType, MethodT
     else:
         assert false, "bad template - " + std.hr(templ)
 
+class CompiledTemplate:
+    """
+    A template which has been turned into a tree of predicates once, so that checking a thing
+    against it doesn't have to re-interpret the template each time.  The predicates just
+    return true or false -- they never raise and never build failure reasons.  Only when a
+    check fails is the thing re-checked against the original template by the verbose checker
+    in order to say why.
+
+    Use `compile_template()' to make one, and keep it around: compiling costs more than a
+    single check does.
+    """
+    def __init__(self, templ):
+        self.templ = templ
+        self.matches = _compile(templ)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, std.hr(self.templ),)
+
+    def check(self, thing):
+        """
+        throws BadFormatError if the thing does not match the template
+        """
+        if not self.matches(thing):
+            _explain_failure(thing, self.templ)
+            raise BadFormatError, 'failed template check.  template was: (' + std.hr(self.templ) + ') target was: (' + std.hr(thing) + ')'
+
+def compile_template(templ):
+    """
+    @returns a CompiledTemplate which checks things exactly as `check_template(thing, templ)'
+        does
+    """
+    return CompiledTemplate(templ)
+
+def _pred_from_func(func, BadFormatError=BadFormatError):
+    """
+    Wraps a template function (which raises BadFormatError) as a predicate.
+    """
+    def pred(thing, func=func, BadFormatError=BadFormatError):
+        try:
+            func(thing, false)
+        except BadFormatError:
+            return false
+        return true
+    return pred
+
+def _pred_NONEMPTY(thing):
+    return true
+
+def _pred_ANY(thing):
+    return thing is not None
+
+def _pred_STRING(thing, StringType=types.StringType):
+    return type(thing) is StringType
+
+def _pred_UNIQUE_ID(thing, StringType=types.StringType):
+    return (type(thing) is StringType) and std.is_sloppy_id(thing)
+
+def _pred_ASCII_ID(thing, StringType=types.StringType):
+    return (type(thing) is StringType) and std.is_mojosixbitencoded_id(thing)
+
+def _pred_BINARY_SHA1(thing, StringType=types.StringType):
+    return (type(thing) is StringType) and std.is_canonical_uniq(thing)
+
+# Predicates for the common template functions which are cheaper than catching the
+# BadFormatError that they raise.  The others are wrapped by `_pred_from_func()'.
+_FUNC_PREDS = {
+    NONEMPTY: _pred_NONEMPTY,
+    ANY: _pred_ANY,
+    STRING: _pred_STRING,
+    UNIQUE_ID: _pred_UNIQUE_ID,
+    ASCII_ID: _pred_ASCII_ID,
+    BINARY_SHA1: _pred_BINARY_SHA1,
+    }
+
+def _compile_marker(marker, ListType=types.ListType, TupleType=types.TupleType):
+    (kind, templ,) = marker
+    if kind == 'list':
+        elempred = _compile(templ)
+        def pred(thing, elempred=elempred, ListType=ListType, TupleType=TupleType):
+            if type(thing) is not ListType and type(thing) is not TupleType:
+                return false
+            for elem in thing:
+                if not elempred(elem):
+                    return false
+            return true
+        return pred
+    elif kind == 'and':
+        preds = map(_compile, templ)
+        def pred(thing, preds=preds):
+            for subpred in preds:
+                if not subpred(thing):
+                    return false
+            return true
+        return pred
+    else:
+        assert kind == 'not', "bad marker - " + std.hr(marker)
+        subpred = _compile(templ)
+        return lambda thing, subpred=subpred: not subpred(thing)
+
+def _compile(templ, FunctionType=types.FunctionType, MethodType=types.MethodType, DictType=types.DictType, StringType=types.StringType, LongType=types.LongType, IntType=types.IntType, ListType=types.ListType, TupleType=types.TupleType):
+    """
+    @returns a predicate which returns true if and only if `inner_check_noverbose(thing, templ)'
+        would not raise BadFormatError
+    """
+    # The order of these tests is the same as in `inner_check_noverbose()', since e.g. a string
+    # template is also `== 0' if you ask the wrong way.
+    templtype = type(templ)
+    if templtype is FunctionType or templtype is MethodType:
+        pred = _FUNC_PREDS.get(templ)
+        if pred is not None:
+            return pred
+        if hasattr(templ, 'marker'):
+            return _compile_marker(templ.marker)
+        return _pred_from_func(templ)
+    elif templtype is DictType:
+        required = []
+        optional = []
+        for (key, subtempl,) in templ.items():
+            if isinstance(subtempl, OptionMarker):
+                optional.append((key, _compile(subtempl.template),))
+            else:
+                required.append((key, _compile(subtempl),))
+        def pred(thing, required=required, optional=optional, DictType=DictType):
+            if type(thing) is not DictType:
+                return false
+            for (key, subpred,) in required:
+                if not thing.has_key(key):
+                    return false
+                if not subpred(thing[key]):
+                    return false
+            for (key, subpred,) in optional:
+                if thing.has_key(key) and not subpred(thing[key]):
+                    return false
+            return true
+        return pred
+    elif templtype is StringType:
+        return lambda thing, templ=templ, StringType=StringType: (type(thing) is StringType) and (thing == templ)
+    elif templ == 0 or templ == -1 or templ == 1:
+        if templ == 0:
+            return lambda thing, LongType=LongType, IntType=IntType: ((type(thing) is IntType) or (type(thing) is LongType)) and (thing >= 0)
+        elif templ == -1:
+            return lambda thing, LongType=LongType, IntType=IntType: (type(thing) is IntType) or (type(thing) is LongType)
+        else:
+            assert templ == 1
+            return lambda thing, LongType=LongType, IntType=IntType: ((type(thing) is IntType) or (type(thing) is LongType)) and (thing > 0)
+    elif templtype is ListType or templtype is TupleType:
+        if len(filter(lambda t, StringType=StringType: type(t) is not StringType, templ)) == 0:
+            # The common case of a choice between strings, e.g. `["success", "failure"]', is
+            # just a dict lookup.
+            choices = {}
+            for choice in templ:
+                choices[choice] = None
+            return lambda thing, choices=choices, StringType=StringType: (type(thing) is StringType) and choices.has_key(thing)
+        preds = map(_compile, templ)
+        def pred(thing, preds=preds):
+            for subpred in preds:
+                if subpred(thing):
+                    return true
+            return false
+        return pred
+    elif templ is None:
+        return lambda thing: thing is None
+    else:
+        assert false, "bad template - " + std.hr(templ)
+
+def _help_make_id_list(n):
+    import idlib
+    ids = []
+    for i in xrange(n):
+        ids.append(idlib.new_random_uniq())
+    return ids
+
+def _bench_it_check_template_id_list(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    check_template(_help_make_id_list(n), ListMarker(UNIQUE_ID))
+
+def _bench_it_compiled_template_id_list(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    compile_template(ListMarker(UNIQUE_ID)).check(_help_make_id_list(n))
+
+def _profile_test_template_speed():
+    import mojoutil
+    profit = mojoutil._dont_enable_if_you_want_speed_profit
+    profit(_real_test_template_speed)
+
+def _real_test_template_speed():
+    """
+    Checks a few of the message bodies from "OurMessages.py", including a 'do you have blobs
+    response' of thousands of ids, with both `check_template()' and `compile_template()'.
+    """
+    import time
+    import OurMessages
+
+    ids = _help_make_id_list(5000)
+    cases = (
+        ('do you have blobs response', ids,),
+        ('do you have blobs', {'block id list': ids},),
+        ('put blob response', {'result': "failure"},),
+        ('request blob response', {'result': "failure"},),
+        )
+    for (msgtype, body,) in cases:
+        templ = OurMessages.templs[msgtype]
+        ctempl = compile_template(templ)
+        if (type(body) is types.ListType) or body.has_key('block id list'):
+            n = 20
+        else:
+            n = 20000
+
+        t1 = time.time()
+        for i in xrange(n):
+            check_template(body, templ)
+        t2 = time.time()
+        for i in xrange(n):
+            ctempl.check(body)
+        t3 = time.time()
+        print '%s: %d checks, interpreted: %3.3f, compiled: %3.3f' % (msgtype, n, t2 - t1, t3 - t2,)
+
 def test_not_on_rejection():
     check_template('a', NotMarker('b'))
 
@@ -478,7 +713,41 @@ def test_check_multiple_in_second_depth_fail() :
         return 0
     except BadFormatError :
         return 1
-    
+
+def test_compiled_agrees_with_check_template():
+    templates = (
+        ANY, STRING, NONEMPTY, INTEGER, None, 0, -1, 1, 'spam',
+        ["success", "failure"],
+        ({"a" : ANY, "b" : ANY}, {"c" : ANY, "d" : ANY}),
+        {"a" : ({"c" : ANY}, {"d" : ANY})},
+        {'spam' : OptionMarker('eggs'), 'bacon' : 0},
+        {'spam' : NOT_PRESENT},
+        ListMarker({"a" : ANY}),
+        ListMarker(["spam", 1]),
+        AndMarker((STRING, NotMarker('spam'))),
+        lambda thing, verbose: None,
+        )
+    things = (
+        None, 0, -2, 3, 4L, '', 'spam', 'eggs', '17', 'success', [], [{"a" : "a"}, {"a" : "a"}], [{"a" : "a"}, {"b" : "a"}],
+        ['spam', 3], ['spam', 0], ('spam',), {}, {"a" : "spam", "b" : "eggs"}, {"a" : "spam", "c" : "eggs"},
+        {"a" : {"d" : "spam"}}, {"a" : {"a" : "spam"}}, {'bacon' : 0}, {'bacon' : 0, 'spam' : 'eggs'},
+        {'bacon' : 0, 'spam' : None}, {'spam' : 'eggs'},
+        )
+    for templ in templates:
+        ctempl = compile_template(templ)
+        for thing in things:
+            assert ctempl.matches(thing) == is_template_matching(thing, templ), "thing: %s, templ: %s" % (std.hr(thing), std.hr(templ),)
+
+def test_compiled_failure_says_why():
+    ctempl = compile_template({'spam' : ListMarker(1)})
+    ctempl.check({'spam' : [1, 2]})
+    try:
+        ctempl.check({'spam' : [1, 0]})
+    except BadFormatError, le:
+        assert str(le).find('mismatch at index') != -1, "le: %s" % std.hr(le)
+    else:
+        assert false, "should have raised BadFormatError"
+
 mojo_test_flag = 1
 
 def run():
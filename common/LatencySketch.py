@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2002 Bryce "Zooko" Wilcox-O'Hearn
+#  This file is licensed under the
+#    GNU Lesser General Public License v2.1.
+#    See the file COPYING or visit http://www.gnu.org/ for details.
+#
+
+# standard modules
+import math
+import time
+
+# pyutil modules
+import humanreadable
+
+true = 1
+false = None
+
+class LatencySketch:
+    """
+    A small, mergeable summary of a stream of latencies (in seconds) from which any quantile can
+    be read, to within a relative error of `accuracy'.  (This is the "DDSketch" scheme:
+    logarithmically sized buckets, so that a bucket's width is proportional to the values in
+    it.)  Unlike a mean and standard deviation it says the right thing about heavy-tailed
+    distributions, such as the response times of counterparties on the Internet.
+
+    So that it keeps up with counterparties that get faster or slower, all the counts are
+    halved whenever the total reaches `halflife', which forgets old samples exponentially.
+
+    Instances can be pickled.
+    """
+    def __init__(self, accuracy=0.02, halflife=200, minvalue=0.001, maxbuckets=512):
+        """
+        @param accuracy the relative error of `quantile()'
+        @param halflife the number of samples after which the older ones count half as much
+        @param minvalue latencies at or below this are all counted as `minvalue'
+        @param maxbuckets if there would be more buckets than this then the lowest ones are
+            merged together, making the smallest quantiles less accurate
+
+        @precondition `accuracy' must be strictly between 0 and 1.: (accuracy > 0) and (accuracy < 1): "accuracy: %s" % humanreadable.hr(accuracy)
+        @precondition `halflife' must be at least 2.: halflife >= 2: "halflife: %s" % humanreadable.hr(halflife)
+        @precondition `minvalue' must be positive.: minvalue > 0: "minvalue: %s" % humanreadable.hr(minvalue)
+        """
+        assert (accuracy > 0) and (accuracy < 1), "precondition: `accuracy' must be strictly between 0 and 1." + " -- " + "accuracy: %s" % humanreadable.hr(accuracy)
+        assert halflife >= 2, "precondition: `halflife' must be at least 2." + " -- " + "halflife: %s" % humanreadable.hr(halflife)
+        assert minvalue > 0, "precondition: `minvalue' must be positive." + " -- " + "minvalue: %s" % humanreadable.hr(minvalue)
+
+        self._gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self._loggamma = math.log(self._gamma)
+        self._halflife = halflife
+        self._minvalue = float(minvalue)
+        self._maxbuckets = maxbuckets
+        self._buckets = {} # maps bucket index to count
+        self._count = 0.0
+
+    def __repr__(self):
+        return "<%s count: %0.1f, p50: %s, p95: %s, %x>" % (self.__class__.__name__, self._count, self.quantile(0.5), self.quantile(0.95), id(self),)
+
+    def __len__(self):
+        """
+        @returns the number of samples, counting the decayed ones fractionally
+        """
+        return int(self._count)
+
+    def _index(self, value):
+        return int(math.ceil(math.log(max(value, self._minvalue)) / self._loggamma))
+
+    def add(self, value, count=1):
+        """
+        @param value a latency in seconds
+        """
+        i = self._index(value)
+        self._buckets[i] = self._buckets.get(i, 0) + count
+        self._count = self._count + count
+        if len(self._buckets) > self._maxbuckets:
+            self._collapse()
+        if self._count >= self._halflife:
+            self._decay()
+
+    def merge(self, other):
+        """
+        Adds all of the samples in `other' into this one.
+
+        @precondition `other' must have the same accuracy as this one.: other._gamma == self._gamma
+        """
+        assert other._gamma == self._gamma, "precondition: `other' must have the same accuracy as this one."
+
+        for (i, count,) in other._buckets.items():
+            self._buckets[i] = self._buckets.get(i, 0) + count
+        self._count = self._count + other._count
+        while len(self._buckets) > self._maxbuckets:
+            self._collapse()
+        while self._count >= self._halflife:
+            self._decay()
+
+    def quantile(self, q):
+        """
+        @returns the latency below which the fraction `q' of the samples fall, or `None' if
+            there are no samples
+
+        @precondition `q' must be between 0 and 1.: (q >= 0) and (q <= 1): "q: %s" % humanreadable.hr(q)
+        """
+        assert (q >= 0) and (q <= 1), "precondition: `q' must be between 0 and 1." + " -- " + "q: %s" % humanreadable.hr(q)
+
+        if not self._buckets:
+            return None
+        indices = self._buckets.keys()
+        indices.sort()
+        rank = q * self._count
+        sofar = 0
+        for i in indices:
+            sofar = sofar + self._buckets[i]
+            if sofar >= rank:
+                break
+        # the middle of the bucket, which is within `accuracy' of everything in it
+        return max(self._minvalue, 2.0 * (self._gamma ** i) / (self._gamma + 1.0))
+
+    def _collapse(self):
+        indices = self._buckets.keys()
+        indices.sort()
+        (lowest, nextlowest,) = indices[:2]
+        self._buckets[nextlowest] = self._buckets[nextlowest] + self._buckets[lowest]
+        del self._buckets[lowest]
+
+    def _decay(self):
+        buckets = {}
+        for (i, count,) in self._buckets.items():
+            count = count / 2.0
+            # Forget buckets that have dwindled to nothing.
+            if count >= 0.01:
+                buckets[i] = count
+        self._buckets = buckets
+        self._count = reduce(lambda x, y: x + y, buckets.values(), 0.0)
+
+def _help_test_within_accuracy(actual, expected, accuracy=0.02):
+    assert abs(actual - expected) <= (expected * accuracy * 1.01), "actual: %s, expected: %s" % (actual, expected,)
+
+def test_quantiles_of_a_heavy_tail():
+    ls = LatencySketch(halflife=10**6)
+    assert ls.quantile(0.5) is None
+    # 90 fast responses and 10 very slow ones
+    for i in range(90):
+        ls.add(0.1 + (i * 0.001))
+    for i in range(10):
+        ls.add(30.0 + i)
+    assert len(ls) == 100
+    _help_test_within_accuracy(ls.quantile(0.5), 0.1 + (49 * 0.001))
+    _help_test_within_accuracy(ls.quantile(0.95), 34.0)
+    _help_test_within_accuracy(ls.quantile(1.0), 39.0)
+
+def test_merge():
+    ls1 = LatencySketch(halflife=10**6)
+    ls2 = LatencySketch(halflife=10**6)
+    for i in range(50):
+        ls1.add(1.0)
+        ls2.add(10.0)
+    ls1.merge(ls2)
+    assert len(ls1) == 100
+    _help_test_within_accuracy(ls1.quantile(0.25), 1.0)
+    _help_test_within_accuracy(ls1.quantile(0.75), 10.0)
+
+def test_old_samples_are_forgotten():
+    ls = LatencySketch(halflife=100)
+    for i in range(1000):
+        ls.add(10.0)
+    for i in range(1000):
+        ls.add(1.0)
+    assert len(ls) < 100
+    _help_test_within_accuracy(ls.quantile(0.99), 1.0)
+
+def test_maxbuckets():
+    ls = LatencySketch(maxbuckets=8, halflife=10**6)
+    for i in range(100):
+        ls.add(1.1 ** i)
+    assert len(ls._buckets) <= 8
+    # The biggest quantiles are still accurate.
+    _help_test_within_accuracy(ls.quantile(1.0), 1.1 ** 99)
+
+def _bench_it_add(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    ls = LatencySketch()
+    for i in xrange(n):
+        ls.add(0.05 + ((i % 1000) * 0.01))
+
+def _profile_test_add_speed():
+    import mojoutil
+    profit = mojoutil._dont_enable_if_you_want_speed_profit
+    profit(_real_test_add_speed)
+
+def _real_test_add_speed():
+    for n in (1000, 10000, 100000,):
+        t1 = time.time()
+        _bench_it_add(n)
+        t2 = time.time()
+        print '_bench_it_add(%d): %3.3f seconds' % (n, t2 - t1,)
+
+mojo_test_flag = 1
+
+def run():
+    import RunTests
+    RunTests.runTests(["LatencySketch"])
+
+if __name__ == '__main__':
+    run()
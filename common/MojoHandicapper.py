@@ -24,6 +24,9 @@ import humanreadable
 import idlib
 import mojoutil
 
+true = 1
+false = None
+
 DISQUALIFIED = ()
 
 def getnameofhandicapper(thingie):
@@ -44,10 +47,10 @@ class MojoHandicapper :
     A very simple business logic utility - for each message to be sent out, compute the 
     sum of all estimated real costs of it, and sort based on those.
     
-    Available methods are add_handicapper and sort_by_preference
+    Available methods are add_handicapper, add_batch_handicapper and sort_by_preference
     """
     def __init__(self) :
-        self.__handicappers_map = {None: []}   # maps from message type to a list of handicappers (None = all messages)
+        self.__handicappers_map = {None: []}   # maps from message type to a list of (handicapper, isbatch,) (None = all messages)
         
     def add_handicapper(self, handicapper, mtypes=None) :
         """
@@ -76,44 +79,128 @@ class MojoHandicapper :
         assert callable(handicapper), "precondition: `handicapper' must be a callable." + " -- " + "handicapper: %s :: %s" % (humanreadable.hr(handicapper), `type(handicapper)`)
         assert (mtypes is None) or (type(mtypes) in (types.ListType, types.TupleType,)), "precondition: `mtypes' must be None or a sequence."
 
+        self._add(handicapper, false, mtypes)
+
+    def add_batch_handicapper(self, handicapper, mtypes=None):
+        """
+        Adds a handicap computing function which computes the handicaps of many counterparties
+        in one call.  This is cheaper than a handicapper which is called once per counterparty
+        when choosing among hundreds of them (e.g. relay servers).
+
+        A batch handicap function must take the parameters counterparties (a list of
+        (counterparty_id, metainfo,) tuples), message_type, and message_body, and return a
+        list of the same length holding a float value or DISQUALIFIED for each counterparty.
+
+        Counterparties already disqualified by an earlier handicapper are not passed to it.  If
+        it raises an exception then all of the counterparties passed to it are disqualified.
+
+        See `add_handicapper()' for `mtypes' and how the results are used.
+
+        @precondition `handicapper' must be a callable.: callable(handicapper): "handicapper: %s :: %s" % (humanreadable.hr(handicapper), `type(handicapper)`)
+        @precondition `mtypes' must be None or a sequence.: (mtypes is None) or (type(mtypes) in (types.ListType, types.TupleType,))
+        """
+        assert callable(handicapper), "precondition: `handicapper' must be a callable." + " -- " + "handicapper: %s :: %s" % (humanreadable.hr(handicapper), `type(handicapper)`)
+        assert (mtypes is None) or (type(mtypes) in (types.ListType, types.TupleType,)), "precondition: `mtypes' must be None or a sequence."
+
+        self._add(handicapper, true, mtypes)
+
+    def _add(self, handicapper, isbatch, mtypes):
         if mtypes is None:
-            self.__handicappers_map[None].append(handicapper)
+            self.__handicappers_map[None].append((handicapper, isbatch,))
         else:
             for mtype in mtypes:
-                setdefault(self.__handicappers_map, mtype, []).append(handicapper)
-        
+                setdefault(self.__handicappers_map, mtype, []).append((handicapper, isbatch,))
+
     def _compute_handicap(self, counterparty_id, metainfo, message_type, message_body):
         """
         Computes the 'handicap', or estimated real cost including risk of failure, 
         of sending the message to the counterparty.
+        """
+        return self._compute_handicaps([(counterparty_id, metainfo,)], message_type, message_body)[0]
+
+    def _compute_handicaps(self, counterparties, message_type, message_body):
+        """
+        Computes the handicaps of sending the message to each of the counterparties.  Each
+        batch handicapper is called once with all of the counterparties which are still
+        qualified, and each other handicapper once per counterparty which is still qualified.
+
+        @param counterparties a sequence of (counterparty_id, metainfo,)
+
+        @returns a list of the handicap (or DISQUALIFIED) of each of `counterparties', in the
+            same order
 
         @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
-        @precondition `counterparty_id' must be a binary id.: idlib.is_binary_id(counterparty_id): "counterparty_id: %s" % humanreadable.hr(counterparty_id)
         """
         assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
-        assert idlib.is_binary_id(counterparty_id), "precondition: `counterparty_id' must be a binary id." + " -- " + "counterparty_id: %s" % humanreadable.hr(counterparty_id)
 
-        handicap = 0.0
+        handicaps = [0.0] * len(counterparties)
+        # the indexes into `counterparties' of the ones not yet disqualified
+        qualified = range(len(counterparties))
+        for (counterparty_id, metainfo,) in counterparties:
+            assert idlib.is_binary_id(counterparty_id), "precondition: `counterparty_id' must be a binary id." + " -- " + "counterparty_id: %s" % humanreadable.hr(counterparty_id)
+
         _hmap = self.__handicappers_map
-        for h in (_hmap.get(message_type, []) + _hmap[None]) :
-            try:
-                amount = h(counterparty_id = counterparty_id, metainfo = metainfo, message_type = message_type, message_body = message_body)
-            except:
-                debugprint("WARNING: counterparty %s disqualified due to exception:\n Handicapper Params (message_type=%s, message_body=%s, metainfo=%s)\n:", args=(counterparty_id, message_type, message_body, metainfo), v=2, vs="business logic")
-                traceback.print_exc(file=debugstream)
-                return DISQUALIFIED
-
-            assert amount is DISQUALIFIED or (type(amount) is types.FloatType), "Handicapper function must return certain type. -- func: %s, result: %s, counterparty_id: %s, metainfo: %s\n" % (humanreadable.hr(h), humanreadable.hr(amount), humanreadable.hr(counterparty_id), humanreadable.hr(metainfo)) # postcondition
-
-            if amount is DISQUALIFIED :
-                # debugprint("Handicap %s DISQUALIFIED for %s on %s\n", args=(getnameofhandicapper(h), counterparty_id, message_type), v=2, vs="business logic")
-                return DISQUALIFIED
+        for (h, isbatch,) in (_hmap.get(message_type, []) + _hmap[None]) :
+            if not qualified:
+                break
+            if isbatch:
+                batch = map(lambda i, counterparties=counterparties: counterparties[i], qualified)
+                try:
+                    amounts = h(counterparties = batch, message_type = message_type, message_body = message_body)
+                except:
+                    debugprint("WARNING: %d counterparties disqualified due to exception in batch handicapper %s:\n Handicapper Params (message_type=%s, message_body=%s)\n:", args=(len(batch), getnameofhandicapper(h), message_type, message_body), v=2, vs="business logic")
+                    traceback.print_exc(file=debugstream)
+                    amounts = [DISQUALIFIED] * len(batch)
+                assert len(amounts) == len(batch), "Batch handicapper function must return one result per counterparty. -- func: %s, len(result): %s, len(counterparties): %s\n" % (humanreadable.hr(h), len(amounts), len(batch)) # postcondition
             else:
-                assert amount >= 0.0
-                # debugprint("Handicap %s additive %s for %s on %s\n", args=(getnameofhandicapper(h), "%0.0f" % amount, counterparty_id, message_type), v=2, vs="business logic")
-                handicap = handicap + (amount**2)
-        # debugprint("Handicap %s for %s on %s\n", args=("%0.0f" % handicap, counterparty_id, message_type), v=2, vs="business logic")
-        return handicap
+                amounts = []
+                for i in qualified:
+                    (counterparty_id, metainfo,) = counterparties[i]
+                    try:
+                        amount = h(counterparty_id = counterparty_id, metainfo = metainfo, message_type = message_type, message_body = message_body)
+                    except:
+                        debugprint("WARNING: counterparty %s disqualified due to exception:\n Handicapper Params (message_type=%s, message_body=%s, metainfo=%s)\n:", args=(counterparty_id, message_type, message_body, metainfo), v=2, vs="business logic")
+                        traceback.print_exc(file=debugstream)
+                        amount = DISQUALIFIED
+                    amounts.append(amount)
+
+            stillqualified = []
+            for j in range(len(qualified)):
+                amount = amounts[j]
+                i = qualified[j]
+                assert amount is DISQUALIFIED or (type(amount) is types.FloatType), "Handicapper function must return certain type. -- func: %s, result: %s, counterparty_id: %s, metainfo: %s\n" % (humanreadable.hr(h), humanreadable.hr(amount), humanreadable.hr(counterparties[i][0]), humanreadable.hr(counterparties[i][1])) # postcondition
+
+                if amount is DISQUALIFIED :
+                    # debugprint("Handicap %s DISQUALIFIED for %s on %s\n", args=(getnameofhandicapper(h), counterparties[i][0], message_type), v=2, vs="business logic")
+                    handicaps[i] = DISQUALIFIED
+                else:
+                    assert amount >= 0.0
+                    handicaps[i] = handicaps[i] + (amount**2)
+                    stillqualified.append(i)
+            qualified = stillqualified
+        return handicaps
+
+    def _pick_best(self, counterparties, message_type, message_body):
+        best = None
+        bestcost = None
+        costs = self._compute_handicaps(counterparties, message_type, message_body)
+        for i in range(len(costs)):
+            cost = costs[i]
+            if cost is not DISQUALIFIED :
+                if (bestcost is None) or (cost < bestcost):
+                    bestcost = cost
+                    best = counterparties[i][0]
+        return best
+
+    def _sort_by_preference(self, counterparties, message_type, message_body):
+        # contains (cost, (counterparty_id, info,))
+        unsorted = []
+        costs = self._compute_handicaps(counterparties, message_type, message_body)
+        for i in range(len(costs)):
+            if costs[i] is not DISQUALIFIED :
+                unsorted.append((costs[i], counterparties[i]))
+        unsorted.sort()
+        return map(lambda x: x[1], unsorted)
 
     def pick_best(self, counterparties, message_type, message_body):
         """
@@ -125,15 +212,7 @@ class MojoHandicapper :
         """
         assert (type(counterparties) in (types.ListType, types.TupleType,)) and (len(filter(lambda x: not ((type(x) in (types.TupleType, types.DictType,)) and (len(x) == 2) and idlib.is_sloppy_id(x[0])), counterparties)) == 0), "precondition: `counterparties' must be a sequence of (id, infodict,) tuples." + " -- " + "counterparties: %s" % humanreadable.hr(counterparties)
 
-        best = None
-        bestcost = None
-        for (cpid, info,) in counterparties:
-            cost = self._compute_handicap(cpid, info, message_type=message_type, message_body=message_body)
-            if cost is not DISQUALIFIED :
-                if (bestcost is None) or (cost < bestcost):
-                    bestcost = cost
-                    best = cpid
-        return best
+        return self._pick_best(counterparties, message_type, message_body)
 
     def pick_best_from_dict(self, counterparties, message_type, message_body):
         """
@@ -141,15 +220,7 @@ class MojoHandicapper :
 
         @returns the id of the best (lowest handicap, not DISQUALIFIED) counterparty, or `None' if none (i.e., they were all disqualified, or the input `counterparties' was of length 0)
         """
-        best = None
-        bestcost = None
-        for cpid, info in counterparties.items():
-            cost = self._compute_handicap(cpid, info, message_type=message_type, message_body=message_body)
-            if cost is not DISQUALIFIED :
-                if (bestcost is None) or (cost < bestcost):
-                    bestcost = cost
-                    best = cpid
-        return best
+        return self._pick_best(counterparties.items(), message_type, message_body)
 
     def sort_by_preference_from_dict(self, counterparties, message_type, message_body):
         """
@@ -170,14 +241,7 @@ class MojoHandicapper :
 
         # debugprint("sort_by_preference_dict(counterparties: %s, message_type:%s, message_body: %s)\n", args=(counterparties, message_type, message_body,), v=2, vs="MojoHandicapper")
 
-        # contains (counterparty_id, cost)
-        unsorted = []
-        for counterpartyid, contactinfo in counterparties.items():
-            cost = self._compute_handicap(counterpartyid, contactinfo, message_type=message_type, message_body=message_body)
-            if cost is not DISQUALIFIED :
-                unsorted.append((cost, i))
-        unsorted.sort()
-        return map(lambda x: x[1], unsorted)
+        return self._sort_by_preference(counterparties.items(), message_type, message_body)
 
     def sort_by_preference(self, counterparties, message_type, message_body):
         """
@@ -196,14 +260,7 @@ class MojoHandicapper :
 
         # debugprint("sort_by_preference(counterparties: %s, message_type:%s, message_body: %s)\n", args=(counterparties, message_type, message_body,), v=2, vs="MojoHandicapper")
 
-        # contains (counterparty_id, cost)
-        unsorted = []
-        for i in counterparties :
-            cost = self._compute_handicap(i[0], i[1], message_type=message_type, message_body=message_body)
-            if cost is not DISQUALIFIED :
-                unsorted.append((cost, i))
-        unsorted.sort()
-        return map(lambda x: x[1], unsorted)
+        return self._sort_by_preference(counterparties, message_type, message_body)
 
 mojo_test_flag = 1
 
@@ -319,3 +376,55 @@ def test_uses_second_handicapper_stored() :
     assert result[0][0] == id_a
     assert result[1][0] == id_b
 
+def test_batch_handicapper() :
+    ids = map(lambda x: idlib.string_to_id(x), ('a', 'b', 'c', 'd',))
+    h = MojoHandicapper()
+    calls = []
+    def bfunc(counterparties, message_type, message_body, ids=ids, calls=calls) :
+        calls.append(len(counterparties))
+        return map(lambda (cpid, info,), ids=ids: float(3 - ids.index(cpid)), counterparties)
+    def cfunc(counterparty_id, metainfo, message_type, message_body, ids=ids) :
+        if counterparty_id == ids[0] :
+            return DISQUALIFIED
+        return 0.0
+    h.add_handicapper(cfunc)
+    h.add_batch_handicapper(bfunc)
+    result = h.sort_by_preference(map(lambda x: (x, None,), ids), 'a message', {})
+    assert map(lambda x: x[0], result) == [ids[3], ids[2], ids[1]], "result: %s" % humanreadable.hr(result)
+    # The disqualified one wasn't passed to the batch handicapper.
+    assert calls == [3], "calls: %s" % humanreadable.hr(calls)
+    assert h.pick_best(map(lambda x: (x, None,), ids), 'a message', {}) == ids[3]
+
+def test_batch_handicapper_exception_disqualifies() :
+    id_a = idlib.string_to_id('a')
+    h = MojoHandicapper()
+    def bfunc(counterparties, message_type, message_body) :
+        raise ValueError, "oops"
+    h.add_batch_handicapper(bfunc, mtypes=('a message',))
+    assert h.pick_best([(id_a, None,)], 'a message', {}) is None
+    assert h.pick_best([(id_a, None,)], 'another message', {}) == id_a
+
+def test_sort_by_preference_from_dict() :
+    id_a = idlib.string_to_id('a')
+    id_b = idlib.string_to_id('b')
+    h = MojoHandicapper()
+    def cfunc(counterparty_id, metainfo, message_type, message_body, id_a = id_a) :
+        if counterparty_id == id_a :
+            return 1.0
+        else :
+            return 0.0
+    h.add_handicapper(cfunc)
+    result = h.sort_by_preference_from_dict({id_a: 'infoa', id_b: 'infob'}, 'a message', {})
+    assert result == [(id_b, 'infob',), (id_a, 'infoa',)], "result: %s" % humanreadable.hr(result)
+    assert h.pick_best_from_dict({id_a: 'infoa', id_b: 'infob'}, 'a message', {}) == id_b
+
+def _bench_it_sort_by_preference(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    h = MojoHandicapper()
+    def bfunc(counterparties, message_type, message_body) :
+        return [1.0] * len(counterparties)
+    h.add_batch_handicapper(bfunc)
+    counterparties = map(lambda x: (idlib.string_to_id(str(x)), None,), range(n))
+    h.sort_by_preference(counterparties, 'a message', {})
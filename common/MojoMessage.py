@@ -10,14 +10,17 @@
 import string
 import types
 
+true = 1
+false = 0
+
 # pyutil modules
 from config import DEBUG_MODE
 from debugprint import debugprint
 import humanreadable
 
 # our modules
-import Cache
-from DataTypes import BadFormatError, ANY, STRING, UNIQUE_ID, checkTemplate, OptionMarker, NON_NEGATIVE_INTEGER
+import BudgetCache
+from DataTypes import BadFormatError, ANY, STRING, UNIQUE_ID, checkTemplate, compile_template, OptionMarker, NON_NEGATIVE_INTEGER
 from MojoErrors import MojoMessageError
 import idlib
 import mencode
@@ -76,9 +79,8 @@ class UnknownMessageTypeError(MojoMessageError):
 
 # We're pretty mono-threaded.  A low number is fine as most calls to MojoMessage functions will be
 # sequential calls using the same msgString.  This cache is intended to speed up the common case
-# of sequential calls to MojoMessage.getSPAM with the same msgString.
-# XXX NOTE: Cache() doesn't do well if given a maxsize and an item > maxsize bytes is inserted;
-#           don't make these size based caches
+# of sequential calls to MojoMessage.getSPAM with the same msgString.  They count against the
+# shared BudgetCache.budget, and a message too big for it is just not memoized.
 _MAX_MEMOIZE_CACHE_ITEMS = 2
 # used to memoize our mdecode(msgString) results
 global _internal_msgString_mdecode_cache
@@ -89,9 +91,9 @@ _internal_checkMsg_cache = None
 
 def init():
     global _internal_msgString_mdecode_cache 
-    _internal_msgString_mdecode_cache = Cache.CacheSingleThreaded(maxitems=_MAX_MEMOIZE_CACHE_ITEMS)
+    _internal_msgString_mdecode_cache = BudgetCache.BudgetCache('MojoMessage mdecode', maxitems=_MAX_MEMOIZE_CACHE_ITEMS)
     global _internal_checkMsg_cache
-    _internal_checkMsg_cache = Cache.CacheSingleThreaded(maxitems=_MAX_MEMOIZE_CACHE_ITEMS)
+    _internal_checkMsg_cache = BudgetCache.BudgetCache('MojoMessage checkMsg', maxitems=_MAX_MEMOIZE_CACHE_ITEMS)
 
 def shutdown():
     global _internal_msgString_mdecode_cache 
@@ -200,6 +202,54 @@ def getNonce(msgString):
     return __internal_mdecode_cache(msgString)['header'].get('nonce')
 
 
+class ParsedMessage:
+    """
+    A message which has been decoded and checked by `parse()', with all of the fields that the
+    getFoo functions above would return.
+    """
+    def __init__(self, msgString, msgdict):
+        header = msgdict['header']
+        self.msgString = msgString
+        self.msgtype = header['message type']
+        self.recipient = header.get('recipient')
+        self.nonce = header.get('nonce')
+        self.reference = header.get('reference')
+        self.metainfo = msgdict.get('metainfo')
+        self.extra_metainfo = msgdict.get('extra_metainfo')
+        self.body = msgdict.get('message body')
+
+    def __repr__(self):
+        return "<%s %s, %d bytes, %x>" % (self.__class__.__name__, self.msgtype, len(self.msgString), id(self),)
+
+def parse(msgString):
+    """
+    Decodes and checks `msgString' once and returns all of its fields together.  Use this
+    instead of a series of getFoo calls when processing an incoming message, since each getFoo
+    call has to look `msgString' up in the memoize caches again.
+
+    The results are also stored in the memoize caches so that any getFoo calls made later on
+    the same message are cheap.
+
+    @param msgString the string containing the message in canonical form
+
+    @return a ParsedMessage
+
+    @throws BadFormatError if `msgString' is badly formed or of an incompatible version of the
+        Mojo protocol
+    @throws MojoMessageError if `msgString' can't be mdecoded
+    """
+    msgdict = _internal_msgString_mdecode_cache.get(msgString)
+    if msgdict is None:
+        msgdict = __internal_mdecode_nocache(msgString)
+        _internal_msgString_mdecode_cache.insert(msgString, msgdict)
+
+    if not _internal_checkMsg_cache.get(msgString):
+        __internal_checkMsgDict(msgdict)
+        _internal_checkMsg_cache.insert(msgString, 1)
+
+    return ParsedMessage(msgString, msgdict)
+
+
 def makeInitialMessage(msgtype, msgbody, recipient_id, nonce, freshnessproof, mymetainfo=None):
     """
     @param msgtype the type of the message, human readable string
@@ -209,7 +259,7 @@ def makeInitialMessage(msgtype, msgbody, recipient_id, nonce, freshnessproof, my
     @param freshnessproof the binary hash of the most recent message that you've received
         from this counterparty, to ensure freshness
     @param mymetainfo is optional and should contain the senders most recent
-        meta info if they wish to include it with their message.
+        meta info if they wish to include it with their message.  (or a mencode.PreEncodedThing of the info)
 
     @return the canonical string representation of this Mojo message
 
@@ -247,7 +297,7 @@ def makeInitialMessage(msgtype, msgbody, recipient_id, nonce, freshnessproof, my
             # just for DEBUG_MODE.  --Zooko 2001-06-07
             msgdict = __internal_mdecode_nocache(msgString)
 
-            checkTemplate(msgdict, BASE_TEMPL)
+            _COMPILED_BASE_TEMPL.check(msgdict)
 
             __internal_checkMsgBody(msgdict)
             __internal_checkMojoVersion(msgdict)
@@ -304,7 +354,7 @@ def makeResponseMessage(msgtype, msgbody, reference, freshnessproof, mymetainfo=
             # just for DEBUG_MODE.  --Zooko 2001-06-07
             msgdict = __internal_mdecode_nocache(msgString)
 
-            checkTemplate(msgdict, BASE_TEMPL)
+            _COMPILED_BASE_TEMPL.check(msgdict)
 
             __internal_checkMsgBody(msgdict)
             __internal_checkMojoVersion(msgdict)
@@ -343,6 +393,12 @@ RESPONSE_TEMPL = {
     'metainfo': OptionMarker(ANY),
     }
 
+_COMPILED_BASE_TEMPL = compile_template(BASE_TEMPL)
+
+# a dict from message types to (template, CompiledTemplate) tuples -- see
+# `__internal_getCompiledBodyTempl()'
+_compiled_body_templs = {}
+
 def checkMessageType(msgString, requiredmsgtype):
     """
     @param msgString the string containing the message in canonical form
@@ -376,9 +432,19 @@ def __internal_checkMsg(msgString, requiredmsgtype = None):
     
     msgdict = __internal_mdecode_cache(msgString)
 
+    __internal_checkMsgDict(msgdict, requiredmsgtype)
+
+    # memoize the fact that this msgdict passed the checks
+    _internal_checkMsg_cache.insert(msgString, 1)
+
+def __internal_checkMsgDict(msgdict, requiredmsgtype = None):
+    """
+    @throws BadFormatError if `msgdict' is badly formed or of an incompatible version of the
+        Mojo protocol
+    """
     # First it has to match the basic template for all Mojo Messages.
     try:
-        checkTemplate(msgdict, BASE_TEMPL)
+        _COMPILED_BASE_TEMPL.check(msgdict)
 
         __internal_checkMsgBody(msgdict)
         __internal_checkMojoVersion(msgdict)
@@ -386,23 +452,35 @@ def __internal_checkMsg(msgString, requiredmsgtype = None):
     except (BadFormatError, TypeError), le:
         raise BadFormatError, (msgdict, requiredmsgtype, le,)
 
-    # memoize the fact that this msgdict passed the checks
-    _internal_checkMsg_cache.insert(msgString, 1)
-
 def __internal_checkMsgBody(msgdict):
     """
     @memoizable
     """
     # Either the message has a mojo header indicating failure, or it matches the template for its specific conversation type.
-    templ = OurMessages.templs.get(msgdict['header']['message type'])
+    ctempl = __internal_getCompiledBodyTempl(msgdict['header']['message type'])
 
-    if templ is None:
+    if ctempl is None:
         debugprint('NOTE: untemplated message of type %s\n', args=(msgdict['header']['message type'],), v=3, vs='MojoMessage')
         return
-    checkTemplate(msgdict.get('message body'), {
+    ctempl.check(msgdict.get('message body'))
+
+def __internal_getCompiledBodyTempl(msgtype):
+    """
+    @returns the CompiledTemplate for the bodies of messages of type `msgtype', or `None' if
+        `OurMessages.templs' has no template for that type
+    """
+    templ = OurMessages.templs.get(msgtype)
+    if templ is None:
+        return None
+    compiled = _compiled_body_templs.get(msgtype)
+    # Recompile if somebody has replaced the template since we compiled it.
+    if (compiled is None) or (compiled[0] is not templ):
+        compiled = (templ, compile_template({
             'mojo message': OptionMarker(templ),
             'mojo header': OptionMarker(OurMessages.MOJO_HEADER_TEMPL)
-            })
+            }),)
+        _compiled_body_templs[msgtype] = compiled
+    return compiled[1]
 
 def __internal_checkMojoVersion(msgdict, minVer=MIN_MOJO_VER, nextVer=NEXT_MOJO_VER):
     """
@@ -436,6 +514,114 @@ def __internal_getMojoVersion(msgdict):
     return verNum
 
 
+def _help_make_test_messages():
+    recipient_id = idlib.new_random_uniq()
+    initial = makeInitialMessage('hello', {'mojo message': {'connection strategies': [], 'sequence num': 1}}, recipient_id, idlib.new_random_uniq(), freshnessproof=None, mymetainfo={'connection strategies': []})
+    response = makeResponseMessage('hello response', {'mojo message': {'result': "success"}}, idlib.make_id(initial, 'msg'), freshnessproof=None, extrametainfo=[{'spam': 'eggs'}])
+    return (initial, response,)
+
+def test_parse_agrees_with_getters():
+    init()
+    try:
+        for msg in _help_make_test_messages():
+            parsedmsg = parse(msg)
+            assert parsedmsg.msgtype == getType(msg)
+            assert parsedmsg.recipient == getRecipient(msg)
+            assert parsedmsg.nonce == getNonce(msg)
+            assert parsedmsg.reference == getReference(msg)
+            assert parsedmsg.metainfo == getSendersMetaInfo(msg)
+            assert parsedmsg.extra_metainfo == getExtraMetaInfo(msg)
+            assert parsedmsg.body == getBody(msg)
+    finally:
+        shutdown()
+
+def test_preencoded_metainfo_is_spliced_in():
+    metainfo = {'connection strategies': [], 'sequence num': 3}
+    reference = idlib.new_random_uniq()
+    msg = makeResponseMessage('hello response', {'mojo message': {'result': "success"}}, reference, freshnessproof=None, mymetainfo=metainfo)
+    assert makeResponseMessage('hello response', {'mojo message': {'result': "success"}}, reference, freshnessproof=None, mymetainfo=mencode.PreEncodedThing(metainfo)) == msg
+
+def test_parse_rejects_bad_version():
+    init()
+    try:
+        msg = mencode.mencode({'header': {'protocol': 'Mojo v' + str(NEXT_MOJO_VER), 'message type': 'hello'}, 'message body': {'mojo message': {'connection strategies': [], 'sequence num': 1}}})
+        try:
+            parse(msg)
+        except IncompatibleVersionError:
+            pass
+        else:
+            assert false, "parse() should have rejected a message of the next version"
+    finally:
+        shutdown()
+
+def _profile_test_parse_speed():
+    import mojoutil
+    profit = mojoutil._dont_enable_if_you_want_speed_profit
+    profit(_real_test_parse_speed)
+
+def _real_test_parse_speed():
+    """
+    Compares `parse()' with the series of getFoo calls that `Conversation' used to make,
+    on the messages saved in $HOME/tmp/messages by the DEBUG code in
+    `Conversation._process()'.
+    """
+    import os
+    import time
+    msgpath = os.path.join(os.environ.get('HOME'), 'tmp/messages')
+    filenamelist = os.listdir(msgpath)
+    filenamelist.sort()
+    encoded_messages = []
+    for name in filenamelist:
+        encoded_messages.append( open(os.path.join(msgpath, name), 'rb').read() )
+    print 'read in %d messages' % len(encoded_messages)
+
+    init()
+    try:
+        print 'processing using the getFoo functions...'
+        t1 = time.time()
+        for m in encoded_messages:
+            try:
+                getReference(m)
+                getNonce(m)
+                getRecipient(m)
+                getSendersMetaInfo(m)
+                getExtraMetaInfo(m)
+                getType(m)
+                getType(m)
+                getBody(m)
+            except:
+                print '!',
+        t2 = time.time()
+        print 'done.  total time: %3.3f' % (t2 - t1,)
+
+        # Empty the memoize caches so that `parse()' has to decode everything too.
+        shutdown()
+        init()
+
+        print 'processing using parse()...'
+        t1 = time.time()
+        for m in encoded_messages:
+            try:
+                parse(m)
+            except:
+                print '!',
+        t2 = time.time()
+        print 'done.  total time: %3.3f' % (t2 - t1,)
+    finally:
+        shutdown()
+
+
+def _compile_known_templates():
+    """
+    Compiles the templates for all of the message types that we know about now.  Templates
+    which are added to `OurMessages.templs' later get compiled the first time they are used.
+    """
+    for msgtype in OurMessages.templs.keys():
+        __internal_getCompiledBodyTempl(msgtype)
+
+_compile_known_templates()
+
+
 mojo_test_flag = 1
 
 
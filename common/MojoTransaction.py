@@ -27,16 +27,19 @@ import pickle
 # pyutil modules
 from compat import setdefault
 from config import DEBUG_MODE
-from debugprint import debugprint
+from debugprint import debugprint, debugstream
 
 # Mojo Nation modules
-import Cache
+import AdmissionController
+import BudgetCache
 from CommHints import HINT_EXPECT_RESPONSE, HINT_EXPECT_MORE_TRANSACTIONS, HINT_EXPECT_NO_MORE_COMMS, HINT_EXPECT_TO_RESPOND, HINT_THIS_IS_A_RESPONSE, HINT_NO_HINT
+import CommHints
 import CommStrat
 import CommsError
 import Conversation
 import CryptoCommsHandler
 import DoQ
+import LatencySketch
 import ListenerManager
 true = 1
 false = 0
@@ -44,8 +47,11 @@ from MojoHandicapper import MojoHandicapper
 import MojoKey
 import MojoMessage
 import MojoTransaction
+import PKOpPool
 import RelayListener
+import ResponseCache
 import TCPCommsHandler
+import TimerWheel
 from UnreliableHandicapper import UnreliableHandicapper
 import confutils
 from confutils import confman
@@ -127,6 +133,257 @@ class Widget:
         return idlib.make_id_from_uniq(uniq=self._firstmsgId, thingtype='conversation')
         
 
+class PendingTransaction:
+    """
+    The outcome of a transaction started with `MojoTransactionManager.request()', which will
+    be filled in when the transaction completes or fails.
+
+    Code on the DoQ gets at the outcome with `add_callback()'.  Code on any other thread can
+    instead just block in `wait()' -- for example a thread that has several transactions
+    going at once can start them all and then wait for each of them in turn, instead of
+    threading the state through nested outcome funcs.
+    """
+    def __init__(self):
+        self.widget = None
+        self.outcome = None
+        self.failure_reason = None
+        self._done = false
+        self._event = threading.Event()
+        self._callbacks = []
+
+    def __repr__(self):
+        if not self._done:
+            return "<%s pending, %x>" % (self.__class__.__name__, id(self),)
+        return "<%s done, failure_reason: %s, %x>" % (self.__class__.__name__, hr(self.failure_reason), id(self),)
+
+    def is_done(self):
+        return self._done
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the transaction is done or `timeout' seconds have passed.
+
+        @returns `true' if and only if the transaction is done
+
+        @precondition This method must not be called on the DoQ.: not DoQ.doq.is_currently_doq()
+        """
+        assert not DoQ.doq.is_currently_doq(), "precondition: This method must not be called on the DoQ."
+
+        self._event.wait(timeout)
+        return self._done
+
+    def add_callback(self, func):
+        """
+        Arranges for `func(self)' to be called once the transaction is done.  If it is already
+        done then `func(self)' is called right away.
+
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        if self._done:
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def _outcome_func(self, widget=None, outcome=None, failure_reason=None, notes=None):
+        """
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        if self._done:
+            return
+        self.widget = widget
+        self.outcome = outcome
+        self.failure_reason = failure_reason
+        self._done = true
+        self._event.set()
+        callbacks = self._callbacks
+        self._callbacks = []
+        for func in callbacks:
+            try:
+                func(self)
+            except:
+                debugprint("%s: exception in callback %s:\n", args=(self, func,), v=0, vs="ERROR")
+                traceback.print_exc(file=debugstream)
+
+class _ConversationGroup:
+    """
+    Tracks the conversations started by one `MojoTransactionManager.initiate_many()'.
+    """
+    def __init__(self, mtm, num, need, outcome_func):
+        self._mtm = mtm
+        self._num = num
+        self._need = need
+        self._outcome_func = outcome_func
+        self._msgIds = {} # maps index to first message id, for the ones that are still outstanding
+        self._numstarted = 0
+        self._numfinished = 0
+        self.successes = [] # (widget, outcome,)
+        self.failures = [] # (widget, failure_reason,)
+        self._complete = false
+
+    def __repr__(self):
+        return "<%s of %d, need: %d, successes: %d, failures: %d, %x>" % (self.__class__.__name__, self._num, self._need, len(self.successes), len(self.failures), id(self),)
+
+    def is_complete(self):
+        return self._complete
+
+    def _started(self, i, msgId):
+        """
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        self._numstarted = self._numstarted + 1
+        if self._complete:
+            # Too late -- finished while it was being started.
+            self._mtm._cm.abandon_conversation(msgId)
+        elif not self._msgIds.has_key(i):
+            # (It won't be there if it already failed while being started.)
+            self._msgIds[i] = msgId
+        self._maybe_complete()
+
+    def _member_outcome_func(self, i, widget=None, outcome=None, failure_reason=None):
+        """
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        if self._complete:
+            return
+        # Mark it as finished even if `_started()' hasn't been called for it yet.
+        self._msgIds[i] = None
+        self._numfinished = self._numfinished + 1
+        if failure_reason is None:
+            self.successes.append((widget, outcome,))
+        else:
+            self.failures.append((widget, failure_reason,))
+        self._maybe_complete()
+
+    def _maybe_complete(self):
+        if self._complete:
+            return
+        if not ((len(self.successes) >= self._need) or ((self._numstarted == self._num) and (self._numfinished == self._num))):
+            return
+        self._complete = true
+        # Forget the stragglers.
+        for msgId in self._msgIds.values():
+            if msgId is not None:
+                self._mtm._cm.abandon_conversation(msgId)
+        self._msgIds = {}
+        self._outcome_func(successes=self.successes, failures=self.failures)
+
+class _HedgedConversation:
+    """
+    Tracks the conversations started by one `MojoTransactionManager.initiate_hedged()'.
+    """
+    def __init__(self, mtm, counterparty_ids, conversationtype, firstmsgbody, outcome_func, timeout, hint):
+        self._mtm = mtm
+        self._counterparty_ids = counterparty_ids
+        self._conversationtype = conversationtype
+        self._firstmsgbody = firstmsgbody
+        self._outcome_func = outcome_func
+        self._timeout = timeout
+        self._hint = hint
+        self._msgIds = {} # maps index to first message id, for the ones that are still outstanding
+        self._numstarted = 0
+        self._numhedges = 0
+        self._hedgetimer = None # handle of the pending hedge timer on the TimerWheel, if any
+        self._lastfailure = None
+        self._complete = false
+
+    def __repr__(self):
+        return "<%s %s, started: %d of %d, hedges: %d, %x>" % (self.__class__.__name__, self._conversationtype, self._numstarted, len(self._counterparty_ids), self._numhedges, id(self),)
+
+    def _start_next(self):
+        """
+        Starts a conversation with the next-best counterparty and, if there is one after that,
+        sets a hedge timer for when this one is slower than usual.
+
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        @precondition There must be a counterparty left to start a conversation with.: self._numstarted < len(self._counterparty_ids)
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+        assert self._numstarted < len(self._counterparty_ids), "precondition: There must be a counterparty left to start a conversation with."
+
+        i = self._numstarted
+        self._numstarted = i + 1
+        self._cancel_hedge_timer()
+        counterparty_id = self._counterparty_ids[i]
+        member_outcome_func = lambda widget=None, outcome=None, failure_reason=None, self=self, i=i: self._member_outcome_func(i, widget=widget, outcome=outcome, failure_reason=failure_reason)
+        msgId = self._mtm._initiate(counterparty_id, self._conversationtype, self._firstmsgbody, member_outcome_func, timeout=self._timeout, use_dynamic_timeout="never", hint=self._hint)
+        if self._complete:
+            # It finished while this one was being started.
+            self._mtm._cm.abandon_conversation(msgId)
+            return
+        if not self._msgIds.has_key(i):
+            # (It will already be there, as `None', if it failed while being started.)
+            self._msgIds[i] = msgId
+        if (self._numstarted < len(self._counterparty_ids)) and (self._msgIds[i] is not None):
+            delay = self._mtm._get_hedge_delay(counterparty_id, self._conversationtype)
+            if delay is None:
+                # No idea how long it should take, so don't hedge until it has timed out.
+                delay = self._timeout
+            delay = min(delay, self._timeout)
+            self._hedgetimer = TimerWheel.wheel.schedule(self._hedge_timer, delay=delay)
+
+    def _cancel_hedge_timer(self):
+        if self._hedgetimer is not None:
+            TimerWheel.wheel.cancel(self._hedgetimer)
+            self._hedgetimer = None
+
+    def _hedge_timer(self):
+        self._hedgetimer = None
+        if self._complete:
+            return
+        if not self._mtm._use_hedge_budget():
+            debugprint("MTM: not hedging %s because the hedging budget is used up\n", args=(self,), v=5, vs="Conversation")
+            return
+        debugprint("MTM: hedging %s\n", args=(self,), v=5, vs="Conversation")
+        self._numhedges = self._numhedges + 1
+        self._start_next()
+
+    def _member_outcome_func(self, i, widget=None, outcome=None, failure_reason=None):
+        """
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        if self._complete:
+            return
+        # Mark it as finished even if `_start_next()' hasn't finished starting it yet.
+        self._msgIds[i] = None
+        if failure_reason is None:
+            self._finish(i, widget=widget, outcome=outcome)
+            return
+        self._lastfailure = (widget, failure_reason,)
+        if filter(lambda x: x is not None, self._msgIds.values()):
+            # Wait for the ones that are still outstanding.
+            return
+        if self._numstarted < len(self._counterparty_ids):
+            # Fail over to the next one right away.  (This is not a hedge.)
+            self._start_next()
+        else:
+            (widget, failure_reason,) = self._lastfailure
+            self._finish(i, widget=widget, failure_reason=failure_reason)
+
+    def _finish(self, i, widget=None, outcome=None, failure_reason=None):
+        self._complete = true
+        self._cancel_hedge_timer()
+        if self._numhedges > 0:
+            if (failure_reason is None) and (i > 0):
+                self._mtm._hedge_stats['won'] = self._mtm._hedge_stats['won'] + 1
+            else:
+                self._mtm._hedge_stats['lost'] = self._mtm._hedge_stats['lost'] + 1
+        # Forget the stragglers.
+        for msgId in self._msgIds.values():
+            if msgId is not None:
+                self._mtm._cm.abandon_conversation(msgId)
+        self._msgIds = {}
+        self._outcome_func(widget=widget, outcome=outcome, failure_reason=failure_reason)
+
 class Error(exceptions.StandardError): pass
 class FailureError(Error): pass # FailureError is for failures in the conversation/transaction layer
 class PricerError(Error): pass
@@ -210,8 +467,11 @@ class MojoTransactionManager:
         self._handicapper=MojoHandicapper()
 
         self._allow_send_metainfo = allow_send_metainfo  # controls if we allow adding our metainfo to outgoing messages on occasion
-        self.__counterparties_metainfo_sent_to_map = Cache.StatsCacheSingleThreaded(maxitems=10000, autoexpireinterval=600, autoexpireparams={'maxage': 1800})
+        # All of the BudgetCaches in this process share one budget of bytes.
+        BudgetCache.budget.set_maxbytes(mojoutil.intorlongpopL(confman.get('CACHE_MEMORY_BUDGET', "16777216")))
+        self.__counterparties_metainfo_sent_to_map = BudgetCache.BudgetCache('metainfo sent to', maxitems=10000, ttl=1800)
         self.__need_sequence_update = true  # determines if we update our sequence number when generating a hello
+        self.__preencoded_hello = None  # (sequence num, hello body dict, mencode.PreEncodedThing of the hello body) -- see `_get_our_preencoded_hello_msgbody()'
         self._lasthellotime=0 # to prevent sending redundant hellos too often
         self._contactinfochangedtime = 0
 
@@ -220,7 +480,22 @@ class MojoTransactionManager:
         # a map of counterpartyids -> the last time we tried sending a token to them in order to stay paid up
         # (used as a quick 'works in most all cases' hack to prevent sending several tokens to someone at once
         # to stay paid up)
-        self._stay_paid_up_time_map = Cache.StatsCacheSingleThreaded(maxitems=5000, autoexpireinterval=300, autoexpireparams={'maxage': 60})
+        self._stay_paid_up_time_map = BudgetCache.BudgetCache('stay paid up times', maxitems=5000, ttl=60)
+
+        # maps (counterparty_id, conversationtype, sha1 of mencoded firstmsgbody,) to the list of
+        # outcome funcs waiting for that outstanding conversation -- see `initiate()''s `coalesce'
+        self._coalesced_outcome_funcs = {}
+        self._coalesce_stats = {'initiated': 0, 'coalesced': 0}
+        self._hedge_stats = {'conversations': 0, 'hedges': 0, 'over budget': 0, 'won': 0, 'lost': 0}
+
+        # maps message type to ResponseCache.ResponseCache -- see `set_response_cache()'
+        self._response_caches = {}
+
+        # for the handler funcs which run on worker threads -- see `add_handler_funcs()'
+        self._handlerpool = None # a PKOpPool.PKOpPool, made when it is first needed
+        self._pooledhandlers = {} # maps message type to the most of them that may run at once
+        self._pooledhandlerqueues = {} # maps message type to a list of (enqueuetime, serverfunc, widget, msgbody,) waiting to run
+        self._pooledhandlerstats = {} # maps message type to a dict of statistics
 
         if handler_funcs:
             self._handler_funcs=copy.copy(handler_funcs)
@@ -239,9 +514,8 @@ class MojoTransactionManager:
 
         self._dbdir=os.path.join(dbparentdir, idlib.to_mojosixbit(self._mesgen.get_id()))
 
-        self.response_times = {}
-        self._responsetimesold = {}
-        self._load_response_times()
+        self._latencysketches = {} # maps conversationtype, and (counterparty_id, conversationtype,), to a LatencySketch
+        self._load_latency_sketches()
         self._cm=Conversation.ConversationManager(self)
         # If `listenport' is None, we can choose any port we like.  We'll choose one determined by the first few bits
         # of our pubkeyid, and make sure it is higher than 1025 and lower than 32767.
@@ -257,6 +531,14 @@ class MojoTransactionManager:
 
         DoQ.doq.add_task(self._periodic_cleanup, delay=150)
 
+        self._admissioncontroller = AdmissionController.AdmissionController(maxinflight=mojoutil.intorlongpopL(confman.get('MAX_INCOMING_REQUESTS_IN_FLIGHT', "256")), maxqueuedelay=float(confman.get('MAX_QUEUE_DELAY', "2.0")))
+        for msgtype in ('hello', 'goodbye', 'lookup contact info', 'list relay servers', 'list relay servers v2',):
+            self._admissioncontroller.set_priority(msgtype, AdmissionController.PRIORITY_CONTROL)
+        for msgtype in ('put blob', 'request blob',):
+            self._admissioncontroller.set_priority(msgtype, AdmissionController.PRIORITY_BULK)
+        self._admissioncontroller.start()
+        self._retryafter = {} # maps counterparty_id to the time before which it asked us not to send it any more requests
+
         self._keeper=counterparties.CounterpartyObjectKeeper(dbparentdir, local_id=self.get_id(), recoverdb=true)
         # IMPORTANT NOTE:  handicappers are ordered as some of them are in-progress multipliers (such as
         # the performance handicappers which should come after price so that they can scale independently
@@ -277,12 +559,20 @@ class MojoTransactionManager:
         # significantly handicap counterparties that haven't been responding to their messages recently at all or fast enough
         self.get_handicapper().add_handicapper(self._cm.pending_responses_handicapper)
 
+        # for all msgtypes
+        #  @returns 1000 if counterparty shed one of our requests and asked us to wait, until it has been that long
+        self.get_handicapper().add_handicapper(self.overloaded_handicapper)
+
+        # for all msgtypes
+        #  @returns BASE_LATENCY_HANDICAP_MULT times the counterparty's 95th percentile response time in seconds for this msgtype
+        self.get_handicapper().add_handicapper(self.latency_handicapper)
+
         # this is used to prevent >1 update from occurring at the same time
         self.__handler_funcs_and_services_dicts_update_lock=threading.Lock()
 
         self.set_pt(pt)
 
-        self._responsetimesdirty = false # `true' iff the response times stats have been changed and need to be saved to disk;  When you change this flag from `false' to `true', you schedule a save task for 10 minutes later.  When the save task goes off it changes the flag from `true' to `false'.
+        self._latencysketchesdirty = false # `true' iff the latency sketches have been changed and need to be saved to disk;  When you change this flag from `false' to `true', you schedule a save task for 10 minutes later.  When the save task goes off it changes the flag from `true' to `false'.
 
     def start_listening(self):
         self._listenermanager.start_listening(inmsg_handler_func=self._cm.handle_raw_message)
@@ -318,6 +608,7 @@ class MojoTransactionManager:
         self.__handler_funcs_and_services_dicts_update_lock.acquire()
         try:
             self._handler_funcs={}
+            self._pooledhandlers={}
         finally:
             self.__handler_funcs_and_services_dicts_update_lock.release()
             pass
@@ -344,49 +635,209 @@ class MojoTransactionManager:
             return
         self._shuttingdownflag = true
         debugprint("%s.shutdown() entering\n", args=(self,))
+        self._admissioncontroller.stop()
+        if self._handlerpool is not None:
+            self._handlerpool.shutdown()
         self.clear_all_announced_services()
         self.clear_all_handler_funcs()
         self._cm.shutdown()
         self._ch.stop_listening()
         self._ch.shutdown()
         self._shutdown_members()
-        self._save_response_times()
+        self._save_latency_sketches()
         debugprint("%s.shutdown() exiting\n", args=(self,))
 
-    def _load_response_times(self):
+    def _load_latency_sketches(self):
         try:
-            f = open(os.path.join(self._dbdir, "response_times"), 'r')
+            f = open(os.path.join(self._dbdir, "latency_sketches"), 'r')
             s = f.read()
             f.close()
-            self.response_times = pickle.loads(s)
+            self._latencysketches = pickle.loads(s)
         except:
-            debugprint("Creating a new global response_times dict.\n", vs="MojoTransaction", v=2)
-            self.response_times = {}
-        self._responsetimesdirty = false
+            debugprint("Creating a new latency sketches dict.\n", vs="MojoTransaction", v=2)
+            self._latencysketches = {}
+        self._latencysketchesdirty = false
   
-    def _initiate_save_response_times_task_idempotent(self):
+    def _initiate_save_latency_sketches_task_idempotent(self):
         MIN_DELAY = 10 * 60
         # Save it to disk, but not more often than once every 10 minutes.
-        if not self._responsetimesdirty:
-            DoQ.doq.add_task(self._save_response_times, delay=MIN_DELAY)
-            self._responsetimesdirty = true
-
-    def _save_response_times(self):
-        debugprint("Saving global response_times dict.\n", vs="MojoTransaction", v=2)
-        f = open(os.path.join(self._dbdir, "response_times"), 'w')
-        f.write(pickle.dumps(self.response_times))
+        if not self._latencysketchesdirty:
+            DoQ.doq.add_task(self._save_latency_sketches, delay=MIN_DELAY)
+            self._latencysketchesdirty = true
+
+    def _save_latency_sketches(self):
+        debugprint("Saving latency sketches dict.\n", vs="MojoTransaction", v=2)
+        f = open(os.path.join(self._dbdir, "latency_sketches"), 'w')
+        f.write(pickle.dumps(self._latencysketches))
         f.close()
-        self._responsetimesdirty = false
+        self._latencysketchesdirty = false
+
+    def get_latency_quantile(self, counterparty_id, conversationtype, q, MIN_SAMPLES=10):
+        """
+        @param counterparty_id the counterparty, or `None' for everyone
+        @param q a fraction between 0 and 1
+
+        @returns the response time in seconds that the fraction `q' of `conversationtype'
+            conversations with `counterparty_id' have been answered within;  If there aren't
+            at least `MIN_SAMPLES' of those, then the one for all counterparties, or `None'
+            if there aren't at least `MIN_SAMPLES' of those either
+        """
+        if counterparty_id is not None:
+            sketch = self._latencysketches.get((idlib.canonicalize(counterparty_id, "broker"), conversationtype,))
+            if (sketch is not None) and (len(sketch) >= MIN_SAMPLES):
+                return sketch.quantile(q)
+        sketch = self._latencysketches.get(conversationtype)
+        if (sketch is None) or (len(sketch) < MIN_SAMPLES):
+            return None
+        return sketch.quantile(q)
+
+    def latency_handicapper(self, counterparty_id, metainfo, message_type, message_body, MIN_SAMPLES=10):
+        """
+        Handicaps counterparties in proportion to how slowly they have been answering messages
+        of this type, by the 95th percentile of their response times.  Counterparties that we
+        don't know enough about yet are not handicapped.
+        """
+        sketch = self._latencysketches.get((idlib.canonicalize(counterparty_id, "broker"), message_type,))
+        if (sketch is None) or (len(sketch) < MIN_SAMPLES):
+            return 0
+        return sketch.quantile(0.95) * float(confman['COUNTERPARTY'].get('BASE_LATENCY_HANDICAP_MULT', "500"))
      
-    def add_handler_funcs(self, updated_handler_funcs_dict):
-        """Add more handler_funcs to this MTM or redefine current ones."""
+    def add_handler_funcs(self, updated_handler_funcs_dict, executor=None, maxconcurrent=1):
+        """
+        Add more handler_funcs to this MTM or redefine current ones.
+
+        @param executor `None' to call the handler funcs on the DoQ, or "threads" to call them
+            on a pool of worker threads so that slow ones (hashing, parsing XML) don't hold up
+            everything else;  When a pooled handler func returns, its result is sent back on
+            the DoQ just as if it had been called there.  If a pooled handler func raises an
+            exception, a failure response is sent.  Pooled handler funcs must not touch
+            anything which is only safe to use on the DoQ.  (If the pool's queue is full, the
+            handler func is called on the DoQ after all.)
+        @param maxconcurrent for pooled handler funcs, the most of each message type that may
+            be running at once;  The rest wait their turn.  See `get_pooled_handler_stats()'.
+
+        @precondition `executor' must be `None' or "threads".: executor in (None, "threads",): "executor: %s" % hr(executor)
+        @precondition `maxconcurrent' must be positive.: maxconcurrent > 0: "maxconcurrent: %s" % hr(maxconcurrent)
+        """
+        assert executor in (None, "threads",), "precondition: `executor' must be `None' or \"threads\"." + " -- " + "executor: %s" % hr(executor)
+        assert maxconcurrent > 0, "precondition: `maxconcurrent' must be positive." + " -- " + "maxconcurrent: %s" % hr(maxconcurrent)
+
         self.__handler_funcs_and_services_dicts_update_lock.acquire()
         try:
+            if (executor == "threads") and (self._handlerpool is None):
+                numthreads = mojoutil.intorlongpopL(confman.get('HANDLER_POOL_THREADS', "4"))
+                self._handlerpool = PKOpPool.PKOpPool(numthreads)
             self._handler_funcs.update(updated_handler_funcs_dict)
+            for msgtype in updated_handler_funcs_dict.keys():
+                if executor == "threads":
+                    self._pooledhandlers[msgtype] = maxconcurrent
+                    if not self._pooledhandlerstats.has_key(msgtype):
+                        self._pooledhandlerstats[msgtype] = {'running': 0, 'completed': 0, 'failed': 0, 'ran on the DoQ': 0, 'total wait': 0.0, 'max wait': 0.0}
+                elif self._pooledhandlers.has_key(msgtype):
+                    del self._pooledhandlers[msgtype]
+                # The new handler func might answer differently.  (ResponseCaches must only be
+                # touched on the DoQ.)
+                if self._response_caches.has_key(msgtype):
+                    if DoQ.doq.is_currently_doq():
+                        self._response_caches[msgtype].invalidate()
+                    else:
+                        DoQ.doq.add_task(self._response_caches[msgtype].invalidate)
         finally:
             self.__handler_funcs_and_services_dicts_update_lock.release()
         self._hello_sequence_num_needs_increasing()
 
+    def set_response_cache(self, msgtype, ttl=60, maxbytes=2**20):
+        """
+        Declares that the handler func for `msgtype' is idempotent: that for a given message
+        body it will give the same response (to anyone) for at least `ttl' seconds, and that
+        calling it has no side-effects that matter.  Then the responses it returns are
+        remembered, and when an identical message body arrives within `ttl' seconds the
+        remembered response is sent back without calling the handler func.  (Handler funcs
+        that return `NO_RESPONSE' or `ASYNC_RESPONSE' are called every time.)
+
+        When the data that the responses are computed from changes before `ttl' is up, call
+        `invalidate_cached_responses()'.
+
+        @param ttl the number of seconds to remember each response
+        @param maxbytes the most bytes of (encoded) responses to remember for this message type;
+            they also count against CACHE_MEMORY_BUDGET (see `get_cache_stats()')
+        """
+        self.__handler_funcs_and_services_dicts_update_lock.acquire()
+        try:
+            self._response_caches[msgtype] = ResponseCache.ResponseCache(ttl=ttl, maxbytes=maxbytes, name="%s responses" % msgtype)
+        finally:
+            self.__handler_funcs_and_services_dicts_update_lock.release()
+
+    def remove_response_cache(self, msgtype):
+        """
+        Forgets the cached responses for `msgtype' and stops caching them.
+        """
+        self.__handler_funcs_and_services_dicts_update_lock.acquire()
+        try:
+            if self._response_caches.has_key(msgtype):
+                del self._response_caches[msgtype]
+        finally:
+            self.__handler_funcs_and_services_dicts_update_lock.release()
+
+    def invalidate_cached_responses(self, msgtype, msgbody=None):
+        """
+        Forgets the cached response to `msgbody' (the "mojo message" part of an incoming
+        `msgtype' message), or all of the cached responses for `msgtype' if `msgbody' is
+        `None'.
+
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        rc = self._response_caches.get(msgtype)
+        if rc is None:
+            return
+        if msgbody is None:
+            rc.invalidate()
+        else:
+            rc.invalidate(ResponseCache.make_key(msgbody))
+
+    def get_response_cache_stats(self):
+        """
+        @returns a dict mapping each message type that has a response cache to a dict of its
+            hits, misses, and the number and bytes of the responses it holds
+        """
+        result = {}
+        for (msgtype, rc,) in self._response_caches.items():
+            result[msgtype] = rc.get_stats()
+        return result
+
+    def set_shedding_priority(self, msgtype, priority):
+        """
+        When we are overloaded, incoming requests of type `msgtype' are shed (answered at once
+        with an "overloaded" failure, without calling the handler func) in order of `priority':
+        AdmissionController.PRIORITY_BULK first and AdmissionController.PRIORITY_CONTROL last.
+        Types whose priority isn't set are PRIORITY_NORMAL, unless their handler funcs are
+        expensive, in which case they are PRIORITY_BULK.
+        """
+        self._admissioncontroller.set_priority(msgtype, priority)
+
+    def get_admission_stats(self):
+        """
+        @returns a dict of the number of incoming requests admitted and shed (in total and by
+            message type), and the current estimate of how late tasks on the DoQ are running
+        """
+        return self._admissioncontroller.get_stats()
+
+    def overloaded_handicapper(self, counterparty_id, metainfo, message_type, message_body):
+        """
+        Handicaps counterparties which have recently shed one of our requests, until the time
+        they asked us to wait has passed.
+        """
+        counterparty_id = idlib.canonicalize(counterparty_id, "broker")
+        retryafter = self._retryafter.get(counterparty_id)
+        if retryafter is None:
+            return 0
+        if retryafter <= time.time():
+            del self._retryafter[counterparty_id]
+            return 0
+        return 1000
+
     def add_announced_services(self, service_dict_list):
         """
         Add more announced services to our list of servers we run.
@@ -415,6 +866,10 @@ class MojoTransactionManager:
                 if self._handler_funcs.has_key(msgtype):
                     del self._handler_funcs[msgtype]
                     self._hello_sequence_num_needs_increasing()
+                if self._pooledhandlers.has_key(msgtype):
+                    del self._pooledhandlers[msgtype]
+                if self._response_caches.has_key(msgtype):
+                    del self._response_caches[msgtype]
         finally:
             self.__handler_funcs_and_services_dicts_update_lock.release()
 
@@ -445,6 +900,7 @@ class MojoTransactionManager:
         # debugprint("xxxxxxx %s._hello_sequence_num_needs_increasing()\n", args=(self,))
         if not self.__need_sequence_update:
             self.__need_sequence_update = true
+        self.__preencoded_hello = None
 
     def _get_our_hello_msgbody(self):
         """
@@ -471,6 +927,20 @@ class MojoTransactionManager:
 
         return hello_body
 
+    def _get_our_preencoded_hello_msgbody(self):
+        """
+        Our metainfo goes into the first message that we send to each counterparty, so this
+        keeps it mencoded, and encodes it again only when our hello sequence number changes.
+        (Anything that changes our hello body also increases the sequence number.)
+
+        @returns a tuple of (hello body dict, mencode.PreEncodedThing of the hello body)
+        """
+        hello_body = self._get_our_hello_msgbody()
+        seqnum = hello_body['sequence num']
+        if (self.__preencoded_hello is None) or (self.__preencoded_hello[0] != seqnum):
+            self.__preencoded_hello = (seqnum, hello_body, mencode.PreEncodedThing(hello_body),)
+        return self.__preencoded_hello[1:]
+
     def get_hello_sequence_num(self, timer=timeutil.timer):
         """
         Get our current hello sequence number, incrementing it and
@@ -490,7 +960,7 @@ class MojoTransactionManager:
             confman.dict[seqconfkey][asciiid] = strpopL(intorlongpopL(confman.dict[seqconfkey][asciiid]) + 1)
             needtosave = true
             # wipe the cache of who we've sent metainfo to since it is now false as our metainfo has been updated
-            self.__counterparties_metainfo_sent_to_map.expire(maxage=0)
+            self.__counterparties_metainfo_sent_to_map.empty()
         if needtosave:
             self._contactinfochangedtime = timer.time()
             # save the current sequence number in the config file so that we never lower it
@@ -596,7 +1066,7 @@ class MojoTransactionManager:
         # (or again when it has been updated; this map is emptied when our metainfo changes)
         mymetainfo = None
         if self._allow_send_metainfo and not self.__counterparties_metainfo_sent_to_map.has_key(counterparty_id):
-            mymetainfo = self._get_our_hello_msgbody()
+            mymetainfo = self._get_our_preencoded_hello_msgbody()[1]
             self.__counterparties_metainfo_sent_to_map[counterparty_id] = None
 
         body = {}
@@ -635,13 +1105,31 @@ class MojoTransactionManager:
             # TODO send an advisory message to counterparty_id containing our metainfo if we haven't sent one recently (prevent DoS)
             return None
 
-        widget=Widget(counterparty_id, firstmsgId=firstmsgId)
+        rc = self._response_caches.get(msgtype)
+        if rc is not None:
+            rckey = ResponseCache.make_key(msgbody['mojo message'])
+            cached = rc.get(rckey)
+            if cached is not None:
+                (preencodedresult, hint,) = cached
+                self.respond_with(firstmsgId, preencodedresult, hint=hint)
+                return None
 
-        mojomessagedict=msgbody['mojo message']
+        retryafter = self._admissioncontroller.admit(msgtype, len(self._cm._map_inmsgid_to_info))
+        if retryafter is not None:
+            # We're overloaded, so tell them now rather than making them wait for a timeout.
+            self.respond_with(firstmsgId, None, mojoheader={'result': "failure", 'reason': "overloaded", 'retry after': retryafter})
+            return None
 
         widget = Widget(counterparty_id, firstmsgId)
+
+        if self._pooledhandlers.has_key(msgtype):
+            DoQ.doq.add_task(self._enqueue_pooled_handler, args=(msgtype, serverfunc, widget, msgbody['mojo message'],))
+            return MojoTransaction.ASYNC_RESPONSE
+
         # Okay, now invoke the server func:
+        starttime = time.time()
         result = serverfunc(widget, msgbody['mojo message'])
+        self._admissioncontroller.record_cost(msgtype, time.time() - starttime)
 
         if result is MojoTransaction.NO_RESPONSE:
             self._cm.drop_request_state(firstmsgId)
@@ -651,15 +1139,147 @@ class MojoTransactionManager:
             return MojoTransaction.ASYNC_RESPONSE
 
         if (type(result) in (types.TupleType, types.ListType,)) and (len(result) == 2) and Conversation.is_mojo_message(result[0]) and CommHints.is_hint(result[1]):
-            result = result[0]
             hint = result[1]
+            result = result[0]
         else:
             hint = HINT_NO_HINT
 
+        if (rc is not None) and (result is not None):
+            result = mencode.PreEncodedThing(result)
+            rc.put(rckey, result, hint)
+
         self.respond_with(firstmsgId, result, hint=hint)
         return None
 
-    def initiate(self, counterparty_id, conversationtype, firstmsgbody, outcome_func=None, timeout=300, notes = None, post_timeout_outcome_func=None, use_dynamic_timeout="iff there is a post_timeout_outcome_func", commstratseqno=None, hint=HINT_NO_HINT):
+    def _enqueue_pooled_handler(self, msgtype, serverfunc, widget, msgbody):
+        """
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        setdefault(self._pooledhandlerqueues, msgtype, []).append((time.time(), serverfunc, widget, msgbody,))
+        self._start_pooled_handlers(msgtype)
+
+    def _start_pooled_handlers(self, msgtype):
+        """
+        Starts as many of the waiting `msgtype' handler funcs as its concurrency limit allows.
+
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        q = self._pooledhandlerqueues.get(msgtype)
+        stats = self._pooledhandlerstats[msgtype]
+        # (If it has stopped being pooled then run the rest right away.)
+        while q and ((not self._pooledhandlers.has_key(msgtype)) or (stats['running'] < self._pooledhandlers[msgtype])):
+            (enqueuetime, serverfunc, widget, msgbody,) = q.pop(0)
+            wait = time.time() - enqueuetime
+            stats['total wait'] = stats['total wait'] + wait
+            stats['max wait'] = max(stats['max wait'], wait)
+            stats['running'] = stats['running'] + 1
+
+            resultfunc = lambda result, self=self, msgtype=msgtype, widget=widget, msgbody=msgbody: self._pooled_handler_done(msgtype, widget, msgbody, result)
+            errorfunc = lambda le, self=self, msgtype=msgtype, widget=widget, msgbody=msgbody: self._pooled_handler_done(msgtype, widget, msgbody, failure=le)
+            if (self._handlerpool is not None) and self._handlerpool.submit(self._run_pooled_handler, args=(msgtype, serverfunc, widget, msgbody,), resultfunc=resultfunc, errorfunc=errorfunc):
+                continue
+            # The pool is full (or shutting down), so run it here.
+            stats['ran on the DoQ'] = stats['ran on the DoQ'] + 1
+            starttime = time.time()
+            try:
+                result = serverfunc(widget, msgbody)
+            except:
+                self._admissioncontroller.record_cost(msgtype, time.time() - starttime)
+                debugprint("MTM: exception in %s handler %s:\n", args=(msgtype, serverfunc,), v=0, vs="ERROR")
+                traceback.print_exc(file=debugstream)
+                self._pooled_handler_done(msgtype, widget, msgbody, failure=sys.exc_info()[1], startmore=false)
+            else:
+                self._admissioncontroller.record_cost(msgtype, time.time() - starttime)
+                self._pooled_handler_done(msgtype, widget, msgbody, result, startmore=false)
+        if (q is not None) and (not q):
+            del self._pooledhandlerqueues[msgtype]
+
+    def _run_pooled_handler(self, msgtype, serverfunc, widget, msgbody):
+        """
+        Runs on a worker thread of the handler pool.  The pool hands only the exception to the
+        errorfunc, so the traceback is printed here while it is still available.
+
+        The time the handler func took is reported to the admission controller (on the DoQ),
+        so that expensive pooled message types are shed as BULK.
+        """
+        starttime = time.time()
+        try:
+            try:
+                return serverfunc(widget, msgbody)
+            except:
+                debugprint("MTM: exception in %s handler %s:\n", args=(msgtype, serverfunc,), v=0, vs="ERROR")
+                traceback.print_exc(file=debugstream)
+                raise
+        finally:
+            DoQ.doq.add_task(self._admissioncontroller.record_cost, args=(msgtype, time.time() - starttime,))
+
+    def _pooled_handler_done(self, msgtype, widget, msgbody, result=None, failure=None, startmore=true):
+        """
+        Sends the response from a pooled handler func, and then starts the next waiting one of
+        the same message type if `startmore'.
+
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        firstmsgId = widget._firstmsgId
+        stats = self._pooledhandlerstats[msgtype]
+        stats['running'] = stats['running'] - 1
+        try:
+            if self._cm._map_inmsgid_to_info.get(firstmsgId) is None:
+                # We are shutting down, or this request has been dealt with some other way.
+                return
+            if failure is not None:
+                stats['failed'] = stats['failed'] + 1
+                debugprint("MTM: %s handler failed: %s\n", args=(msgtype, failure,), v=0, vs="ERROR")
+                self.respond_with(firstmsgId, None, mojoheader={'result': "failure", 'reason': "handler failed"})
+                return
+            stats['completed'] = stats['completed'] + 1
+
+            if result is MojoTransaction.NO_RESPONSE:
+                self._cm.drop_request_state(firstmsgId)
+                return
+            if result is MojoTransaction.ASYNC_RESPONSE:
+                # The handler func will call `respond_with()' itself.
+                return
+
+            if (type(result) in (types.TupleType, types.ListType,)) and (len(result) == 2) and Conversation.is_mojo_message(result[0]) and CommHints.is_hint(result[1]):
+                hint = result[1]
+                result = result[0]
+            else:
+                hint = HINT_NO_HINT
+
+            rc = self._response_caches.get(msgtype)
+            if (rc is not None) and (result is not None):
+                result = mencode.PreEncodedThing(result)
+                rc.put(ResponseCache.make_key(msgbody), result, hint)
+
+            self.respond_with(firstmsgId, result, hint=hint)
+        finally:
+            if startmore:
+                self._start_pooled_handlers(msgtype)
+
+    def get_pooled_handler_stats(self):
+        """
+        @returns a dict mapping each message type whose handler func has ever been pooled to a
+            dict of: the number of its handler funcs running and waiting now, the number that
+            have completed and failed, the number that had to be run on the DoQ because the
+            pool was full, and the total and maximum number of seconds they waited for their
+            turn;  Also under the key `None', the pool's own statistics.
+        """
+        result = {}
+        for (msgtype, stats,) in self._pooledhandlerstats.items():
+            result[msgtype] = copy.copy(stats)
+            result[msgtype]['waiting'] = len(self._pooledhandlerqueues.get(msgtype, ()))
+        if self._handlerpool is not None:
+            result[None] = self._handlerpool.get_stats()
+        return result
+
+    def initiate(self, counterparty_id, conversationtype, firstmsgbody, outcome_func=None, timeout=300, notes = None, post_timeout_outcome_func=None, use_dynamic_timeout="iff there is a post_timeout_outcome_func", commstratseqno=None, hint=HINT_NO_HINT, coalesce=false):
         """
         Initiates a transaction with the specified counterparty.
 
@@ -707,6 +1327,11 @@ class MojoTransactionManager:
             message to the next hop, regardless, which is what you want when it is a
             message that actually originates with you.
         @param an optional comms hint (see CommHints.py)
+        @param coalesce `true' if an identical query (same counterparty, conversation type and
+            `firstmsgbody') that is still outstanding can answer this one too;  In that case
+            nothing is sent, and `outcome_func' gets called with the same outcome as the
+            outstanding one's (and `post_timeout_outcome_func' is ignored).  Only use this
+            for queries which have no side-effects.  See `get_coalesce_stats()'.
 
         @precondition `counterparty_id' must be an id.: idlib.is_sloppy_id(counterparty_id): "counterparty_id: %s" % hr(counterparty_id)
         @precondition This MTM must not be shutting down.: not self._shuttingdownflag
@@ -720,98 +1345,191 @@ class MojoTransactionManager:
                     outcome_func = outcome_func, notes = notes):
                 outcome_func(widget, outcome, failure_reason, notes = notes)
             outcome_func = wrapped_outcome_func
-        DoQ.doq.add_task(self._initiate, args=(counterparty_id, conversationtype, firstmsgbody, outcome_func,), kwargs={'timeout': timeout, 'post_timeout_outcome_func': post_timeout_outcome_func, 'use_dynamic_timeout':use_dynamic_timeout, 'commstratseqno': commstratseqno, 'hint': hint})
+        DoQ.doq.add_task(self._initiate, args=(counterparty_id, conversationtype, firstmsgbody, outcome_func,), kwargs={'timeout': timeout, 'post_timeout_outcome_func': post_timeout_outcome_func, 'use_dynamic_timeout':use_dynamic_timeout, 'commstratseqno': commstratseqno, 'hint': hint, 'coalesce': coalesce})
+
+    def request(self, counterparty_id, conversationtype, firstmsgbody, timeout=300, use_dynamic_timeout="never", commstratseqno=None, hint=HINT_NO_HINT, coalesce=false):
+        """
+        Initiates a transaction with the specified counterparty, just like `initiate()', but
+        instead of taking an outcome func it returns a PendingTransaction which holds the
+        outcome once there is one.  (A response that arrives after a timeout is dropped.)
+
+        @returns an instance of PendingTransaction
+
+        @precondition `counterparty_id' must be an id.: idlib.is_sloppy_id(counterparty_id): "counterparty_id: %s" % hr(counterparty_id)
+        @precondition This MTM must not be shutting down.: not self._shuttingdownflag
+        """
+        assert idlib.is_sloppy_id(counterparty_id), "precondition: `counterparty_id' must be an id." + " -- " + "counterparty_id: %s" % hr(counterparty_id)
+        assert not self._shuttingdownflag, "precondition: This MTM must not be shutting down."
+
+        pt = PendingTransaction()
+        self.initiate(counterparty_id, conversationtype, firstmsgbody, outcome_func=pt._outcome_func, timeout=timeout, use_dynamic_timeout=use_dynamic_timeout, commstratseqno=commstratseqno, hint=hint, coalesce=coalesce)
+        return pt
+
+    def initiate_many(self, counterparty_ids, conversationtype, firstmsgbody, outcome_func, mode="all", timeout=300, hint=HINT_NO_HINT):
+        """
+        Initiates the same transaction with each of several counterparties, and calls
+        `outcome_func' once when enough of them have completed.  `firstmsgbody' is mencoded
+        only once for all of them.
+
+        @param counterparty_ids a list of the ids of the counterparties with whom to transact
+        @param outcome_func a callback that will be called exactly once, with "successes" (a
+            list of (widget, outcome,) tuples) and "failures" (a list of (widget,
+            failure_reason,) tuples) keyword arguments
+        @param mode "first" to call `outcome_func' as soon as one of the transactions succeeds,
+            an integer k to call it as soon as k of them succeed, or "all" to call it when all
+            of them have completed;  In any mode it is called once all of them have completed,
+            even if not enough of them succeeded.  Once `outcome_func' has been called, the
+            transactions that are still outstanding are forgotten: their responses, if any, are
+            ignored.
+
+        (See `initiate()' for the other params.)
+
+        @precondition `counterparty_ids' must be a non-empty list.: (type(counterparty_ids) in (types.ListType, types.TupleType,)) and (len(counterparty_ids) > 0): "counterparty_ids: %s" % hr(counterparty_ids)
+        @precondition `mode' must be "first", "all" or a positive integer.: (mode in ("first", "all",)) or ((type(mode) in (types.IntType, types.LongType,)) and (mode > 0)): "mode: %s" % hr(mode)
+        @precondition This MTM must not be shutting down.: not self._shuttingdownflag
+        """
+        assert (type(counterparty_ids) in (types.ListType, types.TupleType,)) and (len(counterparty_ids) > 0), "precondition: `counterparty_ids' must be a non-empty list." + " -- " + "counterparty_ids: %s" % hr(counterparty_ids)
+        assert (mode in ("first", "all",)) or ((type(mode) in (types.IntType, types.LongType,)) and (mode > 0)), "precondition: `mode' must be \"first\", \"all\" or a positive integer." + " -- " + "mode: %s" % hr(mode)
+        assert not self._shuttingdownflag, "precondition: This MTM must not be shutting down."
+
+        counterparty_ids = map(idlib.to_binary, counterparty_ids)
+        DoQ.doq.add_task(self._initiate_many, args=(counterparty_ids, conversationtype, firstmsgbody, outcome_func,), kwargs={'mode': mode, 'timeout': timeout, 'hint': hint})
+
+    def _initiate_many(self, counterparty_ids, conversationtype, firstmsgbody, outcome_func, mode="all", timeout=300, hint=HINT_NO_HINT):
+        """
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        if mode == "first":
+            need = 1
+        elif mode == "all":
+            need = len(counterparty_ids)
+        else:
+            need = min(mode, len(counterparty_ids))
+        group = _ConversationGroup(self, len(counterparty_ids), need, outcome_func)
+
+        preencodedbody = mencode.PreEncodedThing(firstmsgbody)
+        for i in range(len(counterparty_ids)):
+            if group.is_complete():
+                # No need to send to the rest.
+                break
+            member_outcome_func = lambda widget=None, outcome=None, failure_reason=None, group=group, i=i: group._member_outcome_func(i, widget=widget, outcome=outcome, failure_reason=failure_reason)
+            msgId = self._initiate(counterparty_ids[i], conversationtype, preencodedbody, member_outcome_func, timeout=timeout, use_dynamic_timeout="never", hint=hint)
+            group._started(i, msgId)
+
+    def initiate_hedged(self, counterparties, conversationtype, firstmsgbody, outcome_func, timeout=300, hint=HINT_NO_HINT):
+        """
+        Initiates a transaction with the best of `counterparties', as judged by the handicapper.
+        If it hasn't answered by the time that `HEDGE_PERCENTILE' percent of its (or, if there
+        are no statistics for it yet, everyone's) `conversationtype' conversations have
+        answered, the same transaction is initiated with the next-best, and so on.  The first
+        successful response is passed to `outcome_func', and the conversations which are still
+        outstanding are forgotten.  A failure moves on to the next-best immediately.
+
+        Hedges are limited to `HEDGE_BUDGET_PERCENT' percent of the conversations initiated this
+        way, so that slow counterparties don't make us flood the network with duplicates.  See
+        `get_hedge_stats()'.
+
+        Use this only for queries which have no side-effects.
+
+        @param counterparties a sequence of (counterparty_id, service_info_dict,) tuples, as for
+            `MojoHandicapper.sort_by_preference()'
+        @param outcome_func a callback that will be called exactly once, with "widget",
+            "outcome" and "failure_reason" keyword arguments;  If all of the counterparties
+            fail, it is given the last failure.
+
+        (See `initiate()' for the other params.)
+
+        @precondition This MTM must not be shutting down.: not self._shuttingdownflag
+        """
+        assert not self._shuttingdownflag, "precondition: This MTM must not be shutting down."
+
+        DoQ.doq.add_task(self._initiate_hedged, args=(counterparties, conversationtype, firstmsgbody, outcome_func,), kwargs={'timeout': timeout, 'hint': hint})
+
+    def _initiate_hedged(self, counterparties, conversationtype, firstmsgbody, outcome_func, timeout=300, hint=HINT_NO_HINT):
+        """
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
+        """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
+
+        counterparty_ids = map(lambda x: idlib.canonicalize(x[0], "broker"), self.get_handicapper().sort_by_preference(counterparties, conversationtype, firstmsgbody))
+        if not counterparty_ids:
+            outcome_func(failure_reason="no counterparties available")
+            return
+
+        self._hedge_stats['conversations'] = self._hedge_stats['conversations'] + 1
+        hc = _HedgedConversation(self, counterparty_ids, conversationtype, mencode.PreEncodedThing(firstmsgbody), outcome_func, timeout, hint)
+        hc._start_next()
+
+    def _get_hedge_delay(self, counterparty_id, conversationtype):
+        """
+        @returns the number of seconds in which `HEDGE_PERCENTILE' percent of `conversationtype'
+            conversations with `counterparty_id' are expected to be answered, or `None' if
+            there have been none
+        """
+        percentile = float(confman['COUNTERPARTY'].get('HEDGE_PERCENTILE', "95"))
+        return self.get_latency_quantile(counterparty_id, conversationtype, percentile / 100.0)
+
+    def _use_hedge_budget(self):
+        """
+        @returns `true' and counts a hedge if there is room in the budget for one more
+        """
+        budgetpercent = float(confman['COUNTERPARTY'].get('HEDGE_BUDGET_PERCENT', "5"))
+        if (self._hedge_stats['hedges'] + 1) > ((self._hedge_stats['conversations'] * budgetpercent) / 100.0):
+            self._hedge_stats['over budget'] = self._hedge_stats['over budget'] + 1
+            return false
+        self._hedge_stats['hedges'] = self._hedge_stats['hedges'] + 1
+        return true
+
+    def get_hedge_stats(self):
+        """
+        @returns a dict of the number of conversations initiated with `initiate_hedged()', the
+            number of hedges sent, the number not sent because the budget was used up, and of
+            the conversations that sent hedges, the number answered by a hedge ("won") and the
+            number answered by the first counterparty or not at all ("lost")
+        """
+        return copy.copy(self._hedge_stats)
 
-    def _initiate(self, counterparty_id, conversationtype, firstmsgbody, outcome_func, timeout=300, post_timeout_outcome_func=None, use_dynamic_timeout=None, commstratseqno=None, hint=HINT_NO_HINT):
+    def _initiate(self, counterparty_id, conversationtype, firstmsgbody, outcome_func, timeout=300, post_timeout_outcome_func=None, use_dynamic_timeout=None, commstratseqno=None, hint=HINT_NO_HINT, coalesce=false):
         """
+        @returns the id of the first message of the conversation, or `None' if it was coalesced
+
         @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
         """
         assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
 
         counterparty_id = idlib.canonicalize(counterparty_id, "broker")
+
+        if coalesce and outcome_func:
+            key = (counterparty_id, conversationtype, sha(mencode.mencode(firstmsgbody)).digest(),)
+            waiting = self._coalesced_outcome_funcs.get(key)
+            if waiting is not None:
+                debugprint("MTM: coalescing %s with %s into an outstanding conversation\n", args=(conversationtype, counterparty_id,), v=5, vs="Conversation")
+                waiting.append(outcome_func)
+                self._coalesce_stats['coalesced'] = self._coalesce_stats['coalesced'] + 1
+                return None
+            waiting = [outcome_func]
+            self._coalesced_outcome_funcs[key] = waiting
+            self._coalesce_stats['initiated'] = self._coalesce_stats['initiated'] + 1
+            outcome_func = lambda widget=None, outcome=None, failure_reason=None, self=self, key=key: self._call_coalesced_outcome_funcs(key, widget, outcome, failure_reason)
             
         if confman.is_true_bool(['COUNTERPARTY', 'USE_DYNAMIC_TIMING'], default="yes"):
             if (use_dynamic_timeout == "always" or (use_dynamic_timeout == "iff there is a post_timeout_outcome_func" and post_timeout_outcome_func is not None)):
-                counterparty = self._keeper.get_counterparty_object(counterparty_id)
-                stat = 'roundtrip_time['+conversationtype+']'
-                if counterparty.get_custom_stat(stat) is None:
-                    (mu, sigma, ignore) = self.response_times.get(conversationtype, (120, 20, false,))
-                    timeout = mu + 2*sigma
-                    debugprint("using global average dynamic timeout %s with for %s to %s\n", args=("%0.2f" % timeout, stat, counterparty_id), v=3, vs='counterparty')
-                else:
-                    (mu, sigma, ignore) = counterparty.get_custom_stat(stat)
-                    timeout = mu + 2*sigma
-                    debugprint("using dynamic timeout %s with for %s to %s\n", args=("%0.2f" % timeout, stat, counterparty_id), v=3, vs='counterparty')
+                percentile = float(confman['COUNTERPARTY'].get('TIMEOUT_PERCENTILE', "99"))
+                dynamictimeout = self.get_latency_quantile(counterparty_id, conversationtype, percentile / 100.0)
+                if dynamictimeout is not None:
+                    timeout = dynamictimeout
+                    debugprint("using dynamic timeout %s for %s to %s\n", args=("%0.2f" % timeout, conversationtype, counterparty_id), v=3, vs='counterparty')
 
         timeout = min(mojoutil.intorlongpopL(confman.get('MAX_TIMEOUT', 3600)), timeout)
 
-        def collect_timings(counterparty_id=counterparty_id, start_time=time.time(), conversationtype=conversationtype, self=self):
-            """
-            Update timing statistics then call outcome_func
-
-            The elapsed time is used to update estimates of mean and
-            standard deviation of arrival times.  As a statistical
-            tool, a warning is output every time the estimate is under
-            by two standard deviations.  The intention is that one
-            could use mu + 2*sigma as a timeout.
-
-            The exponential averaging uses a time constant of 10, so
-            it takes about 10 packets to learn aout the timeouts.
-            This may be too high; it should be a configuration option.
-            """
-            elapsed_time = time.time() - start_time
-            time_constant = float(confman["COUNTERPARTY"]["AVERAGING_TIMESCALE_v2"])
-            default_sigma = elapsed_time
-
-            stat = 'roundtrip_time['+conversationtype+']'
-            
-            counterparty = self._keeper.get_counterparty_object(idlib.canonicalize(counterparty_id, "broker"))
-            if counterparty.get_custom_stat(stat) is not None:
-                # We already have an estimate of how long it should have taken.
-                # How good was our guess?
-                try:
-                    # defaults get returned only if it's you
-                    (mu, sigma, ignore) = counterparty.get_custom_stat(stat, (0, 0, 0))
-                    debugprint("dynamic timing: message %s to %s took %s seconds (mu: %s, sigma: %s)\n", args=(stat, counterparty_id, "%0.2f" % elapsed_time, "%0.2f" % mu, "%0.2f" % sigma), v=3, vs="MojoTransaction")
-                    if elapsed_time > (mu+2*sigma):
-                        # Assuming a normal distribution, 99.7% caught
-                        debugprint("dynamic timing: UNUSUALLY LONG DELAY (normal distribution) on message %s to %s (took: %s mu: %s, sigma: %s)\n", args=(stat, counterparty_id, "%0.2f" % elapsed_time, "%0.2f" % mu, "%0.2f" % sigma), v=4, vs="MojoTransaction")
-                    if elapsed_time > 6*mu:
-                        # Assuming an exponential distribution, 99.7% caught
-                        debugprint("dynamic timing: UNUSUALLY LONG DELAY (exponential distribution) on message %s to %s (took: %s mu: %s)\n", args=(stat, counterparty_id, "%0.2f" % elapsed_time, "%0.2f" % mu), v=4, vs="MojoTransaction")
-                except TypeError:
-                    # Statistics are damaged.  Ignore.
-                    debugprint("dynamic timing: deleting damaged statistic %s for %s\n", args=(stat, counterparty_id), v=2, vs="MojoTransaction")
-                    # this shouldn't happen, but we should nuke the damaged stat in the event that it does
-                    counterparty.delete_custom_stat(stat)
-
-            counterparty.update_custom_stat_weighted_sample_with_deviation(stat, elapsed_time, math.exp(-1./time_constant), default_sigma)
-
-            oldval = self._responsetimesold.get(conversationtype)
-            newval = mojoutil.update_weighted_sample(setdefault(self.response_times, conversationtype, None), elapsed_time, math.exp(-1./time_constant), default_sigma)
-            self.response_times[conversationtype] = newval
-            if (oldval is None) or (abs(oldval[0] - newval[0]) > 0.5) or (abs(oldval[1] - newval[1]) > 0.5):
-                self._initiate_save_response_times_task_idempotent()
-                self._responsetimesold.update(self.response_times)
-
-        def wrapped_outcome_func_collect_timings(widget=None, outcome=None, failure_reason=None, notes=None, outcome_func=outcome_func, collect_timings=collect_timings):
-            if failure_reason != 'timeout':
-                collect_timings()
-            return outcome_func(widget, outcome, failure_reason)
-
-        def wrapped_post_timeout_outcome_func_collect_timings(outcome=None, failure_reason=None, notes=None, post_timeout_outcome_func=post_timeout_outcome_func, collect_timings=collect_timings):
-            debugprint("dynamic timing: late return from %s\n", args=(notes['counterparty_id'],), v=3, vs='MojoTransaction')
-            collect_timings()
-            widget = Widget(notes['counterparty_id'], notes['first_message_id'])
-            if post_timeout_outcome_func is not None:
-                return post_timeout_outcome_func(widget=widget, outcome=outcome['mojo message'], failure_reason=failure_reason)
-            else:
-                return None
-
+        record = Conversation.ConversationRecord(counterparty_id, conversationtype)
+        record.outer_outcome_func = outcome_func
+        record.outer_post_timeout_outcome_func = post_timeout_outcome_func
         if confman.is_true_bool(['COUNTERPARTY', 'COLLECT_DYNAMIC_TIMING']) and outcome_func:
-            outcome_func = wrapped_outcome_func_collect_timings
-            post_timeout_outcome_func = wrapped_post_timeout_outcome_func_collect_timings
-        ### END DYNAMIC TIMERS code
+            record.starttime = time.time()
+            post_timeout_outcome_func = self._post_timeout_outcome_func_collect_timings
 
         mojoheaderdict={}
 
@@ -820,27 +1538,90 @@ class MojoTransactionManager:
             'mojo message': firstmsgbody,
             }
 
-        notes = {'outer_outcome_func': outcome_func, 
-            'conversationtype': conversationtype, 'firstmsgbody': firstmsgbody, 
-            'timeout': timeout,
-            'counterparty_id': counterparty_id,
-            }
-            
         # include our metainfo in messages the first time we send a message to a counterparty
         # (or again when it has been updated; this map is emptied when our metainfo changes)
         mymetainfo = None
         if self._allow_send_metainfo and not self.__counterparties_metainfo_sent_to_map.has_key(counterparty_id):
-            mymetainfo = self._get_our_hello_msgbody()
-            if not mymetainfo.has_key('connection strategies'):
+            (hello_body, mymetainfo,) = self._get_our_preencoded_hello_msgbody()
+            if not hello_body.has_key('connection strategies'):
                 # Hm.  We haven't finished choosing a relay server I guess.
                 mymetainfo = None
             self.__counterparties_metainfo_sent_to_map[counterparty_id] = None
 
-        first_message_id, msg = self._cm.initiate_and_return_first_message(counterparty_id, conversationtype, bodydict, outcome_func=self._outcome_func_to_do_mojo_header, timeout=timeout, notes=notes, mymetainfo=mymetainfo, post_timeout_outcome_func=post_timeout_outcome_func)
-
-        notes['first_message_id'] = first_message_id
+        first_message_id, msg = self._cm.initiate_and_return_first_message(counterparty_id, conversationtype, bodydict, outcome_func=self._outcome_func_to_do_mojo_header, timeout=timeout, record=record, mymetainfo=mymetainfo, post_timeout_outcome_func=post_timeout_outcome_func)
 
         self.send_message_with_lookup(counterparty_id, msg, timeout=timeout, hint=hint | HINT_EXPECT_RESPONSE, commstratseqno=commstratseqno)
+        return first_message_id
+
+    def _collect_timings(self, record):
+        """
+        Add the elapsed time to the latency sketches for this conversation type, both for
+        this counterparty and for everyone, from which dynamic timeouts, hedge delays and
+        the latency handicap are read.  The sketches are only in memory; they get saved to
+        disk in one batch at most once every 10 minutes.
+        """
+        elapsed_time = time.time() - record.starttime
+        conversationtype = record.conversationtype
+        halflife = max(2, int(float(confman["COUNTERPARTY"]["AVERAGING_TIMESCALE_v2"])))
+
+        counterparty_id = idlib.canonicalize(record.counterparty_id, "broker")
+        for key in ((counterparty_id, conversationtype,), conversationtype,):
+            sketch = self._latencysketches.get(key)
+            if sketch is None:
+                sketch = LatencySketch.LatencySketch(halflife=halflife)
+                self._latencysketches[key] = sketch
+            elif len(sketch) >= 10:
+                p99 = sketch.quantile(0.99)
+                if elapsed_time > p99:
+                    debugprint("dynamic timing: UNUSUALLY LONG DELAY on message %s to %s (took: %s p99: %s)\n", args=(conversationtype, counterparty_id, "%0.2f" % elapsed_time, "%0.2f" % p99,), v=4, vs="MojoTransaction")
+            sketch.add(elapsed_time)
+        self._initiate_save_latency_sketches_task_idempotent()
+
+    def _post_timeout_outcome_func_collect_timings(self, outcome=None, failure_reason=None, notes=None):
+        record = notes
+        debugprint("dynamic timing: late return from %s\n", args=(record.counterparty_id,), v=3, vs='MojoTransaction')
+        self._collect_timings(record)
+        if record.outer_post_timeout_outcome_func is not None:
+            widget = Widget(record.counterparty_id, record.firstmsgId)
+            return record.outer_post_timeout_outcome_func(widget=widget, outcome=outcome['mojo message'], failure_reason=failure_reason)
+        else:
+            return None
+
+    def _call_coalesced_outcome_funcs(self, key, widget, outcome, failure_reason):
+        waiting = self._coalesced_outcome_funcs[key]
+        del self._coalesced_outcome_funcs[key]
+        for outcome_func in waiting:
+            try:
+                outcome_func(widget=widget, outcome=outcome, failure_reason=failure_reason)
+            except:
+                debugprint("MTM: exception in coalesced outcome func %s:\n", args=(outcome_func,), v=0, vs="ERROR")
+                traceback.print_exc(file=debugstream)
+
+    def get_cache_stats(self):
+        """
+        @returns a dict of the total bytes used by the BudgetCaches, the budget, and the items,
+            bytes, hits, misses, evictions and expirations of each cache by name
+        """
+        return BudgetCache.budget.get_stats()
+
+    def get_conversation_memory_stats(self):
+        """
+        @returns a dict of the number of conversations we initiated which are waiting for a
+            response, and an estimate of the bytes of memory they use
+        """
+        return self._cm.get_memory_stats()
+
+    def get_coalesce_stats(self):
+        """
+        @returns a dict of the number of conversations initiated with `coalesce' on, the number
+            of `initiate()'s that were answered by one of those instead of sending, and the
+            number of those conversations that are currently outstanding
+        """
+        return {
+            'initiated': self._coalesce_stats['initiated'],
+            'coalesced': self._coalesce_stats['coalesced'],
+            'outstanding': len(self._coalesced_outcome_funcs),
+            }
 
     def _outcome_func_to_do_mojo_header(self, outcome = None, failure_reason = None, notes = None):
         """
@@ -851,14 +1632,19 @@ class MojoTransactionManager:
         """
         assert (not outcome) or outcome.has_key('mojo header') or outcome.has_key('mojo message'), "`outcome' is none or else the full message body, having a \"mojo header\" or \"mojo message\" subdict." + " -- " + "outcome: %s" % hr(outcome)
 
-        counterparty_id = notes['counterparty_id']
-        outer_outcome_func = notes['outer_outcome_func']
-        conversationtype = notes['conversationtype']
-        firstmsgbody = notes['firstmsgbody']
-        timeout = notes['timeout']
+        record = notes
+        counterparty_id = record.counterparty_id
+        outer_outcome_func = record.outer_outcome_func
+        conversationtype = record.conversationtype
+        # The record may be kept a while longer in case of a late response, but this won't be
+        # needed again.
+        record.outer_outcome_func = None
+
+        if (record.starttime is not None) and (failure_reason != 'timeout'):
+            self._collect_timings(record)
 
         widget=Widget(counterparty_id)
-        widget._firstmsgId = notes['first_message_id']
+        widget._firstmsgId = record.firstmsgId
 
         counterparty_obj = self._keeper.get_counterparty_object(counterparty_id)
 
@@ -889,9 +1675,14 @@ class MojoTransactionManager:
                 else:
                     return None
             else:
+                if mojoheader.get('reason') == "overloaded":
+                    # It shed our request;  Don't bother it again for a while.
+                    retryafter = mojoheader.get('retry after')
+                    if mojoutil.is_number(retryafter):
+                        self._retryafter[idlib.canonicalize(counterparty_id, "broker")] = time.time() + min(retryafter, 3600)
                 # this is some other undefined failure response.
                 if outer_outcome_func:
-                    return apply(outer_outcome_func, (), {'widget': widget, 'outcome': outcome, 'failure_reason': mojoheader.get('failure_reason', "failure reported in mojoheader")})
+                    return apply(outer_outcome_func, (), {'widget': widget, 'outcome': outcome, 'failure_reason': mojoheader.get('reason', mojoheader.get('failure_reason', "failure reported in mojoheader"))})
                 else:
                     return None
 
@@ -1016,3 +1807,24 @@ class MojoTransactionManager:
         self._lookupman.lookup(counterparty_id, lookuphand)
         # _debugprint(diagstr="done calling nonblocking_get_contact_info...", v=15, vs="metatracking")
 
+def test_one_fast_sample_does_not_shrink_the_timeout():
+    import new
+    mtm = new.instance(MojoTransactionManager, {'_latencysketches': {}})
+    sketch = LatencySketch.LatencySketch()
+    sketch.add(0.05)
+    mtm._latencysketches['get blob'] = sketch
+    counterparty_id = idlib.string_to_id('a')
+    assert mtm.get_latency_quantile(counterparty_id, 'get blob', 0.99) is None
+    assert mtm.get_latency_quantile(None, 'get blob', 0.99) is None
+    for i in range(9):
+        sketch.add(0.05)
+    assert mtm.get_latency_quantile(counterparty_id, 'get blob', 0.99) is not None
+
+mojo_test_flag = 1
+
+def run():
+    import RunTests
+    RunTests.runTests(["MojoTransaction"])
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2002 Bryce "Zooko" Wilcox-O'Hearn
+#  This file is licensed under the
+#    GNU Lesser General Public License v2.1.
+#    See the file COPYING or visit http://www.gnu.org/ for details.
+#
+
+# standard modules
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+# pyutil modules
+import DoQ
+from debugprint import debugprint, debugstream
+import humanreadable
+
+true = 1
+false = None
+
+class PKOpPool:
+    """
+    A fixed set of worker threads for doing expensive operations (such as public key
+    operations) off of the DoQ thread.  The results are delivered back on the DoQ.
+
+    The queue of waiting operations is bounded: when it is full `submit()' refuses the
+    operation, and the caller should do it itself on the DoQ instead.  That way a burst of
+    work slows the DoQ down (which slows down the reading of more work) rather than piling
+    up without bound.
+
+    Note that the operations can only run in parallel with each other and with the DoQ if
+    the extension module doing the work releases the global interpreter lock while it works.
+    """
+    def __init__(self, numthreads, maxqueued=None):
+        """
+        @param numthreads the number of worker threads
+        @param maxqueued the maximum number of operations waiting for a worker, or `None'
+            for 4 per worker
+
+        @precondition `numthreads' must be positive.: numthreads > 0: "numthreads: %s" % humanreadable.hr(numthreads)
+        """
+        assert numthreads > 0, "precondition: `numthreads' must be positive." + " -- " + "numthreads: %s" % humanreadable.hr(numthreads)
+
+        if maxqueued is None:
+            maxqueued = numthreads * 4
+        self._q = Queue.Queue(maxqueued)
+        self._shuttingdown = false
+
+        # statistics (updated by the workers as well as the DoQ, so under `_statslock')
+        self._statslock = threading.Lock()
+        self._submitted = 0
+        self._refused = 0
+        self._completed = 0
+        self._failed = 0
+
+        self._threads = []
+        for i in range(numthreads):
+            t = threading.Thread(target=self._worker_loop, name="PKOpPool worker %d" % i)
+            t.setDaemon(true)
+            t.start()
+            self._threads.append(t)
+
+    def __repr__(self):
+        return "<%s threads: %d, queued: %d, %x>" % (self.__class__.__name__, len(self._threads), self._q.qsize(), id(self),)
+
+    def submit(self, func, args=(), kwargs={}, resultfunc=None, errorfunc=None):
+        """
+        Arranges for `func(*args, **kwargs)' to be called on a worker thread.  Then either
+        `resultfunc(result)' or, if `func' raised an exception, `errorfunc(exception)' will be
+        called on the DoQ.
+
+        @returns `true' if the operation was queued, `false' if the queue was full or the pool
+            is shutting down (in which case none of the functions will be called)
+        """
+        if self._shuttingdown:
+            return false
+        try:
+            self._q.put((func, args, kwargs, resultfunc, errorfunc,), 0)
+        except Queue.Full:
+            self._count('_refused')
+            return false
+        self._count('_submitted')
+        return true
+
+    def _count(self, statname):
+        self._statslock.acquire()
+        try:
+            setattr(self, statname, getattr(self, statname) + 1)
+        finally:
+            self._statslock.release()
+
+    def get_stats(self):
+        """
+        @returns a dict of the number of operations submitted, refused, completed and failed,
+            and the number currently waiting for a worker
+        """
+        self._statslock.acquire()
+        try:
+            return {
+                'submitted': self._submitted,
+                'refused': self._refused,
+                'completed': self._completed,
+                'failed': self._failed,
+                'queued': self._q.qsize(),
+                }
+        finally:
+            self._statslock.release()
+
+    def shutdown(self):
+        """
+        Operations which are already queued will still be done, but no more will be accepted.
+        """
+        if self._shuttingdown:
+            return
+        self._shuttingdown = true
+        for t in self._threads:
+            # a `None' tells one worker to stop
+            self._q.put(None)
+        self._threads = []
+
+    def _worker_loop(self):
+        while true:
+            job = self._q.get()
+            if job is None:
+                return
+            (func, args, kwargs, resultfunc, errorfunc,) = job
+            try:
+                result = apply(func, args, kwargs)
+            except:
+                self._count('_failed')
+                le = sys.exc_info()[1]
+                if errorfunc is not None:
+                    DoQ.doq.add_task(errorfunc, args=(le,))
+                else:
+                    debugprint("%s: exception in %s:\n", args=(self, func,), v=0, vs="ERROR")
+                    traceback.print_exc(file=debugstream)
+            else:
+                self._count('_completed')
+                if resultfunc is not None:
+                    DoQ.doq.add_task(resultfunc, args=(result,))
+
+def _help_wait_for(pred, timeout=10):
+    stoptime = time.time() + timeout
+    while not pred():
+        assert time.time() < stoptime, "timed out"
+        time.sleep(0.01)
+        DoQ.doq.flush()
+
+def test_results_come_back_on_doq():
+    pool = PKOpPool(3)
+    results = []
+    errors = []
+    def resultfunc(result, results=results):
+        assert DoQ.doq.is_currently_doq()
+        results.append(result)
+    def errorfunc(le, errors=errors):
+        assert DoQ.doq.is_currently_doq()
+        errors.append(le)
+    for i in range(10):
+        assert pool.submit(pow, args=(i, 2,), resultfunc=resultfunc, errorfunc=errorfunc)
+    assert pool.submit(pow, args=("spam", 2,), resultfunc=resultfunc, errorfunc=errorfunc)
+    _help_wait_for(lambda results=results, errors=errors: (len(results) == 10) and (len(errors) == 1))
+    results.sort()
+    assert results == map(lambda i: i * i, range(10)), "results: %s" % humanreadable.hr(results)
+    assert isinstance(errors[0], TypeError)
+    pool.shutdown()
+
+def test_full_queue_refuses():
+    pool = PKOpPool(1, maxqueued=2)
+    started = threading.Event()
+    proceed = threading.Event()
+    def block(started=started, proceed=proceed):
+        started.set()
+        proceed.wait()
+    assert pool.submit(block)
+    started.wait()
+    # The worker is busy, so the next two wait in the queue, and then the queue is full.
+    assert pool.submit(block)
+    assert pool.submit(block)
+    assert not pool.submit(block)
+    assert pool.get_stats()['refused'] == 1
+    proceed.set()
+    _help_wait_for(lambda pool=pool: pool.get_stats()['completed'] == 3)
+    pool.shutdown()
+    assert not pool.submit(block)
+
+def test_stats_add_up():
+    pool = PKOpPool(8, maxqueued=1000)
+    for i in range(1000):
+        assert pool.submit(pow, args=(i, 2,))
+    _help_wait_for(lambda pool=pool: pool.get_stats()['queued'] == 0)
+    threads = pool._threads[:]
+    pool.shutdown()
+    for t in threads:
+        t.join()
+    stats = pool.get_stats()
+    assert (stats['submitted'], stats['completed'], stats['failed'],) == (1000, 1000, 0,), "stats: %s" % humanreadable.hr(stats)
+
+mojo_test_flag = 1
+
+def run():
+    import RunTests
+    RunTests.runTests(["PKOpPool"])
+
+if __name__ == '__main__':
+    run()
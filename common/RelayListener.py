@@ -23,6 +23,7 @@ import DoQ
 import LazySaver
 import MojoMessage
 import OurMessages
+import TimerWheel
 from confutils import confman
 import dictutil
 from humanreadable import hr
@@ -121,6 +122,10 @@ class RelayListener(LazySaver.LazySaver):
                 self._preferredrelayers.remove(thing)
 
     def _launch_polling_of_preferred_relayers(self):
+        # (Polls are scheduled on the TimerWheel, which must only be touched on the DoQ.)
+        if not DoQ.doq.is_currently_doq():
+            DoQ.doq.add_task(self._launch_polling_of_preferred_relayers)
+            return
         for i in range(len(self._preferredrelayers)):
             self._schedule_poll(self._preferredrelayers[i], delay=(MIN_POLL_DELAY * (2**i) - MIN_POLL_DELAY))
 
@@ -183,8 +188,12 @@ class RelayListener(LazySaver.LazySaver):
         This does not schedule the poll if there is already a poll scheduled that would go off approximately before this one would.
         (Where approximately is very approximate -- within MIN_POLL_DELAY.)
 
+        The poll goes on the TimerWheel rather than the DoQ, so it may go off up to a tick late.
+
+        @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
         @precondition `relayerid' must be an id (in binary form).: idlib.is_binary_id(relayerid): "relayerid: %s :: %s" (hr(relayerid), hr(type(relayerid)),)
         """
+        assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
         assert idlib.is_binary_id(relayerid), "precondition: `relayerid' must be an id (in binary form)." + " -- " + "relayerid: %s :: %s" % (hr(relayerid), hr(type(relayerid)),)
 
         approxschedtime = timer.time() + delay
@@ -192,10 +201,10 @@ class RelayListener(LazySaver.LazySaver):
         if (next is not None) and (approxschedtime + MIN_POLL_DELAY >= next):
             return
 
-        schedtime = DoQ.doq.add_task(self._retrieve_messages, args=(relayerid,), delay=delay)
+        TimerWheel.wheel.schedule(self._retrieve_messages, args=(relayerid,), delay=delay)
 
-        if (next is None) or (schedtime < next):
-            self._nextscheduledpolls[relayerid] = schedtime
+        if (next is None) or (approxschedtime < next):
+            self._nextscheduledpolls[relayerid] = approxschedtime
 
     def _adopt_new_favorite(self, true=true):
         """
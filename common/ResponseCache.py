@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2002 Bryce "Zooko" Wilcox-O'Hearn
+#  This file is licensed under the
+#    GNU Lesser General Public License v2.1.
+#    See the file COPYING or visit http://www.gnu.org/ for details.
+#
+
+# standard modules
+from sha import sha
+import time
+import types
+
+# pyutil modules
+import humanreadable
+
+# EGTP modules
+import BudgetCache
+import mencode
+
+true = 1
+false = None
+
+def make_key(msgbody):
+    """
+    @returns the key under which the response to `msgbody' is cached: the SHA-1 of the
+        canonical mencoding of `msgbody'
+    """
+    return sha(mencode.mencode(msgbody)).digest()
+
+class ResponseCache:
+    """
+    Remembers the responses to one type of idempotent query for `ttl' seconds, as
+    mencode.PreEncodedThings so that they can be sent again without calling the handler func
+    or encoding them again.  See `MojoTransactionManager.set_response_cache()'.
+
+    The responses take up at most `maxbytes' bytes (counting just their encodings); when a new
+    one doesn't fit, the least recently used ones are forgotten to make room.  They are kept in
+    a BudgetCache, so they also count against the shared `BudgetCache.budget'.
+    """
+    def __init__(self, ttl=60, maxbytes=2**20, name="responses", budget=BudgetCache.budget, time=time.time):
+        """
+        @param ttl the number of seconds to remember each response
+        @param maxbytes the most bytes of responses to remember at once
+        @param name the name under which the BudgetCache's stats are reported
+
+        @precondition `ttl' must be positive.: ttl > 0: "ttl: %s" % humanreadable.hr(ttl)
+        @precondition `maxbytes' must be positive.: maxbytes > 0: "maxbytes: %s" % humanreadable.hr(maxbytes)
+        """
+        assert ttl > 0, "precondition: `ttl' must be positive." + " -- " + "ttl: %s" % humanreadable.hr(ttl)
+        assert maxbytes > 0, "precondition: `maxbytes' must be positive." + " -- " + "maxbytes: %s" % humanreadable.hr(maxbytes)
+
+        self._ttl = ttl
+        self._maxbytes = maxbytes
+        self._name = name
+        # maps key to (preencodedresponse, hint,)
+        self._cache = BudgetCache.BudgetCache(name, maxbytes=maxbytes, ttl=ttl, budget=budget, sizefunc=_size_of_entry, time=time)
+
+    def __repr__(self):
+        return "<%s %s responses: %d, bytes: %d, %x>" % (self.__class__.__name__, self._name, len(self._cache), self._cache._bytes, id(self),)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        """
+        @returns (preencodedresponse, hint,), or `None' if there is no fresh response cached
+            under `key'
+        """
+        return self._cache.get(key)
+
+    def put(self, key, preencodedresponse, hint):
+        """
+        @param preencodedresponse a mencode.PreEncodedThing of the response
+        """
+        self._cache.insert(key, (preencodedresponse, hint,))
+
+    def invalidate(self, key=None):
+        """
+        Forgets the response cached under `key', or all of them if `key' is `None'.
+        """
+        if key is None:
+            self._cache.empty()
+        elif self._cache.has_key(key):
+            del self._cache[key]
+
+    def get_stats(self):
+        stats = self._cache.get_stats()
+        return {
+            'hits': stats['hits'],
+            'misses': stats['misses'],
+            'responses': stats['items'],
+            'bytes': stats['bytes'],
+            }
+
+def _size_of_entry(thing):
+    """
+    Counts just the encodings of the responses, not the keys.
+    """
+    if type(thing) is types.TupleType:
+        return len(thing[0])
+    return 0
+
+def test_get_put_and_expire():
+    clock = [1000.0]
+    rc = ResponseCache(ttl=10, maxbytes=2**10, time=lambda clock=clock: clock[0])
+    k1 = make_key({'query': 'spam'})
+    k2 = make_key({'query': 'eggs'})
+    assert k1 == make_key({'query': 'spam'})
+    assert rc.get(k1) is None
+
+    r1 = mencode.PreEncodedThing({'answer': 'spam'})
+    rc.put(k1, r1, 0)
+    assert rc.get(k1) == (r1, 0,)
+    assert rc.get(k2) is None
+
+    clock[0] = 1005.0
+    r2 = mencode.PreEncodedThing({'answer': 'eggs'})
+    rc.put(k2, r2, 0)
+    clock[0] = 1010.0
+    assert rc.get(k1) is None
+    assert rc.get(k2) == (r2, 0,)
+    assert rc.get_stats()['hits'] == 2, "rc.get_stats(): %s" % humanreadable.hr(rc.get_stats())
+
+    rc.invalidate(k2)
+    assert rc.get(k2) is None
+    rc.put(k2, r2, 0)
+    rc.invalidate()
+    assert rc.get(k2) is None
+    assert rc.get_stats()['bytes'] == 0
+
+def test_oldest_are_forgotten_to_stay_under_maxbytes():
+    clock = [1000.0]
+    rs = []
+    for i in range(10):
+        rs.append(mencode.PreEncodedThing("x" * 200))
+    # room for 5 and a half of them
+    maxbytes = (len(rs[0]) * 5) + (len(rs[0]) / 2)
+    rc = ResponseCache(ttl=100, maxbytes=maxbytes, time=lambda clock=clock: clock[0])
+    for i in range(10):
+        rc.put(make_key(i), rs[i], 0)
+        clock[0] = clock[0] + 1
+        assert rc.get_stats()['bytes'] <= maxbytes, "rc.get_stats(): %s" % humanreadable.hr(rc.get_stats())
+    for i in range(10):
+        if i < 5:
+            assert rc.get(make_key(i)) is None, "i: %s" % i
+        else:
+            assert rc.get(make_key(i)) == (rs[i], 0,), "i: %s" % i
+
+    # A response too big to cache is just not cached.
+    rc.put(make_key('big'), mencode.PreEncodedThing("x" * maxbytes), 0)
+    assert rc.get(make_key('big')) is None
+    assert len(rc) == 5
+
+mojo_test_flag = 1
+
+def run():
+    import RunTests
+    RunTests.runTests(["ResponseCache"])
+
+if __name__ == '__main__':
+    run()
@@ -77,8 +77,8 @@ class TCPCommsHandler(asyncore.dispatcher, LazySaver.LazySaver):
         # this boolean determines if we actually bind to a port
         self._dontbind = dontbind
 
-        self._throttlerout = BandwidthThrottler.BandwidthThrottler(throttle=confman.is_true_bool(('TCP_THROTTLE_OUT',)), Kbps=mojoutil.longpopL(confman.get('TCP_MAX_KILOBITS_PER_SECOND_OUT', "56")))
-        self._throttlerin = BandwidthThrottler.BandwidthThrottler(throttle=confman.is_true_bool(('TCP_THROTTLE_IN',)), Kbps=mojoutil.longpopL(confman.get('TCP_MAX_KILOBITS_PER_SECOND_IN', "56")))
+        self._throttlerout = BandwidthThrottler.TokenBucketThrottler(throttle=confman.is_true_bool(('TCP_THROTTLE_OUT',)), Kbps=mojoutil.longpopL(confman.get('TCP_MAX_KILOBITS_PER_SECOND_OUT', "56")))
+        self._throttlerin = BandwidthThrottler.TokenBucketThrottler(throttle=confman.is_true_bool(('TCP_THROTTLE_IN',)), Kbps=mojoutil.longpopL(confman.get('TCP_MAX_KILOBITS_PER_SECOND_IN', "56")))
         self._throttlerin.register(self._throttle, self._unthrottle)
 
         # My "id" is just a random number.  Nobody really uses this except for testing.
@@ -105,10 +105,21 @@ class TCPCommsHandler(asyncore.dispatcher, LazySaver.LazySaver):
 
         LazySaver.LazySaver.__init__(self, fname=os.path.join(self._mtm._dbdir, 'ListenerManager.pickle'), attrs={'_ip': None, '_listenport': None}, DELAY=10*60)
 
-    def _bandwidth_tick_doq_loop(self):
-        pyutilasync.selector.add_task(self._throttlerout.used, args=(0,))
-        pyutilasync.selector.add_task(self._throttlerin.used, args=(0,))
-        DoQ.doq.add_task(self._bandwidth_tick_doq_loop, delay=60)
+    def _make_connection_throttlers(self):
+        """
+        If `TCP_MAX_KILOBITS_PER_SECOND_OUT_PER_CONNECTION' (or `..._IN_...') is set then each
+        connection gets its own throttler, underneath the overall one, so that no one
+        counterparty can use up all of the bandwidth.
+
+        @returns a tuple of (throttlerin, throttlerout,) for a new TCPConnection
+        """
+        result = []
+        for (throttler, kbpsname,) in ((self._throttlerin, 'TCP_MAX_KILOBITS_PER_SECOND_IN_PER_CONNECTION',), (self._throttlerout, 'TCP_MAX_KILOBITS_PER_SECOND_OUT_PER_CONNECTION',),):
+            kbps = confman.get(kbpsname)
+            if kbps:
+                throttler = BandwidthThrottler.TokenBucketThrottler(throttle=true, Kbps=mojoutil.longpopL(kbps), parent=throttler)
+            result.append(throttler)
+        return tuple(result)
 
     def shutdown(self):
         self._throttlerin.unregister(self._throttle, self._unthrottle)
@@ -373,7 +384,8 @@ class TCPCommsHandler(asyncore.dispatcher, LazySaver.LazySaver):
             tcpc = cs.asyncsock
             tcpc._upward_inmsg_handler=self._inmsg_handler
         elif cs.host and cs.port:
-            tcpc = TCPConnection.TCPConnection(inmsg_handler_func=self._inmsg_handler, close_handler_func=self._close_handler, key=counterparty_id, host=cs.host, port=cs.port, commstratobj=cs, throttlerin=self._throttlerin, throttlerout=self._throttlerout, cid_for_debugging=counterparty_id)
+            (throttlerin, throttlerout,) = self._make_connection_throttlers()
+            tcpc = TCPConnection.TCPConnection(inmsg_handler_func=self._inmsg_handler, close_handler_func=self._close_handler, key=counterparty_id, host=cs.host, port=cs.port, commstratobj=cs, throttlerin=throttlerin, throttlerout=throttlerout, cid_for_debugging=counterparty_id)
             cs.asyncsock = tcpc
         else:
             return # can't use this comm strat -- this problem will be discovered momentarily when someone tries to send a message  --Zooko 2000-09-26
@@ -441,7 +453,8 @@ class TCPCommsHandler(asyncore.dispatcher, LazySaver.LazySaver):
         while hasattr(sock, 'socket'):
             # unwrap it from asyncore because we're about to wrap it in asyncore
             sock = sock.socket
-        tcpc = TCPConnection.TCPConnection(inmsg_handler_func=self._inmsg_handler, close_handler_func=self._close_handler, key=key, sock=sock, throttlerin=self._throttlerin, throttlerout=self._throttlerout)
+        (throttlerin, throttlerout,) = self._make_connection_throttlers()
+        tcpc = TCPConnection.TCPConnection(inmsg_handler_func=self._inmsg_handler, close_handler_func=self._close_handler, key=key, sock=sock, throttlerin=throttlerin, throttlerout=throttlerout)
         pn = None
         try:
             pn = tcpc.getpeername()
@@ -497,6 +510,12 @@ class TCPCommsHandler(asyncore.dispatcher, LazySaver.LazySaver):
         #     debugprint("TCPCommsHandler: asyncore log: " + message + "\n", v=7, vs="commstrats")
 
 
+def _getpeername_or_none(tcpc):
+    try:
+        return tcpc.getpeername()
+    except:
+        return None
+
 # XXX multithreading issues>  --Zooko 2001-10-04
 class TCPConnCache(Cache.SimpleCache):
     """
@@ -612,172 +631,108 @@ class TCPConnCache(Cache.SimpleCache):
             connections that are currently busy (they all return `true' from
             `TCPConnection.is_busy()').
 
-        XXX Note: this might be a slow method when there are many (?? how many?) connections
-        because it does a lot of sorting in order to choose the very best connections to keep.
-        This could probably be sped-up but it probably wouldn't be a win since N is normally so
-        low. In fact, one solution if this turns out to be slow when there are many connections
-        is just to turn down TCP_MAX_CONNECTIONS to be small enough that this is fast!  :-)
-        --Zooko 2000-08-15
+        This makes one pass over the connections to sort them into "probably keep" (busy, or
+        waiting for a response) and "maybe keep" (expecting more transactions, or just not idle
+        yet) and to remove the losers, and then sorts each of the two lists once in order to
+        choose which ones to keep.  So it is O(N log N) in the number of connections.
 
         @precondition This method must be called on the DoQ.: DoQ.doq.is_currently_doq()
         """
         assert DoQ.doq.is_currently_doq(), "precondition: This method must be called on the DoQ."
 
-        def cmpmaybs(tupa, tupb, self=self):
-            (ka, tcpa) = tupa
-            (kb, tcpb) = tupb
-            return -1 * cmp(tcpa._inmsgs, tcpb._inmsgs)
-
-        def cmpprobs(tupa, tupb, self=self):
-            tcp_timeout = int(confman.get('TCP_TIMEOUT', 60))
-            (ka, tcpa) = tupa
-            (kb, tcpb) = tupb
-            if tcpa.is_busy(tcp_timeout):
-                if tcpb.is_busy(tcp_timeout):
-                    # Both are in the middle of something.
-                    return -1 * cmp(tcpa._last_io_time, tcpb._last_io_time) # highest (most recent) io_time first
-                else:
-                    # tcpa is in the middle of something so it goes first.
-                    return -1
-            else:
-                if tcpb.is_busy(tcp_timeout):
-                    # tcpb is in the middle of something so it goes first.
-                    return 1
-
-            # Neither are in the middle of something.
-            return -1 * cmp(tcpa._last_io_time, tcpb._last_io_time) # highest (most recent) io_time first
-
         try:
             # debugprint("TCPConnCache._cleanup(): starting... self: %s, MAINT: %s, MAX: %s, len(self): %s\n", args=(self, confman.get('TCP_MAINTAINED_CONNECTIONS', '5'), confman.get('TCP_MAX_CONNECTIONS', '50'), len(self)), v=6, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
 
-            now = time.time()
+            tcp_timeout = long(confman.get('TCP_TIMEOUT', '60'))
+            nummaintainedconns = long(confman.get('TCP_MAINTAINED_CONNECTIONS', '5'))
 
-            # "maintain" connections, sorted with most frequently used first;  This list never
-            # exceeds nummaintainedconns, and it is the first to go if we approach maxconns.
+            # "maintain" connections, as tuples of (-_inmsgs, k, tcpc) so that sorting puts
+            # the most frequently used first;  These are the first to go if we approach
+            # maxconns.
             listomaybes = []
-            # busy and "expect response" connections, sorted so that the best bets are first;
-            # This list never exceeds maxconns.
+            # busy and "expect response" connections, as tuples of (notbusy, -_last_io_time,
+            # k, tcpc) so that sorting puts the best bets first: active connections with
+            # half-finished messages and recent activity, with the most recent network
+            # activity first, and then the others with the most recent network activity
+            # first.
             listoprobablies = []
 
-            def addtomaybes(k, tcpc, self=self, listomaybes=listomaybes, listoprobablies=listoprobablies, cmpmaybs=cmpmaybs, maxconns=maxconns):
-                listomaybes.append((k, tcpc))
-                # Sort the maybes with the most-used at the front of the list.
-                listomaybes.sort(cmpmaybs)
-                # If adding this put us over the limit...
-                # We can have only this many maybes:
-                cutoff = min(long(confman.get('TCP_MAINTAINED_CONNECTIONS', '5')), maxconns - len(listoprobablies))
-                if (cutoff >= 0) and (len(listomaybes) > cutoff):
-                    assert (cutoff + 1) == len(listomaybes), "internal error -- the listomaybes should be checked at each insert and never allowed to grow over limit."
-                    (k, tcpc) = listomaybes.pop(cutoff)
-                    assert cutoff == len(listomaybes)
-                    pn = None
-                    try:
-                        pn = tcpc.getpeername()
-                    except:
-                        pass
-
-                    if cutoff == (maxconns - len(listoprobablies)):
-                        debugprint("TCPConnCache._cleanup(): removing connection %s _cid_for_debugging: %s, .getpeername(): %s, which I 'maybe' wanted due to too many total connections.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=5, vs="comm hints")
-                    else:
-                        debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, which I 'maybe' wanted due to too many maintained connections.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=5, vs="comm hints")
-                    self.remove(k)
-
-            def addtoprobablies(k, tcpc, self=self, listomaybes=listomaybes, listoprobablies=listoprobablies, cmpprobs=cmpprobs, maxconns=maxconns):
-                listoprobablies.append((k, tcpc))
-                # Sort the probablies with the best at the front of the list.
-                # First: active connections with half-finished messages and recent activity,
-                # sorted with most recent network activity first.
-                # Second: "expect response" connections sorted with most-frequently-used first.
-                listoprobablies.sort(cmpprobs)
-                # We can only have this many probablies:
-                cutoff = maxconns
-                if (cutoff >= 0) and (len(listoprobablies) > cutoff):
-                    assert (cutoff + 1) == len(listoprobablies), "internal error -- the listoprobablies should be checked at each insert and never allowed to grow over limit."
-                    (k, tcpc) = listoprobablies.pop(cutoff)
-                    assert cutoff == len(listoprobablies)
-                    # If we are about to kill a busy connection then don't do it and instead return `false'.
-                    if tcpc.is_busy(long(confman.get('TCP_TIMEOUT', '60'))):
-                        return false # failure
-                    pn = None
-                    try:
-                        pn = tcpc.getpeername()
-                    except:
-                        pass
-
-                    debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, which I 'probably' wanted due to too many total connections.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=3, vs="comm hints")
-                    self.remove(k)
-
-                # We can only have this many maybes:
-                cutoff = min(long(confman.get('TCP_MAINTAINED_CONNECTIONS', '5')), maxconns - len(listoprobablies))
-                if (cutoff >= 0) and (len(listomaybes) > cutoff):
-                    assert (cutoff + 1) == len(listomaybes), "internal error -- the listomaybes should be checked at each insert and never allowed to grow over limit."
-                    (k, tcpc) = listomaybes.pop(cutoff)
-                    assert cutoff == len(listomaybes)
-                    pn = None
-                    try:
-                        pn = tcpc.getpeername()
-                    except:
-                        pass
-
-                    debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, due to too many maintained connections.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=5, vs="comm hints")
-                    self.remove(k)
-
-
             for (k, tcpc) in self._dict.items():
-                pn = None
-                try:
-                    pn = tcpc.getpeername()
-                except:
-                    pass
-
                 cs = self._cid_to_cs.get(k)
                 if cs:
                     hint = cs.hint
 
-                    # debugprint("TCPConnCache._cleanup(): examining connection %s._cid_for_debugging: %s, .getpeername(): %s -- hint: %s, hintnumexpectedresponses: %s, hintnumexpectedsends: %s.\n", args=(tcpc, tcpc._cid_for_debugging, pn, hint, cs.hintnumexpectedresponses, cs.hintnumexpectedsends), v=7, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
+                    # debugprint("TCPConnCache._cleanup(): examining connection %s._cid_for_debugging: %s -- hint: %s, hintnumexpectedresponses: %s, hintnumexpectedsends: %s.\n", args=(tcpc, tcpc._cid_for_debugging, hint, cs.hintnumexpectedresponses, cs.hintnumexpectedsends), v=7, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
                 else:
                     hint = HINT_NO_HINT   # we didn't have a CommStrat for k, no hint available
 
                 # Remove it if it is closing.
                 if tcpc._closing:
-                    # debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, because it has been closed.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=6, vs="comm hints")
+                    # debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, because it has been closed.\n", args=(tcpc, tcpc._cid_for_debugging), v=6, vs="comm hints")
                     self.remove(k)
                     continue
 
                 # Leave it alone if it is busy.
-                if tcpc.is_busy(long(confman.get('TCP_TIMEOUT', '60'))):
-                    # debugprint("TCPConnCache._cleanup(): keeping connection %s._cid_for_debugging: %s, .getpeername(): %s probably: it is busy.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=7, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
-
-                    addtoprobablies(k, tcpc)
+                if tcpc.is_busy(tcp_timeout):
+                    # debugprint("TCPConnCache._cleanup(): keeping connection %s._cid_for_debugging: %s probably: it is busy.\n", args=(tcpc, tcpc._cid_for_debugging), v=7, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
+                    listoprobablies.append((0, -tcpc._last_io_time, k, tcpc,))
                     continue
 
                 if (hint & HINT_EXPECT_RESPONSE) or (hint & HINT_EXPECT_TO_RESPOND):
                     # We're waiting for a response.  This one is a definite keeper.
-                    # debugprint("TCPConnCache._cleanup(): keeping connection %s._cid_for_debugging: %s, .getpeername(): %s probably: waiting for response.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=7, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
-
-                    addtoprobablies(k, tcpc)
+                    # debugprint("TCPConnCache._cleanup(): keeping connection %s._cid_for_debugging: %s probably: waiting for response.\n", args=(tcpc, tcpc._cid_for_debugging), v=7, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
+                    listoprobablies.append((1, -tcpc._last_io_time, k, tcpc,))
                     continue
                 if hint & HINT_EXPECT_NO_MORE_COMMS:
                     # loser
-                    debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, due to HINT_EXPECT_NO_MORE_COMMS.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=5, vs="comm hints")
+                    debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, due to HINT_EXPECT_NO_MORE_COMMS.\n", args=(tcpc, tcpc._cid_for_debugging, _getpeername_or_none(tcpc)), v=5, vs="comm hints")
                     self.remove(k)
                     continue
                 if hint & HINT_EXPECT_MORE_TRANSACTIONS:
-                    # debugprint("TCPConnCache._cleanup(): keeping connection %s._cid_for_debugging: %s, .getpeername(): %s maybe: expect more transactions.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=7, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
-                    addtomaybes(k, tcpc)
+                    # debugprint("TCPConnCache._cleanup(): keeping connection %s._cid_for_debugging: %s maybe: expect more transactions.\n", args=(tcpc, tcpc._cid_for_debugging), v=7, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
+                    listomaybes.append((-tcpc._inmsgs, k, tcpc,))
                     continue
 
                 # If we have no better clue to go on, then just time it out if it is old.
-                if tcpc.is_idle(long(confman.get('TCP_TIMEOUT', '60'))):
-                    debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, due to idleness.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=5, vs="comm hints")
+                if tcpc.is_idle(tcp_timeout):
+                    debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, due to idleness.\n", args=(tcpc, tcpc._cid_for_debugging, _getpeername_or_none(tcpc)), v=5, vs="comm hints")
                     self.remove(k)
                 else:
-                    # debugprint("TCPConnCache._cleanup(): keeping connection %s._cid_for_debugging: %s, .getpeername(): %s maybe: it isn't idle.\n", args=(tcpc, tcpc._cid_for_debugging, pn), v=8, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
-                    pass
-
-                    addtomaybes(k, tcpc)
+                    # debugprint("TCPConnCache._cleanup(): keeping connection %s._cid_for_debugging: %s maybe: it isn't idle.\n", args=(tcpc, tcpc._cid_for_debugging), v=8, vs="comm hints") ### for faster operation, comment this line out.  --Zooko 2000-12-11
+                    listomaybes.append((-tcpc._inmsgs, k, tcpc,))
+
+            success = true
+
+            # We can only have this many probablies:
+            if (maxconns >= 0) and (len(listoprobablies) > maxconns):
+                listoprobablies.sort()
+                numkept = maxconns
+                for (notbusy, negiotime, k, tcpc,) in listoprobablies[maxconns:]:
+                    # If we are about to kill a busy connection then don't do it, and instead
+                    # return `false'.
+                    if not notbusy:
+                        numkept = numkept + 1
+                        success = false
+                        continue
+                    debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, which I 'probably' wanted due to too many total connections.\n", args=(tcpc, tcpc._cid_for_debugging, _getpeername_or_none(tcpc)), v=3, vs="comm hints")
+                    self.remove(k)
+            else:
+                numkept = len(listoprobablies)
+
+            # We can only have this many maybes:
+            # (Busy connections that we couldn't remove may have used up more than all of the
+            # room, in which case none of the maybes get to stay.)
+            cutoff = max(0, min(nummaintainedconns, maxconns - numkept))
+            if (maxconns >= 0) and (len(listomaybes) > cutoff):
+                listomaybes.sort()
+                for (neginmsgs, k, tcpc,) in listomaybes[cutoff:]:
+                    if cutoff >= (maxconns - numkept):
+                        debugprint("TCPConnCache._cleanup(): removing connection %s _cid_for_debugging: %s, .getpeername(): %s, which I 'maybe' wanted due to too many total connections.\n", args=(tcpc, tcpc._cid_for_debugging, _getpeername_or_none(tcpc)), v=5, vs="comm hints")
+                    else:
+                        debugprint("TCPConnCache._cleanup(): removing connection %s._cid_for_debugging: %s, .getpeername(): %s, which I 'maybe' wanted due to too many maintained connections.\n", args=(tcpc, tcpc._cid_for_debugging, _getpeername_or_none(tcpc)), v=5, vs="comm hints")
+                    self.remove(k)
 
-            return true # success
+            return success
         finally:
             self._timelastcleaned = time.time()
             # debugprint("TCPConnCache._cleanup(): finishing.  len(self): %s\n", args=(len(self),), v=7, vs="comm hints") ## verbose connection caching diags ### for faster operation, comment this line out.  --Zooko 2000-12-11
@@ -793,6 +748,103 @@ class TCPConnCache(Cache.SimpleCache):
         self._nice_cleanup_result = self._cleanup(long(confman.get('TCP_MAX_CONNECTIONS', '50')))
         return self._nice_cleanup_result
 
+class _FakeTCPConnection:
+    """
+    Just enough of a TCPConnection for TCPConnCache._cleanup().
+    """
+    def __init__(self, key, busy=false, idle=false, inmsgs=0, last_io_time=0):
+        self._key = key
+        self._cid_for_debugging = key
+        self._closing = false
+        self._busy = busy
+        self._idle = idle
+        self._inmsgs = inmsgs
+        self._last_io_time = last_io_time
+    def is_busy(self, idletimeout):
+        return self._busy
+    def is_idle(self, idletimeout):
+        return self._idle
+    def getpeername(self):
+        return ('127.0.0.1', 0,)
+    def close(self, reason=None):
+        self._closing = true
+
+def _help_make_conncache(conns, hints={}):
+    cid_to_cs = {}
+    for (k, hint,) in hints.items():
+        cs = CommStrat.CommStrat()
+        cs.hint = hint
+        cid_to_cs[k] = cs
+    cc = TCPConnCache(cid_to_cs=cid_to_cs)
+    for tcpc in conns:
+        # Bypass `TCPConnCache.insert()', which wants real TCPConnections and does its own cleanups.
+        Cache.SimpleCache.insert(cc, tcpc._key, tcpc)
+    return cc
+
+def _help_run_on_doq(func, args=()):
+    results = []
+    def f(func=func, args=args, results=results):
+        results.append(apply(func, args))
+    DoQ.doq.add_task(f)
+    DoQ.doq.flush()
+    assert len(results) == 1
+    return results[0]
+
+def test_cleanup_keeps_the_best():
+    conns = []
+    for i in range(3):
+        conns.append(_FakeTCPConnection('busy%d' % i, busy=true, last_io_time=i))
+    for i in range(2):
+        conns.append(_FakeTCPConnection('waiting%d' % i, last_io_time=i))
+    for i in range(4):
+        conns.append(_FakeTCPConnection('maybe%d' % i, inmsgs=i))
+    conns.append(_FakeTCPConnection('idle', idle=true, inmsgs=100))
+    closing = _FakeTCPConnection('closing', inmsgs=100)
+    closing._closing = true
+    conns.append(closing)
+    cc = _help_make_conncache(conns, hints={'waiting0': HINT_EXPECT_RESPONSE, 'waiting1': HINT_EXPECT_TO_RESPOND})
+
+    # The 3 busy and 2 waiting ones are "probably"s, which leaves room for only 1 of the "maybe"s: the most used one.
+    assert _help_run_on_doq(cc._cleanup, args=(6,))
+    keys = cc._dict.keys()
+    keys.sort()
+    assert keys == ['busy0', 'busy1', 'busy2', 'maybe3', 'waiting0', 'waiting1'], "keys: %s" % hr(keys)
+
+    # Now only the busy ones can stay, and they can't all stay.
+    assert not _help_run_on_doq(cc._cleanup, args=(2,))
+    keys = cc._dict.keys()
+    keys.sort()
+    assert keys == ['busy0', 'busy1', 'busy2'], "keys: %s" % hr(keys)
+
+def _help_make_many_conns(n):
+    conns = []
+    for i in xrange(n):
+        if i % 3 == 0:
+            conns.append(_FakeTCPConnection('conn%d' % i, busy=true, last_io_time=i))
+        else:
+            conns.append(_FakeTCPConnection('conn%d' % i, inmsgs=i % 97, last_io_time=i))
+    return conns
+
+def _bench_it_conncache_cleanup(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    cc = _help_make_conncache(_help_make_many_conns(n))
+    _help_run_on_doq(cc._cleanup, args=(n / 2,))
+
+def _profile_test_conncache_cleanup_speed():
+    import mojoutil
+    profit = mojoutil._dont_enable_if_you_want_speed_profit
+    profit(_real_test_conncache_cleanup_speed)
+
+def _real_test_conncache_cleanup_speed():
+    for n in (50, 100, 500, 1000, 5000, 10000,):
+        cc = _help_make_conncache(_help_make_many_conns(n))
+        t1 = time.time()
+        _help_run_on_doq(cc._cleanup, args=(n / 2,))
+        t2 = time.time()
+        print '%5d connections: %3.3f seconds' % (n, t2 - t1,)
+
 # Generic stuff
 NAME_OF_THIS_MODULE="TCPCommsHandler"
 
@@ -7,7 +7,7 @@
 #
 
 # standard Python modules
-import asyncore, socket, struct, sys, threading, time, traceback, types
+import asyncore, socket, string, struct, sys, threading, time, traceback, types
 
 # pyutil modules
 import DoQ
@@ -32,6 +32,68 @@ false = None
 # will cause a fast fail.
 MAXIMUM_MSG_SIZE = 4*(2**20) # 4 megabytes
 
+# Outgoing messages smaller than this are coalesced (along with their length-prefixes) into
+# batches of up to this many bytes, so that one `send()' can carry several of them.  Larger
+# messages are sent from the caller's string without copying, except for the first
+# `SEND_BATCH_SIZE' bytes which are joined to the length-prefix.
+SEND_BATCH_SIZE = 2**16
+
+# Messages of at least `SEND_BATCH_SIZE' bytes wait in a separate "bulk" queue, so that a big
+# message doesn't hold up the small (typically control or interactive) messages queued after
+# it.  When both queues have messages waiting, this many batches of small messages are sent
+# for each bulk message.
+SMALL_BATCHES_PER_BULK_MESSAGE = 4
+
+def _popbytes(inbufq, offset, num, join=string.join):
+    """
+    Removes the first `num' unconsumed bytes from the queue of received strings `inbufq' and
+    returns them along with the new offset into `inbufq[0]'.  Strings that are used up are
+    deleted from `inbufq' (in place).  A string which is exactly the wanted bytes is returned
+    without copying, and a wanted range which is spread across several strings is copied once,
+    by a single `join()' -- never by repeated concatenation.
+
+    @param offset the number of already-consumed bytes at the beginning of `inbufq[0]'
+
+    @return (str, newoffset,)
+
+    @precondition `num' must be positive.: num > 0: "num: %s" % humanreadable.hr(num)
+    @precondition `inbufq' must contain at least `num' unconsumed bytes.: len(inbufq) > 0
+    """
+    assert num > 0, "precondition: `num' must be positive." + " -- " + "num: %s" % humanreadable.hr(num)
+    assert len(inbufq) > 0, "precondition: `inbufq' must contain at least `num' unconsumed bytes."
+
+    first = inbufq[0]
+    lenfirst = len(first)
+    end = offset + num
+    if end < lenfirst:
+        return (first[offset:end], end,)
+    if end == lenfirst:
+        del inbufq[0]
+        if offset == 0:
+            return (first, 0,)
+        return (first[offset:], 0,)
+
+    # The wanted bytes are spread across more than one string.
+    if offset == 0:
+        pieces = [first]
+    else:
+        pieces = [first[offset:]]
+    remain = end - lenfirst
+    i = 1
+    while true:
+        chunk = inbufq[i]
+        lenchunk = len(chunk)
+        if lenchunk > remain:
+            pieces.append(chunk[:remain])
+            del inbufq[:i]
+            return (join(pieces, ''), remain,)
+        pieces.append(chunk)
+        remain = remain - lenchunk
+        i = i + 1
+        if remain == 0:
+            del inbufq[:i]
+            return (join(pieces, ''), 0,)
+
 class TCPConnection(asyncore.dispatcher):
     """
     Sends and receives buffers on TCP connections.  Prepends lengths for each message.
@@ -68,14 +130,18 @@ class TCPConnection(asyncore.dispatcher):
         self._readthrottled = false
         self._writethrottled = false
 
-        self._inbufq = [] # this is a list of strings
+        self._inbufq = [] # this is a list of strings, exactly as they were received
         self._inbuflen = 0 # the current aggregate unconsumed bytes in inbufq (there can be leading byte in inbufq[0] which have already been consumed and are not counted by inbuflen)
-        self._nextinmsglen = None # the length of the next incoming msg or `None' if unknown
-        self._offset = 0 # the index of the beginning of the length-prefix of the next message (when there is no next message, `_offset' is 0)
+        self._nextinmsglen = None # the length of the next incoming msg or `None' if its length-prefix hasn't been received yet (once it is known the length-prefix has been consumed)
+        self._offset = 0 # the number of already-consumed bytes at the beginning of inbufq[0] (when inbufq is empty, `_offset' is 0)
 
-        self._outmsgq = [] # contains (msg, fast_fail_handler_func) # for all subsequent outgoing messages that haven't begun sending yet
-        self._outbuf = '' # the not-yet-sent part of the current outgoing message
-        self._current_fast_fail_handler = None # the ffh for the current outgoing message
+        self._outmsgq = [] # contains (lengthprefix, msg, fast_fail_handler_func) # for all subsequent outgoing messages smaller than `SEND_BATCH_SIZE' that haven't begun sending yet
+        self._outbulkq = [] # contains (lengthprefix, msg, fast_fail_handler_func) # for all subsequent outgoing messages of `SEND_BATCH_SIZE' or more that haven't begun sending yet
+        self._smallbatchessincebulk = 0 # the number of batches loaded from `_outmsgq' since the last one from `_outbulkq'
+        self._outbufs = [] # the strings (or buffers) making up the not-completely-sent part of the current outgoing batch of messages
+        self._outoffset = 0 # the number of bytes of `_outbufs[0]' which have already been sent
+        self._outbatchleft = 0 # the aggregate not-yet-sent bytes in `_outbufs'
+        self._outbatchffhs = [] # contains (bytesleftwhensent, fast_fail_handler_func) for each not-completely-sent message in the current batch; the message has been completely sent once `_outbatchleft' <= `bytesleftwhensent'
 
         if sock:
             self._everconnected = true  # we're already connected
@@ -200,7 +266,7 @@ class TCPConnection(asyncore.dispatcher):
 
         self._writethrottled = None # `false'
         # Now if we are not closing, and if there is data waiting to be sent, then we are ready to write.
-        if not self._closing and (self._outbuf or self._outmsgq) and not self._writable:
+        if not self._closing and (self._outbufs or self._outmsgq or self._outbulkq) and not self._writable:
             self._writable = 1 # `true'
 
     def send(self, msg, fast_fail_handler=None, pack=struct.pack):
@@ -221,12 +287,12 @@ class TCPConnection(asyncore.dispatcher):
                 DoQ.doq.add_task(fast_fail_handler, kwargs={'failure_reason': "message too long: %s" % humanreadable.hr(lenmsg)})
             return
 
-        # TODO this is gross, it does a full data copy of the message just to prepend 4 bytes
-        # (send should ideally accept buffer chains instead of a single string messages)
-        # (this is not such a big deal as we're already spending many more cycles to encrypt every message)
-        str = pack('>L', lenmsg) + msg
-
-        self._outmsgq.append((str, fast_fail_handler,))
+        # The length-prefix is kept separate from the message; `_load_next_batch()' decides how
+        # to put them together.
+        if lenmsg >= SEND_BATCH_SIZE:
+            self._outbulkq.append((pack('>L', lenmsg), msg, fast_fail_handler,))
+        else:
+            self._outmsgq.append((pack('>L', lenmsg), msg, fast_fail_handler,))
         # Now if we are not closing, and not write-throttled, then we are now ready to write.
         # (Note that it is possible for us to be closing now even though we tested just a few lines up because we are operating on the DoQ thread here and the asyncore thread can cause us to become closing.)
         if not self._closing and not self._writethrottled and not self._writable:
@@ -247,7 +313,7 @@ class TCPConnection(asyncore.dispatcher):
         """
         @returns `true' if and only if there is a message actually half-sent or half-received
         """
-        return (len(self._outbuf) > 0) or (self._inbuflen > 0) or (len(self._outmsgq) > 0)
+        return (self._outbatchleft > 0) or (self._inbuflen > 0) or (self._nextinmsglen is not None) or (len(self._outmsgq) > 0) or (len(self._outbulkq) > 0)
 
     def is_busy(self, idletimeout):
         """
@@ -325,26 +391,28 @@ class TCPConnection(asyncore.dispatcher):
         else:
             connection_refused = None
 
-        # Fail any partially sent message:
+        # Fail any partially sent messages:
         # debugprint("%s.close(): about to Fail any partially sent message...\n", args=(self,))
-        if (len(self._outbuf) > 0) and (self._current_fast_fail_handler):
-            if hasattr(self, '_fast_fail_reason'):
-                self._current_fast_fail_handler(failure_reason="TCPConnection: "+self._fast_fail_reason, bad_commstrat=self._commstratobj)
-            elif connection_refused:
-                self._current_fast_fail_handler(failure_reason="TCPConnection: connection refused", bad_commstrat=self._commstratobj)
-            else:
-                self._current_fast_fail_handler(failure_reason="TCPConnection: closed before message was sent")
+        for (bytesleftwhensent, ffh,) in self._outbatchffhs:
+            if ffh:
+                if hasattr(self, '_fast_fail_reason'):
+                    ffh(failure_reason="TCPConnection: "+self._fast_fail_reason, bad_commstrat=self._commstratobj)
+                elif connection_refused:
+                    ffh(failure_reason="TCPConnection: connection refused", bad_commstrat=self._commstratobj)
+                else:
+                    ffh(failure_reason="TCPConnection: closed before message was sent")
         # debugprint("%s.close(): done with Fail any partially sent message\n", args=(self,))
 
         # debugprint("%s.close(): about to Fail any queued messages...\n", args=(self,))
         # Now fail any queued messages.
-        while len(self._outmsgq) > 0:
-            (str, ffh) = self._outmsgq.pop(0)
+        for (lengthprefix, msg, ffh,) in self._outmsgq + self._outbulkq:
             if ffh:
                 if connection_refused:
                     ffh(failure_reason="TCPConnection: connection refused", bad_commstrat=self._commstratobj)
                 else:
                     ffh(failure_reason="TCPConnection: cannot send message")
+        self._outmsgq = []
+        self._outbulkq = []
 
         # send the event out to the TCPCommsHandler
         self._close_handler_func(self)
@@ -358,7 +426,7 @@ class TCPConnection(asyncore.dispatcher):
 
         # remove no longer needed function references
         self._upward_inmsg_handler = None
-        self._current_fast_fail_handler = None
+        self._outbatchffhs = []
         self._close_handler_func = None
 
         # remove no longer needed object references
@@ -367,28 +435,100 @@ class TCPConnection(asyncore.dispatcher):
         self._throttlerwrite = None
 
         # empty our buffers
-        self._outbuf = ''
+        self._outbufs = []
+        self._outoffset = 0
+        self._outbatchleft = 0
         self._inbufq = []
         self._inbuflen = 0
         self._nextinmsglen = None
+        self._offset = 0
 
         self._closed = true
 
+    def _load_next_batch(self, join=string.join):
+        """
+        Makes the next outgoing batch: either the next bulk message from `_outbulkq', or the
+        next several small messages from `_outmsgq'.  Small messages are joined together with
+        their length-prefixes into a single string of at most `SEND_BATCH_SIZE' bytes, so that
+        a single `send()' can write all of them.  A bulk message makes up a batch by itself and
+        is not copied, except for its first `SEND_BATCH_SIZE' bytes.
+
+        Small messages go first, but when bulk messages are waiting too then one of them gets
+        its turn after every `SMALL_BATCHES_PER_BULK_MESSAGE' batches of small messages.
+
+        @precondition There must be no current batch.: len(self._outbufs) == 0
+        @precondition There must be a message waiting to be sent.: (len(self._outmsgq) > 0) or (len(self._outbulkq) > 0)
+        """
+        assert len(self._outbufs) == 0, "precondition: There must be no current batch."
+        assert (len(self._outmsgq) > 0) or (len(self._outbulkq) > 0), "precondition: There must be a message waiting to be sent."
+
+        outmsgq = self._outmsgq
+        if self._outbulkq and ((not outmsgq) or (self._smallbatchessincebulk >= SMALL_BATCHES_PER_BULK_MESSAGE)):
+            (lengthprefix, msg, ffh,) = self._outbulkq[0]
+            del self._outbulkq[0]
+            lenmsg = len(msg)
+            self._outbufs = [lengthprefix + msg[:SEND_BATCH_SIZE]]
+            if lenmsg > SEND_BATCH_SIZE:
+                self._outbufs.append(buffer(msg, SEND_BATCH_SIZE))
+            self._outbatchleft = 4 + lenmsg
+            self._outbatchffhs = [(0, ffh,)]
+            self._smallbatchessincebulk = 0
+            return
+
+        self._smallbatchessincebulk = self._smallbatchessincebulk + 1
+
+        pieces = []
+        ends = []
+        total = 0
+        i = 0
+        lenoutmsgq = len(outmsgq)
+        while i < lenoutmsgq:
+            (lengthprefix, msg, ffh,) = outmsgq[i]
+            lenmsg = len(msg)
+            if (i > 0) and (total + 4 + lenmsg > SEND_BATCH_SIZE):
+                break
+            pieces.append(lengthprefix)
+            pieces.append(msg)
+            total = total + 4 + lenmsg
+            ends.append((total, ffh,))
+            i = i + 1
+        del outmsgq[:i]
+
+        self._outbufs = [join(pieces, '')]
+        self._outbatchleft = total
+        self._outbatchffhs = []
+        for (end, ffh,) in ends:
+            self._outbatchffhs.append((total - end, ffh,))
+
     def handle_write(self):
         if self._closing:
             return
 
         self._last_io_time = time.time()
 
-        # load up the next message if any.
-        if (len(self._outbuf) == 0) and (len(self._outmsgq) > 0):
-            (str, ffh) = self._outmsgq.pop(0)
-            self._current_fast_fail_handler = ffh
-            self._outbuf = str
+        # load up the next batch of messages if any.
+        if (len(self._outbufs) == 0) and (self._outmsgq or self._outbulkq):
+            self._load_next_batch()
 
-        if len(self._outbuf) > 0:
+        if len(self._outbufs) > 0:
+            outbuf = self._outbufs[0]
+            outoffset = self._outoffset
+            allowance = None
+            if self._throttlerwrite:
+                allowance = self._throttlerwrite.allowance()
+                if allowance == 0:
+                    # Wait for the throttler to unthrottle us along with the others.
+                    self._throttle_write()
+                    return
             try:
-                num_sent = asyncore.dispatcher.send(self, self._outbuf)
+                if (allowance is not None) and (allowance < (len(outbuf) - outoffset)):
+                    # Send only our share of the bandwidth.
+                    num_sent = asyncore.dispatcher.send(self, buffer(outbuf, outoffset, allowance))
+                elif outoffset == 0:
+                    num_sent = asyncore.dispatcher.send(self, outbuf)
+                else:
+                    # Send from a buffer object instead of slicing, so that the unsent remainder doesn't get copied after every partial send.
+                    num_sent = asyncore.dispatcher.send(self, buffer(outbuf, outoffset))
                 # debugprint("%s.handle_write(): sent [%s] bytes\n", args=(self, num_sent), v=9, vs="commstrats") ### for faster operation, comment this line out.  --Zooko 2000-12-11
             except socket.error, le:
                 # debugprint("%s.handle_write(): got exception: %s\n", args=(self, le,), v=6, vs="commstrats")
@@ -396,11 +536,23 @@ class TCPConnection(asyncore.dispatcher):
                 return
 
             self._outbytes = self._outbytes + num_sent
-            self._outbuf = self._outbuf[num_sent:]
-            if len(self._outbuf) == 0:
-                self._current_fast_fail_handler = None   # remove the no longer needed function reference!
+            outoffset = outoffset + num_sent
+            if outoffset == len(outbuf):
+                del self._outbufs[0]
+                outoffset = 0
+            self._outoffset = outoffset
+
+            outbatchleft = self._outbatchleft - num_sent
+            self._outbatchleft = outbatchleft
+            outbatchffhs = self._outbatchffhs
+            # remove the no longer needed function references of messages that are now completely sent!
+            while outbatchffhs and (outbatchffhs[0][0] >= outbatchleft):
+                del outbatchffhs[0]
+
+            if len(self._outbufs) == 0:
+                assert outbatchleft == 0, "outbatchleft: %s" % humanreadable.hr(outbatchleft)
                 # Now if there are no more messages waiting to be sent, then we are no longer ready to write.
-                if not self._outmsgq:
+                if not (self._outmsgq or self._outbulkq):
                     self._writable = 0 # `false'
             if self._throttlerwrite:
                 self._throttlerwrite.used(num_sent) # notify throttler we just used up some bandwidth
@@ -411,8 +563,80 @@ class TCPConnection(asyncore.dispatcher):
     def readable(self):
         return self._readable
 
-    def _chunkify(self, nextstream, unpack=struct.unpack):
+    def _chunkify(self, nextstream, unpack=struct.unpack, popbytes=_popbytes):
+        """
+        Appends `nextstream' to the receive queue and sends upward every message which is now
+        complete.  `nextstream' is queued as-is, and the bytes of each message are gathered (by
+        `_popbytes()') only once the whole message has arrived, so the cost is linear in the
+        number of bytes received no matter how the peer's stream was split into reads.  (The
+        previous implementation, kept as `_chunkify_with_concatenation()' for comparison in
+        `_real_test_chunkify_speed()', was quadratic when a large message arrived in many small
+        pieces.)
+
+        @precondition `self._upward_inmsg_handler' must be callable.: callable(self._upward_inmsg_handler): "self._upward_inmsg_handler: %s :: %s" % (humanreadable.hr(self._upward_inmsg_handler), humanreadable.hr(type(self._upward_inmsg_handler)),)
+        """
+        assert callable(self._upward_inmsg_handler), "precondition: `self._upward_inmsg_handler' must be callable." + " -- " + "self._upward_inmsg_handler: %s :: %s" % (humanreadable.hr(self._upward_inmsg_handler), humanreadable.hr(type(self._upward_inmsg_handler)),)
+
+        assert (self._inbuflen == 0) or (len(self._inbufq) > 0), "self._inbuflen: %s, self._inbufq: %s" % (humanreadable.hr(self._inbuflen), humanreadable.hr(self._inbufq),)
+
+        lennextstream = len(nextstream)
+        if lennextstream == 0:
+            debugprint("warning %s._chunkify(%s): length 0\n", args=(self, nextstream,), v=0, vs="debug")
+            return
+
+        nextinmsglen = self._nextinmsglen
+        inbufq = self._inbufq
+        inbuflen = self._inbuflen + lennextstream
+        offset = self._offset
+
+        inbufq.append(nextstream)
+
+        while true:
+            if nextinmsglen is None:
+                if inbuflen < 4:
+                    break
+                (lenstr, offset,) = popbytes(inbufq, offset, 4)
+                inbuflen = inbuflen - 4
+                nextinmsglen = unpack('>L', lenstr)[0]
+                if nextinmsglen > MAXIMUM_MSG_SIZE:
+                    # Too big.
+                    debugprint("%s._chunkify(): killing due to overlarge msg size. nextinmsglen: %s, inbuflen:%s, offset: %s\n", args=(self, nextinmsglen, inbuflen, offset,), v=0, vs="debug")
+                    self.close(reason=("overlarge msg size", nextinmsglen,))
+                    return
+                nextinmsglen = int(nextinmsglen)
+                if DEBUG_MODE and nextinmsglen > (260 * 2**10):
+                    debugprint("%s._chunkify(): suspiciously large msg size. nextinmsglen: %s, inbuflen:%s, offset: %s\n", args=(self, nextinmsglen, inbuflen, offset,), v=0, vs="debug")
+
+            if inbuflen < nextinmsglen:
+                break
+
+            if nextinmsglen == 0:
+                msg = ''
+            else:
+                (msg, offset,) = popbytes(inbufq, offset, nextinmsglen)
+            inbuflen = inbuflen - nextinmsglen
+            nextinmsglen = None
+            assert (inbuflen == 0) == (len(inbufq) == 0), "inbuflen: %s, len(inbufq): %s" % (humanreadable.hr(inbuflen), humanreadable.hr(len(inbufq)),)
+
+            self._inmsgs = self._inmsgs + 1
+            self._nummsgs = self._nummsgs + 1
+
+            # debugprint("%s._chunkify(): got message of length: %s, msg: %s\n", args=(self, len(msg), msg,), v=6, vs="debug")
+            DoQ.doq.add_task(self._upward_inmsg_handler, args=(self, msg))
+
+        self._nextinmsglen = nextinmsglen
+        self._inbuflen = inbuflen
+        self._offset = offset
+        assert (self._inbuflen == 0) or (len(self._inbufq) > 0), "self._inbuflen: %s, self._inbufq: %s" % (humanreadable.hr(self._inbuflen), humanreadable.hr(self._inbufq),)
+
+    def _chunkify_with_concatenation(self, nextstream, unpack=struct.unpack):
         """
+        The old implementation of `_chunkify()', which builds each message by repeated string
+        concatenation.  It is no longer used for receiving; it is kept so that
+        `_real_test_chunkify_speed()' can compare the two.  It leaves the length-prefix of the
+        next message in `_inbufq', so don't mix calls to it with calls to `_chunkify()' on the
+        same TCPConnection.
+
         @precondition `self._upward_inmsg_handler' must be callable.: callable(self._upward_inmsg_handler): "self._upward_inmsg_handler: %s :: %s" % (humanreadable.hr(self._upward_inmsg_handler), humanreadable.hr(type(self._upward_inmsg_handler)),)
         """
         assert callable(self._upward_inmsg_handler), "precondition: `self._upward_inmsg_handler' must be callable." + " -- " + "self._upward_inmsg_handler: %s :: %s" % (humanreadable.hr(self._upward_inmsg_handler), humanreadable.hr(type(self._upward_inmsg_handler)),)
@@ -541,8 +765,17 @@ class TCPConnection(asyncore.dispatcher):
             return
 
         self._last_io_time = time.time()
+        readsize = 65536
+        if self._throttlerread:
+            allowance = self._throttlerread.allowance()
+            if allowance == 0:
+                # Wait for the throttler to unthrottle us along with the others.
+                self._throttle_read()
+                return
+            if allowance is not None:
+                readsize = min(readsize, allowance)
         try:
-            data = self.recv(65536)
+            data = self.recv(readsize)
             # debugprint("%s.handle_read(): received [%s] bytes\n", args=(self, len(data)), v=9, vs="commstrats") ### for faster operation, comment this line out.  --Zooko 2000-12-11
         except socket.error, le:
             # This is the socket's way of telling us that we are _closed_.
@@ -632,3 +865,203 @@ def test_chunkify():
     help_test(msgs, (15, 20, 30, 40, 50,))
     help_test(msgs, (15, 17, 23, 40, 50,))
 
+
+def _help_split_stream(str, splitter):
+    """
+    @param splitter a function which takes the number of bytes left and returns the size of the next read
+
+    @return a list of the pieces of `str', as though `str' had been received by reads of the sizes given by `splitter'
+    """
+    pieces = []
+    i = 0
+    while i < len(str):
+        n = max(1, min(splitter(len(str) - i), len(str) - i))
+        pieces.append(str[i:i+n])
+        i = i + n
+    return pieces
+
+def _help_make_stream(msgs, pack=struct.pack):
+    l = []
+    for msg in msgs:
+        l.append(pack('>L', len(msg)))
+        l.append(msg)
+    return string.join(l, '')
+
+def _help_parse_stream(str, unpack=struct.unpack):
+    msgs = []
+    i = 0
+    while i < len(str):
+        lenmsg = unpack('>L', str[i:i+4])[0]
+        msgs.append(str[i+4:i+4+lenmsg])
+        i = i + 4 + lenmsg
+    return msgs
+
+def test_chunkify_adversarial_splits():
+    import random
+    outputs = []
+    def inmsg(tcpc, msg, outputs=outputs):
+        outputs.append(msg)
+
+    msgs = ["", "a", "hellbo", "", "goodbyte" * 1000, "wheedle, wordling!", "x" * 70000, "",]
+    str = _help_make_stream(msgs)
+
+    for splitter in (lambda left: 1, lambda left: 3, lambda left: 5, lambda left: random.randrange(1, 20), lambda left: random.randrange(1, 70000), lambda left: left,):
+        t = TCPConnection(inmsg, idlib.new_random_uniq())
+        del outputs[:]
+        for piece in _help_split_stream(str, splitter):
+            t._chunkify(piece)
+        DoQ.doq.flush() # the upward inmsg push happens on the DoQ.
+        assert outputs == msgs, "outputs: %s" % humanreadable.hr(outputs)
+        assert t._inbufq == []
+        assert t._inbuflen == 0
+        assert t._nextinmsglen is None
+        assert not t.is_talking()
+
+def test_chunkify_half_received_length_prefix_is_talking():
+    def inmsg(tcpc, msg):
+        pass
+
+    t = TCPConnection(inmsg, idlib.new_random_uniq())
+    t._chunkify(struct.pack('>L', 5))
+    assert t.is_talking()
+    t._chunkify("hello")
+    DoQ.doq.flush()
+    assert not t.is_talking()
+
+class _FakeSocket:
+    """
+    Accepts at most `maxsend' bytes per `send()', and remembers them all.
+    """
+    def __init__(self, maxsend):
+        self.maxsend = maxsend
+        self.sent = []
+        self.numsends = 0
+    def send(self, data):
+        self.numsends = self.numsends + 1
+        n = min(self.maxsend, len(data))
+        self.sent.append(str(data[:n]))
+        return n
+    def close(self):
+        pass
+
+def test_send_batches_small_messages():
+    def inmsg(tcpc, msg):
+        pass
+    failures = []
+    def ffh(failures=failures, failure_reason=None, bad_commstrat=None):
+        failures.append(failure_reason)
+
+    msgs = ["hellbo", "", "goodbyte" * 1000, "x" * (SEND_BATCH_SIZE + 17), "wheedle, wordling!", "y" * SEND_BATCH_SIZE,] + ["spam"] * 1000
+    for maxsend in (1, 7, 4096, 2**20,):
+        t = TCPConnection(inmsg, idlib.new_random_uniq())
+        t.socket = _FakeSocket(maxsend)
+        for msg in msgs:
+            t.send(msg, ffh)
+        while t.writable():
+            t.handle_write()
+        # The two big ones wait in the bulk queue until the small ones have all been sent.
+        assert _help_parse_stream(string.join(t.socket.sent, '')) == msgs[:3] + msgs[4:5] + msgs[6:] + msgs[3:4] + msgs[5:6]
+        assert not t.is_talking()
+        assert t._outbatchffhs == []
+        assert failures == []
+        if maxsend == 2**20:
+            assert t.socket.numsends < 10, "t.socket.numsends: %s" % humanreadable.hr(t.socket.numsends)
+
+def test_small_messages_go_ahead_of_bulk_messages():
+    def inmsg(tcpc, msg):
+        pass
+
+    t = TCPConnection(inmsg, idlib.new_random_uniq())
+    t.socket = _FakeSocket(2**20)
+    big1 = "x" * (SEND_BATCH_SIZE * 3)
+    big2 = "y" * (SEND_BATCH_SIZE * 3)
+    t.send(big1)
+    t.send(big2)
+    t.send("are there messages")
+    while t.writable():
+        t.handle_write()
+    assert _help_parse_stream(string.join(t.socket.sent, '')) == ["are there messages", big1, big2]
+
+    # When there are lots of small messages, the bulk messages still get their turn.
+    t = TCPConnection(inmsg, idlib.new_random_uniq())
+    t.socket = _FakeSocket(2**20)
+    small = "z" * ((SEND_BATCH_SIZE / 2) - 4)
+    t.send(big1)
+    for i in range(SMALL_BATCHES_PER_BULK_MESSAGE * 2 * 3):
+        t.send(small)
+    t.send(big2)
+    while t.writable():
+        t.handle_write()
+    sent = _help_parse_stream(string.join(t.socket.sent, ''))
+    assert len(sent) == (SMALL_BATCHES_PER_BULK_MESSAGE * 2 * 3) + 2
+    assert sent.index(big1) == SMALL_BATCHES_PER_BULK_MESSAGE * 2, "sent.index(big1): %s" % humanreadable.hr(sent.index(big1))
+    assert sent.index(big2) == (SMALL_BATCHES_PER_BULK_MESSAGE * 2 * 2) + 1, "sent.index(big2): %s" % humanreadable.hr(sent.index(big2))
+
+def test_close_fails_only_unsent_messages():
+    def inmsg(tcpc, msg):
+        pass
+    failures = []
+    def make_ffh(name, failures=failures):
+        def ffh(name=name, failures=failures, failure_reason=None, bad_commstrat=None):
+            failures.append(name)
+        return ffh
+
+    t = TCPConnection(inmsg, idlib.new_random_uniq())
+    t.socket = _FakeSocket(4 + 6 + 4 + 3)
+    t._close_handler_func = lambda tcpc: None
+    t.send("hellbo", make_ffh("hellbo"))
+    t.send("goodbyte", make_ffh("goodbyte"))
+    t.send("wheedle", make_ffh("wheedle"))
+    t.handle_write()
+    t.close()
+    DoQ.doq.flush()
+    assert failures == ["goodbyte", "wheedle",], "failures: %s" % humanreadable.hr(failures)
+
+def _help_bench_chunkify(chunkifyname, pieces):
+    def inmsg(tcpc, msg):
+        pass
+    t = TCPConnection(inmsg, idlib.new_random_uniq())
+    chunkify = getattr(t, chunkifyname)
+    for piece in pieces:
+        chunkify(piece)
+    DoQ.doq.flush()
+
+def _bench_it_chunkify_one_byte_reads(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    _help_bench_chunkify('_chunkify', _help_split_stream(_help_make_stream(["x" * n]), lambda left: 1))
+
+def _bench_it_chunkify_with_concatenation_one_byte_reads(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    _help_bench_chunkify('_chunkify_with_concatenation', _help_split_stream(_help_make_stream(["x" * n]), lambda left: 1))
+
+def _profile_test_chunkify_speed():
+    import mojoutil
+    profit = mojoutil._dont_enable_if_you_want_speed_profit
+    profit(_real_test_chunkify_speed)
+
+def _real_test_chunkify_speed():
+    import random
+    random.seed(0)
+    splitters = (
+        ("1-byte reads", lambda left: 1,),
+        ("random 1..16 byte reads", lambda left: random.randrange(1, 17),),
+        ("random 1..64KB reads", lambda left: random.randrange(1, 65537),),
+        ("64KB reads", lambda left: 65536,),
+        )
+    for (msgsize, nummsgs,) in ((100, 1000,), (8 * 2**10, 40,), (64 * 2**10, 4,), (512 * 2**10, 2,),):
+        str = _help_make_stream(["x" * msgsize] * nummsgs)
+        for (splittername, splitter,) in splitters:
+            pieces = _help_split_stream(str, splitter)
+            for chunkifyname in ('_chunkify', '_chunkify_with_concatenation',):
+                if (chunkifyname == '_chunkify_with_concatenation') and ((len(pieces) / nummsgs) > 2**17):
+                    # The old implementation is quadratic in the number of pieces per message, so this one would take too long to be worth waiting for.
+                    print '%s: %d messages of %d bytes, %d %s: skipped' % (chunkifyname, nummsgs, msgsize, len(pieces), splittername,)
+                    continue
+                t1 = time.time()
+                _help_bench_chunkify(chunkifyname, pieces)
+                t2 = time.time()
+                print '%s: %d messages of %d bytes, %d %s: %3.3f' % (chunkifyname, nummsgs, msgsize, len(pieces), splittername, t2 - t1,)
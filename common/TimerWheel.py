@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2002 Bryce "Zooko" Wilcox-O'Hearn
+#  This file is licensed under the
+#    GNU Lesser General Public License v2.1.
+#    See the file COPYING or visit http://www.gnu.org/ for details.
+#
+
+# standard modules
+import time
+import traceback
+
+# pyutil modules
+import DoQ
+from debugprint import debugprint, debugstream
+import humanreadable
+
+true = 1
+false = None
+
+class TimerWheel:
+    """
+    A "timing wheel" for timeouts that are usually cancelled before they go off, such as
+    conversation timeouts.  Scheduling and cancelling are both O(1), instead of a sorted
+    insertion into (or a removal from) the DoQ's task list each time.
+
+    Time is divided into ticks of `tick' seconds, and there is one slot per tick in a ring of
+    `numslots' slots.  A timer goes in the slot for the first tick at or after its time, so it
+    goes off up to `tick' seconds late.  Timers further ahead than the ring reaches share a
+    slot with nearer ones and are just skipped until their own tick comes around.
+
+    While there are any timers, one task on the DoQ runs once per tick and calls the functions
+    in the slots that have come due.  All methods must be called on the DoQ.
+    """
+    def __init__(self, tick=1.0, numslots=512, time=time.time):
+        """
+        @param tick the number of seconds per slot
+        @param numslots the number of slots in the ring
+
+        @precondition `tick' must be positive.: tick > 0: "tick: %s" % humanreadable.hr(tick)
+        @precondition `numslots' must be positive.: numslots > 0: "numslots: %s" % humanreadable.hr(numslots)
+        """
+        assert tick > 0, "precondition: `tick' must be positive." + " -- " + "tick: %s" % humanreadable.hr(tick)
+        assert numslots > 0, "precondition: `numslots' must be positive." + " -- " + "numslots: %s" % humanreadable.hr(numslots)
+
+        self._tick = float(tick)
+        self._numslots = numslots
+        self._time = time
+        # Each slot maps handle to (ticknum, func, args, kwargs,).
+        self._slots = []
+        for i in range(numslots):
+            self._slots.append({})
+        self._handletoslot = {}
+        self._nexthandle = 0
+        # The number of the last tick whose slot has been run, or `None' when the ticker isn't
+        # running (because there are no timers).
+        self._lasttick = None
+
+    def __repr__(self):
+        return "<%s timers: %d, tick: %s, %x>" % (self.__class__.__name__, len(self._handletoslot), self._tick, id(self),)
+
+    def __len__(self):
+        return len(self._handletoslot)
+
+    def schedule(self, func, args=(), kwargs={}, delay=0):
+        """
+        Arranges for `func(*args, **kwargs)' to be called on the DoQ in `delay' seconds, or a
+        little later.
+
+        @returns a handle which can be passed to `cancel()'
+        """
+        ticknum = long((self._time() + delay) / self._tick) + 1
+        if self._lasttick is None:
+            self._lasttick = long(self._time() / self._tick)
+            self._schedule_ticker()
+        elif ticknum <= self._lasttick:
+            ticknum = self._lasttick + 1
+
+        handle = self._nexthandle
+        self._nexthandle = handle + 1
+        slot = self._slots[ticknum % self._numslots]
+        slot[handle] = (ticknum, func, args, kwargs,)
+        self._handletoslot[handle] = slot
+        return handle
+
+    def cancel(self, handle):
+        """
+        @returns `true' if the timer was cancelled, `false' if it had already gone off or been
+            cancelled
+        """
+        slot = self._handletoslot.get(handle)
+        if slot is None:
+            return false
+        del self._handletoslot[handle]
+        del slot[handle]
+        return true
+
+    def _schedule_ticker(self):
+        DoQ.doq.add_task(self._ticker, delay=self._tick)
+
+    def _ticker(self):
+        self._run_due_timers()
+        if self._handletoslot:
+            self._schedule_ticker()
+        else:
+            self._lasttick = None
+
+    def _run_due_timers(self):
+        nowtick = long(self._time() / self._tick)
+        firsttick = self._lasttick + 1
+        if (nowtick - firsttick) >= self._numslots:
+            # We're so late that every slot is due.
+            firsttick = nowtick - self._numslots + 1
+
+        due = []
+        for ticknum in range(firsttick, nowtick + 1):
+            slot = self._slots[ticknum % self._numslots]
+            for (handle, (whentick, func, args, kwargs,),) in slot.items():
+                if whentick <= nowtick:
+                    due.append((whentick, handle, func, args, kwargs,))
+        # Mark the slots as run before running any of the funcs, so that a timer scheduled by
+        # one of them goes into a later slot.
+        self._lasttick = nowtick
+
+        # Call them in the order they were due, and in the order they were scheduled.
+        due.sort()
+        for (whentick, handle, func, args, kwargs,) in due:
+            if not self.cancel(handle):
+                # An earlier func cancelled it.
+                continue
+            try:
+                apply(func, args, kwargs)
+            except:
+                debugprint("%s: exception in %s:\n", args=(self, func,), v=0, vs="ERROR")
+                traceback.print_exc(file=debugstream)
+
+# The TimerWheel for everyone to use.
+wheel = TimerWheel()
+
+def _help_make_wheel(clock, tick=1.0, numslots=8):
+    w = TimerWheel(tick=tick, numslots=numslots, time=lambda clock=clock: clock[0])
+    # Instead of putting the ticker on the DoQ, just count how many times it would have been.
+    w._tickersscheduled = []
+    w._schedule_ticker = lambda w=w: w._tickersscheduled.append(None)
+    return w
+
+def test_timers_go_off_in_order_unless_cancelled():
+    clock = [1000.0]
+    w = _help_make_wheel(clock)
+    fired = []
+    h1 = w.schedule(fired.append, args=(1,), delay=2.5)
+    h2 = w.schedule(fired.append, args=(2,), delay=2.5)
+    h3 = w.schedule(fired.append, args=(3,), delay=0)
+    h4 = w.schedule(fired.append, args=(4,), delay=30) # further than the ring reaches
+    assert len(w) == 4
+    assert len(w._tickersscheduled) == 1
+
+    assert w.cancel(h2)
+    assert not w.cancel(h2)
+
+    clock[0] = 1001.0
+    w._ticker()
+    assert fired == [3], "fired: %s" % humanreadable.hr(fired)
+
+    clock[0] = 1002.0
+    w._ticker()
+    assert fired == [3], "fired: %s" % humanreadable.hr(fired)
+    clock[0] = 1003.0
+    w._ticker()
+    assert fired == [3, 1,], "fired: %s" % humanreadable.hr(fired)
+    assert not w.cancel(h1)
+
+    # The slot for `h4' comes around a few times before it is due.
+    while clock[0] < 1030.0:
+        clock[0] = clock[0] + 1
+        w._ticker()
+        assert fired == [3, 1,], "fired: %s" % humanreadable.hr(fired)
+    clock[0] = 1031.0
+    w._ticker()
+    assert fired == [3, 1, 4,], "fired: %s" % humanreadable.hr(fired)
+
+    # No more timers, so the ticker stopped.
+    assert len(w) == 0
+    assert w._lasttick is None
+
+def test_late_ticker_catches_up():
+    clock = [1000.0]
+    w = _help_make_wheel(clock)
+    fired = []
+    for i in range(20):
+        w.schedule(fired.append, args=(i,), delay=i)
+    clock[0] = 1100.0
+    w._ticker()
+    assert fired == range(20), "fired: %s" % humanreadable.hr(fired)
+
+def test_timer_scheduled_by_a_timer_waits_for_the_next_tick():
+    clock = [1000.0]
+    w = _help_make_wheel(clock)
+    fired = []
+    def again(w=w, fired=fired):
+        fired.append('first')
+        w.schedule(fired.append, args=('second',), delay=0)
+    w.schedule(again, delay=0)
+    clock[0] = 1001.0
+    w._ticker()
+    assert fired == ['first'], "fired: %s" % humanreadable.hr(fired)
+    clock[0] = 1002.0
+    w._ticker()
+    assert fired == ['first', 'second',], "fired: %s" % humanreadable.hr(fired)
+
+def _bench_it_schedule_and_cancel(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    w = TimerWheel()
+    w._schedule_ticker = lambda: None
+    handles = []
+    for i in xrange(n):
+        handles.append(w.schedule(_bench_it_schedule_and_cancel, delay=300))
+    for handle in handles:
+        w.cancel(handle)
+
+def _bench_it_doq_add_and_remove_task(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    handles = []
+    for i in xrange(n):
+        handles.append(DoQ.doq.add_task(_bench_it_doq_add_and_remove_task, delay=300))
+    for handle in handles:
+        DoQ.doq.remove_task(handle)
+
+def _profile_test_timer_speed():
+    import mojoutil
+    profit = mojoutil._dont_enable_if_you_want_speed_profit
+    profit(_real_test_timer_speed)
+
+def _real_test_timer_speed():
+    for n in (1000, 10000, 50000,):
+        for benchfunc in (_bench_it_schedule_and_cancel, _bench_it_doq_add_and_remove_task,):
+            t1 = time.time()
+            benchfunc(n)
+            t2 = time.time()
+            print '%s(%d): %3.3f seconds' % (benchfunc.__name__, n, t2 - t1,)
+
+mojo_test_flag = 1
+
+def run():
+    import RunTests
+    RunTests.runTests(["TimerWheel"])
+
+if __name__ == '__main__':
+    run()
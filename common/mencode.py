@@ -55,6 +55,33 @@ __doc__ = """
 Methods to be used from other modules are mencode and mdecode
 """
 
+class StreamedString:
+    """
+    A string whose contents are read from a file-like object only while it is being encoded.
+    Use this with `mencode_to_file()' to send a big blob from disk without ever holding the
+    whole thing in memory.
+    """
+    def __init__(self, f, length, chunksize=2**16):
+        """
+        @param f a file-like object from which `length' bytes will be read
+        @param length the number of bytes to read from `f'
+        """
+        self.f = f
+        self.length = length
+        self.chunksize = chunksize
+    def encode_io(self, result):
+        result.write('(6:string')
+        result.write(str(self.length))
+        result.write(':')
+        left = self.length
+        while left > 0:
+            chunk = self.f.read(min(left, self.chunksize))
+            if not chunk:
+                raise MencodeError, 'file ended %d bytes before the length of the StreamedString' % left
+            result.write(chunk)
+            left = left - len(chunk)
+        result.write(')')
+
 class PreEncodedThing:
     """
     This class is used by servers who are attempting to lighten
@@ -124,8 +151,11 @@ def encode_none(data, result):
     result.write('(4:null)')
 
 def encode_preencoded(data, result):
-    assert isinstance(data, PreEncodedThing), "the only class that can be mencoded are PreEncodedThing classes"
-    result.write(data.getvalue())
+    assert isinstance(data, PreEncodedThing) or isinstance(data, StreamedString), "the only classes that can be mencoded are PreEncodedThing and StreamedString classes"
+    if isinstance(data, StreamedString):
+        data.encode_io(result)
+    else:
+        result.write(data.getvalue())
 
 def encode_io(data, result):
     encoder = encodersdict.get(type(data))
@@ -153,6 +183,16 @@ def mencode(data):
         raise MencodeError, "Couldn't encode this data object: %s, le: %s" % (humanreadable.hr(data), humanreadable.hr(le),)
     return result.getvalue()
 
+def mencode_to_file(data, f):
+    """
+    Like `mencode()', but writes the encoding to the file-like object `f' as it goes instead of
+    building the whole encoding in memory first.
+    """
+    try:
+        encode_io(data, f)
+    except MencodeError, le:
+        raise MencodeError, "Couldn't encode this data object: %s, le: %s" % (humanreadable.hr(data), humanreadable.hr(le),)
+
 def mdecode(s):
     """
     Does the opposite of mencode. Raises a mencode.MencodeError if the string is not a proper Python
@@ -266,6 +306,216 @@ def mdecode_index(s, index):
     return result, index + 1
 
 
+# The states of a StreamingDecoder.
+_S_OPEN = 0   # expecting '(' (or ')' if we are inside a list or dict)
+_S_DIGITS = 1 # reading the length of a raw string
+_S_BYTES = 2  # reading the contents of a raw string
+_S_CLOSE = 3  # expecting the ')' that ends a string, int or null
+_S_UNKNOWN = 4 # skipping over an object of an unknown type
+
+# What the raw string currently being read is for.
+_RAW_TYPE = 0
+_RAW_VALUE = 1
+_RAW_SKIP = 2
+
+_NO_KEY = []
+
+class StreamingDecoder:
+    """
+    The opposite of `mencode_to_file()': a decoder which is fed the encoding a piece at a time
+    (for example as it arrives on a socket) and which returns each object as soon as its
+    encoding is complete.  It accepts exactly what `mdecode()' accepts, and any number of
+    encoded objects one after another.
+
+    The contents of a string of `bufferthreshold' bytes or more come out as a buffer
+    object instead of a string if they arrived in one piece, so that big blobs aren't copied
+    out of the pieces that you feed in.  Note that things which insist on strings (such as
+    DataTypes.STRING) will reject these buffers.
+    """
+    def __init__(self, bufferthreshold=None):
+        """
+        @param bufferthreshold the length at or above which strings will be returned as
+            buffer objects, or `None' to always return strings
+        """
+        self._bufferthreshold = bufferthreshold
+        self._state = _S_OPEN
+        # Each frame is a list of [type, result] for strings, ints and nulls, [type, result,
+        # key, prevkey] for lists and dicts, or [type, depth] for objects of unknown type.
+        self._stack = []
+        self._digits = []
+        self._rawfor = _RAW_TYPE
+        self._need = 0
+        self._pieces = []
+        self._results = []
+        self._error = None
+
+    def is_idle(self):
+        """
+        @returns true if and only if every byte fed in so far was part of a complete object
+        """
+        return (self._state == _S_OPEN) and (not self._stack)
+
+    def feed(self, data):
+        """
+        @param data the next piece of the encoding
+
+        @returns a list of the objects whose encoding was completed by `data'
+
+        @throws MencodeError if the encoding is bad, after which this decoder is useless
+        """
+        if self._error is not None:
+            raise MencodeError, ('this decoder already failed', self._error,)
+        try:
+            self._feed(data)
+        except (MencodeError, ValueError, TypeError,), le:
+            self._error = le
+            raise MencodeError, le
+        results = self._results
+        self._results = []
+        return results
+
+    def _feed(self, data, join=string.join):
+        i = 0
+        l = len(data)
+        while i < l:
+            state = self._state
+            if state == _S_BYTES:
+                need = self._need
+                if l - i >= need:
+                    if self._pieces:
+                        self._pieces.append(data[i:i+need])
+                        raw = join(self._pieces, '')
+                        self._pieces = []
+                    elif (self._rawfor == _RAW_VALUE) and (self._bufferthreshold is not None) and (need >= self._bufferthreshold):
+                        raw = buffer(data, i, need)
+                    else:
+                        raw = data[i:i+need]
+                    i = i + need
+                    self._got_raw(raw)
+                else:
+                    self._pieces.append(data[i:])
+                    self._need = need - (l - i)
+                    i = l
+            elif state == _S_DIGITS:
+                c = data[i]
+                i = i + 1
+                if c == ':':
+                    digits = join(self._digits, '')
+                    self._digits = []
+                    if not digits:
+                        raise MencodeError, 'raw string with no length'
+                    if (len(digits) > 1) and (digits[0] == '0'):
+                        raise MencodeError, "string lengths can't start with 0 unless they are 0"
+                    self._need = int(digits)
+                    if self._need == 0:
+                        self._got_raw('')
+                    else:
+                        self._state = _S_BYTES
+                elif c in string.digits:
+                    self._digits.append(c)
+                    if len(self._digits) > 10:
+                        raise MencodeError, 'raw string length is too long'
+                else:
+                    raise MencodeError, 'bad character in raw string length: %s' % humanreadable.hr(c)
+            elif state == _S_OPEN:
+                c = data[i]
+                i = i + 1
+                if c == '(':
+                    self._rawfor = _RAW_TYPE
+                    self._state = _S_DIGITS
+                elif (c == ')') and self._stack and (self._stack[-1][0] in ('list', 'dict',)):
+                    frame = self._stack.pop()
+                    if (frame[0] == 'dict') and (frame[2] is not _NO_KEY):
+                        raise MencodeError, 'dict ended between a key and its value'
+                    self._got_object(frame[1])
+                else:
+                    raise MencodeError, "Object encodings must begin with an open parentheses, not %s" % humanreadable.hr(c)
+            elif state == _S_CLOSE:
+                c = data[i]
+                i = i + 1
+                if c != ')':
+                    raise MencodeError, "Object encodings must end with a close parentheses, not %s" % humanreadable.hr(c)
+                self._got_object(self._stack.pop()[1])
+            else:
+                assert state == _S_UNKNOWN
+                # This skips exactly what `decode_unknown()' skips.
+                c = data[i]
+                frame = self._stack[-1]
+                if c == ')':
+                    i = i + 1
+                    frame[1] = frame[1] - 1
+                    if frame[1] <= 0:
+                        self._stack.pop()
+                        self._got_object(UNKNOWN_TYPE)
+                elif c == '(':
+                    i = i + 1
+                    frame[1] = frame[1] + 1
+                else:
+                    self._rawfor = _RAW_SKIP
+                    self._state = _S_DIGITS
+
+    def _got_raw(self, raw):
+        rawfor = self._rawfor
+        if rawfor == _RAW_TYPE:
+            if raw in ('string', 'int',):
+                self._stack.append([raw, None])
+                self._rawfor = _RAW_VALUE
+                self._state = _S_DIGITS
+            elif raw == 'null':
+                self._stack.append([raw, None])
+                self._state = _S_CLOSE
+            elif raw == 'list':
+                self._stack.append([raw, [], _NO_KEY, _NO_KEY])
+                self._state = _S_OPEN
+            elif raw == 'dict':
+                self._stack.append([raw, {}, _NO_KEY, _NO_KEY])
+                self._state = _S_OPEN
+            else:
+                self._stack.append(['unknown', 0])
+                self._state = _S_UNKNOWN
+        elif rawfor == _RAW_VALUE:
+            frame = self._stack[-1]
+            if frame[0] == 'int':
+                if not _int_re.match(raw):
+                    raise MencodeError, "non canonical integer: %s" % humanreadable.hr(raw)
+                try:
+                    frame[1] = int(raw)
+                except (OverflowError, ValueError):
+                    frame[1] = long(raw)
+            else:
+                frame[1] = raw
+            self._state = _S_CLOSE
+        else:
+            assert rawfor == _RAW_SKIP
+            self._state = _S_UNKNOWN
+
+    def _got_object(self, obj, BufferType=types.BufferType):
+        if not self._stack:
+            if obj is UNKNOWN_TYPE:
+                raise UnknownTypeError, 'unknown type in required part of message'
+            self._results.append(obj)
+            self._state = _S_OPEN
+            return
+        frame = self._stack[-1]
+        if frame[0] == 'list':
+            frame[1].append(obj)
+        else:
+            assert frame[0] == 'dict'
+            if frame[2] is _NO_KEY:
+                if type(obj) is BufferType:
+                    obj = str(obj)
+                frame[2] = obj
+            else:
+                key = frame[2]
+                frame[2] = _NO_KEY
+                if (key is not UNKNOWN_TYPE) and (obj is not UNKNOWN_TYPE):
+                    if (frame[3] is not _NO_KEY) and (key <= frame[3]):
+                        raise MencodeError, "out of order keys in serialized dict.  %s is not greater than %s\n" % (humanreadable.hr(key), humanreadable.hr(frame[3]),)
+                    frame[3] = key
+                    frame[1][key] = obj
+        self._state = _S_OPEN
+
+
 class MencodeError(StandardError): pass
 # for backwards compatibility in case I missed changing anything - this shouldn't be necessary
 Error = MencodeError
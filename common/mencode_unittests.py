@@ -255,6 +255,66 @@ class Testy(unittest.TestCase):
                 # Good!  we want an exception when we try this.
                 return
 
+    def _help_stream_decode(self, s, piecesize, bufferthreshold=None):
+        d = StreamingDecoder(bufferthreshold)
+        results = []
+        i = 0
+        while i < len(s):
+            results.extend(d.feed(s[i:i+piecesize]))
+            i = i + piecesize
+        assert d.is_idle()
+        return results
+
+    def test_streaming_decoder_agrees_with_mdecode(self):
+        spam = [[], 0, -3, -345234523543245234523L, {}, 'spam', None, {'a': 3}, {69: []}, 'x' * 1000]
+        s = mencode(spam)
+        for piecesize in (1, 2, 3, 7, 100, len(s)):
+            assert self._help_stream_decode(s, piecesize) == [spam]
+        for s in ('(4:dict(7:garbage)(3:int1:4)(4:null)(3:int1:5))', '(4:dict(4:null)(3:int1:5)(3:int1:4)(7:garbage))', '(4:list(7:garbage0:1:a)(4:null))',):
+            for piecesize in (1, 5, len(s)):
+                assert self._help_stream_decode(s, piecesize) == [mdecode(s)]
+
+    def test_streaming_decoder_several_objects(self):
+        s = mencode('spam') + mencode({'eggs': 1}) + mencode(None)
+        assert self._help_stream_decode(s, 4) == ['spam', {'eggs': 1}, None]
+
+    def test_streaming_decoder_rejects_what_mdecode_rejects(self):
+        for s in ('(4:dict(3:int1:1)(4:null)(3:int1:0)(4:null))', '(4:dict(3:int1:1)(4:null)(3:int1:1)(4:null))', '(7:garbage)', '(4:dict(7:garbage)(2:int1:4)(4:null)(3:int1:5))', '(4:dict(4:dict)(4:null))', '(3:int2:01)', '(6:string02:ab)', '(4:null', ')', '(4:dict(4:null))',):
+            try:
+                mdecode(s)
+            except MencodeError:
+                pass
+            else:
+                assert 0, "mdecode() should have rejected %s" % humanreadable.hr(s)
+            d = StreamingDecoder()
+            try:
+                d.feed(s)
+                assert not d.is_idle(), "StreamingDecoder should have rejected %s" % humanreadable.hr(s)
+            except MencodeError:
+                pass
+
+    def test_streaming_decoder_returns_big_strings_as_buffers(self):
+        s = mencode({'data': 'x' * 100, 'name': 'spam'})
+        [result] = self._help_stream_decode(s, len(s), bufferthreshold=50)
+        assert type(result['data']) is types.BufferType
+        assert str(result['data']) == 'x' * 100
+        assert result['name'] == 'spam'
+        # A string that arrived in pieces has to be copied together anyway.
+        [result] = self._help_stream_decode(s, 10, bufferthreshold=50)
+        assert result['data'] == 'x' * 100
+
+    def test_streamed_string_and_mencode_to_file(self):
+        data = 'spam and eggs' * 1000
+        f = StringIO()
+        mencode_to_file({'data': StreamedString(StringIO(data), len(data), chunksize=100), 'name': 'spam'}, f)
+        assert f.getvalue() == mencode({'data': data, 'name': 'spam'})
+        try:
+            mencode(StreamedString(StringIO(data), len(data) + 1))
+        except MencodeError:
+            pass
+        else:
+            assert 0, "a StreamedString which was longer than its file should have been rejected"
+
     def test_no_leakage(self):
         # Test every (other) test here for leakage!  That's my cheap way to try to exercise the weird internal cases in the compiled code...
         for m in dir(self.__class__):
@@ -290,6 +350,17 @@ def _bench_it_mencode_plus_mdecode(n):
 
     mdecode(mencode(d))
 
+def _bench_it_streaming_decoder(n):
+    """
+    For use with utilscripts/benchfunc.py.
+    """
+    s = mencode({'data': 'x' * (n * 1024), 'name': 'spam'})
+    d = StreamingDecoder(bufferthreshold=2**12)
+    i = 0
+    while i < len(s):
+        d.feed(s[i:i+2**12])
+        i = i + 2**12
+
 def _profile_test_mdecode_implementation_speed():
     import mojoutil
     profit = mojoutil._dont_enable_if_you_want_speed_profit
@@ -52,6 +52,9 @@ SIZE_OF_PUBLIC_KEYS = SIZE_OF_MODULAR_VALUES
 
 MINS_BETWEEN_DB_CHECKPOINTS = 5
 
+# The maximum number of prepared tripledescbc objects that a MessageMaker keeps.
+MAX_CACHED_CIPHERS = 1000
+
 #### !!!! XXXX TODO: add check that counterparty is not using weak public key size.  --Zooko 2000-07-16
 # Size of symmetric keys.
 SIZE_OF_SYMMETRIC_KEYS = 24
@@ -198,6 +201,8 @@ class SessionKeeper:
                 db_env.open(self._dbdir, db.DB_CREATE | db.DB_INIT_MPOOL | db.DB_INIT_LOCK | db.DB_THREAD | db.DB_INIT_LOG | db.DB_INIT_TXN | privateflag | recoverflag & (~db.DB_RECOVER))
 
         self.__key = keyMV
+        # copies of `self.__key' for use by `undo_header_pk_ops()' (one per concurrent caller)
+        self.__spare_keys = []
         # maps id_in to counterparty id
         session_map = dbobj.DB(db_env)
         session_map.open('session_map', db.DB_BTREE, db.DB_CREATE | db.DB_THREAD )
@@ -208,6 +213,19 @@ class SessionKeeper:
         self.extres = SessionKeeper.ExtRes(db_env, session_map, counterparty_map)
         # maps header ids to content of headers for memoization
         self.__cached_headers = Cache.CacheSingleThreaded(maxitems)
+        # The following two are write-through caches of `counterparty_map' and `session_map', so
+        # that sending to or receiving from a hot counterparty doesn't cost a db read and an
+        # unpickling per message.  Every write to the db tables must also update these (after
+        # the transaction commits).
+        self._cachemaxitems = maxitems
+        # maps counterparty id to (session_id_in, session_id_out, symmetric_key, header, full pk)
+        self.__cached_counterparty_infos = Cache.CacheSingleThreaded(maxitems)
+        # maps id_in to (counterparty pub key sexp, counterparty id)
+        self.__cached_sessions = Cache.CacheSingleThreaded(maxitems)
+        self._cachehits = 0
+        self._cachemisses = 0
+        # when the getters last asked for a checkpoint -- see `_maybe_checkpoint()'
+        self._lastcheckpointtime = time.time()
 
         self.store_key(self.__my_public_key)
 
@@ -235,6 +253,52 @@ class SessionKeeper:
     def get_id(self):
         return self.__my_public_key_id
 
+    def get_cache_stats(self):
+        """
+        @returns a dict with the number of hits and misses of the session info caches used by
+            `get_connect_info()' and `get_session_info()', and the number of items currently in
+            them
+        """
+        return {
+            'hits': self._cachehits,
+            'misses': self._cachemisses,
+            'counterparty infos': len(self.__cached_counterparty_infos),
+            'sessions': len(self.__cached_sessions),
+            }
+
+    def _flush_caches(self):
+        """
+        Forget all cached session info.  This is only necessary if the db tables are modified
+        by something other than the methods of this class (e.g. by a unit test).
+        """
+        self.lock.acquire()
+        try:
+            self.__cached_counterparty_infos = Cache.CacheSingleThreaded(self._cachemaxitems)
+            self.__cached_sessions = Cache.CacheSingleThreaded(self._cachemaxitems)
+        finally:
+            self.lock.release()
+
+    def __uncache_counterparty_info(self, counterparty_id):
+        if self.__cached_counterparty_infos.has_key(counterparty_id):
+            del self.__cached_counterparty_infos[counterparty_id]
+
+    def __get_counterparty_info(self, counterparty_id, txn=None):
+        """
+        @returns (session_id_in, session_id_out, symmetric_key, header, full pk) or `None' if
+            there is no info stored for `counterparty_id'
+        """
+        info = self.__cached_counterparty_infos.get(counterparty_id)
+        if info is not None:
+            self._cachehits = self._cachehits + 1
+            return info
+        self._cachemisses = self._cachemisses + 1
+        infopickle = self.extres.counterparty_map.get(counterparty_id, txn=txn)
+        if infopickle is None:
+            return None
+        info = tuple(loads(infopickle)[:5])
+        self.__cached_counterparty_infos[counterparty_id] = info
+        return info
+
     def got_ack(self, counterparty_id):
         self.lock.acquire()
         try:
@@ -265,6 +329,7 @@ class SessionKeeper:
             self.extres.counterparty_map.put(counterparty_id, dumps([session_id_in, session_id_out, symmetric_key, None, full_key], 1), txn=trans)
             trans.commit()
             trans = None
+            self.__cached_counterparty_infos[counterparty_id] = (session_id_in, session_id_out, symmetric_key, None, full_key,)
         finally:
             if trans is not None:
                 trans.abort()
@@ -276,6 +341,59 @@ class SessionKeeper:
         finally:
             self.lock.release()
 
+    def is_header_cached(self, header):
+        """
+        @returns `true' if and only if `parse_header(header)' would be answered from the
+            memoized headers, without doing any public key operations
+        """
+        self.lock.acquire()
+        try:
+            return self.__cached_headers.has_key(sha(header).digest())
+        finally:
+            self.lock.release()
+
+    def undo_header_pk_ops(self, header):
+        """
+        Does the expensive part of `parse_header()' -- the two public key operations and the
+        checks on their results -- without touching the db or holding `self.lock', so that it
+        can be called from any thread, including several threads at once.  Pass the result to
+        `store_parsed_header()' (on the DoQ) to finish the job.
+
+        @returns (full_key, full_key_id, id_in, id_out, symmetric_key,) throws Error
+        """
+        assert type(header) == type('')
+        # Each thread needs a modval object of its own, since the value being operated on is
+        # stored in the modval object.
+        try:
+            key = self.__spare_keys.pop()
+        except IndexError:
+            key = modval.new_serialized(self.__key.get_private_key_encoding())
+        try:
+            try:
+                return self.__undo_header_pk_ops(header, key)
+            except (modval.Error, tripledescbc.Error, xdrlib.Error, EOFError), le:
+                debugprint("got error in mesgen.undo_header_pk_ops(): %s", args=(le,), v=4, vs="debug")
+                raise Error, le
+        finally:
+            self.__spare_keys.append(key)
+
+    def store_parsed_header(self, header, parsed):
+        """
+        Stores the session information from `parsed' (the result of
+        `undo_header_pk_ops(header)') as necessary and memoizes it, just like `parse_header()'.
+
+        Returns (counterparty pub key sexp, symmetric key) throws Error
+        """
+        self.lock.acquire()
+        try:
+            try:
+                return self.__store_parsed_header(sha(header).digest(), parsed)
+            except (modval.Error, tripledescbc.Error, xdrlib.Error, EOFError), le:
+                debugprint("got error in mesgen.store_parsed_header(): %s", args=(le,), v=4, vs="debug")
+                raise Error, le
+        finally:
+            self.lock.release()
+
     def __parse_header(self, header):
         """
         Parses a header and stores information contained in it as necessary
@@ -288,109 +406,129 @@ class SessionKeeper:
             cached = self.__cached_headers.get(hash)
             if cached is not None:
                 return cached
-            u = Unpacker(header)
-            # messages start with the hash of the recipient's public id
-            recipient_id = u.unpack_fstring(SIZE_OF_UNIQS)
-            if recipient_id != self.__my_public_key_id:
-                raise Error, 'message not intended for me'
-            # unpack PK encrypted public key
-            encrypted_key = u.unpack_string()
-            self.__key.set_value_string(encrypted_key)
-            self.__key.decrypt()   # PKop
-            decrypted = self.__key.get_value()
+            return self.__store_parsed_header(hash, self.__undo_header_pk_ops(header, self.__key))
+        except (modval.Error, tripledescbc.Error, xdrlib.Error, EOFError), le:
+            debugprint("got error in mesgen.__parse_header(): %s", args=(le,), v=4, vs="debug")
+            raise Error, le
 
-            try:
-                symmetric_key = cryptutil.oaep_decode(decrypted[1:]) # Leave off the initial 0 byte. ### XX check whether it really is 0 and raise bad-encoding error if not.  --Zooko 2000-07-29
-            except cryptutil.OAEPError, le:
-                raise Error, 'bad encryption -- pad badding: padded: %s, Error: %s' % (`decrypted`, `le.args`)
-
-            iv = u.unpack_fstring(8)
-            # first half of the MAC # XXX A.K.A. the key?  --Zooko 2000-07-29
-            prefix = header[:u.get_position()]
-            # all data except the symmetric key and recipient, encrypted
-            encrypted = u.unpack_string()
-            u.done()
-
-            decrypted = tripledescbc.new(symmetric_key).decrypt(iv, encrypted)                
-            u = Unpacker(decrypted)
-            # the full public key of the sender
-            sender_key = u.unpack_string()
-            full_key = MojoKey.makePublicRSAKeyForCommunicating(modval.new(sender_key, HARDCODED_RSA_PUBLIC_EXPONENT))
-            full_key_id = idlib.make_id(full_key, 'broker')
-            # the session id for messages sent 'here'
-            id_in = _mix_counterparties(full_key_id, self.__my_public_key_id, u.unpack_fstring(SIZE_OF_UNIQS))
-            # the session id for messages sent 'there'
-            id_out = _mix_counterparties(full_key_id, self.__my_public_key_id, u.unpack_fstring(SIZE_OF_UNIQS))
-            # check that the pk encrypted symmetric key used to send this message is the same was generated properly
-            strl = u.unpack_fstring(SIZE_OF_UNIQS)
-            sr = HashRandom.SHARandom(_mix_counterparties(full_key_id, self.__my_public_key_id, strl))
-            spaml = sr.get(SIZE_OF_SYMMETRIC_KEYS)
-            if symmetric_key != spaml:
-                raise Error, 'improperly generated key'
-            # the second half of what's in the MAC # XXX A.K.A. the message?  --Zooko 2000-07-29
-            end = decrypted[:u.get_position()]
-            # the signature of everything
-            signature = u.unpack_fstring(len(sender_key))
-            u.done()
-            
-            # debugprint("------ ------ ------ ------ hmachish(key=%s, message=%s)\n" % (`symmetric_key`, `end`))
-            summary = cryptutil.hmacish(key=symmetric_key, message=end)
+    def __undo_header_pk_ops(self, header, key):
+        """
+        @param key a modval object holding our private key, which no other thread is using
+
+        @returns (full_key, full_key_id, id_in, id_out, symmetric_key,) throws Error
+        """
+        u = Unpacker(header)
+        # messages start with the hash of the recipient's public id
+        recipient_id = u.unpack_fstring(SIZE_OF_UNIQS)
+        if recipient_id != self.__my_public_key_id:
+            raise Error, 'message not intended for me'
+        # unpack PK encrypted public key
+        encrypted_key = u.unpack_string()
+        key.set_value_string(encrypted_key)
+        key.decrypt()   # PKop
+        decrypted = key.get_value()
+
+        try:
+            symmetric_key = cryptutil.oaep_decode(decrypted[1:]) # Leave off the initial 0 byte. ### XX check whether it really is 0 and raise bad-encoding error if not.  --Zooko 2000-07-29
+        except cryptutil.OAEPError, le:
+            raise Error, 'bad encryption -- pad badding: padded: %s, Error: %s' % (`decrypted`, `le.args`)
+
+        iv = u.unpack_fstring(8)
+        # first half of the MAC # XXX A.K.A. the key?  --Zooko 2000-07-29
+        prefix = header[:u.get_position()]
+        # all data except the symmetric key and recipient, encrypted
+        encrypted = u.unpack_string()
+        u.done()
+
+        decrypted = tripledescbc.new(symmetric_key).decrypt(iv, encrypted)                
+        u = Unpacker(decrypted)
+        # the full public key of the sender
+        sender_key = u.unpack_string()
+        full_key = MojoKey.makePublicRSAKeyForCommunicating(modval.new(sender_key, HARDCODED_RSA_PUBLIC_EXPONENT))
+        full_key_id = idlib.make_id(full_key, 'broker')
+        # the session id for messages sent 'here'
+        id_in = _mix_counterparties(full_key_id, self.__my_public_key_id, u.unpack_fstring(SIZE_OF_UNIQS))
+        # the session id for messages sent 'there'
+        id_out = _mix_counterparties(full_key_id, self.__my_public_key_id, u.unpack_fstring(SIZE_OF_UNIQS))
+        # check that the pk encrypted symmetric key used to send this message is the same was generated properly
+        strl = u.unpack_fstring(SIZE_OF_UNIQS)
+        sr = HashRandom.SHARandom(_mix_counterparties(full_key_id, self.__my_public_key_id, strl))
+        spaml = sr.get(SIZE_OF_SYMMETRIC_KEYS)
+        if symmetric_key != spaml:
+            raise Error, 'improperly generated key'
+        # the second half of what's in the MAC # XXX A.K.A. the message?  --Zooko 2000-07-29
+        end = decrypted[:u.get_position()]
+        # the signature of everything
+        signature = u.unpack_fstring(len(sender_key))
+        u.done()
+        
+        # debugprint("------ ------ ------ ------ hmachish(key=%s, message=%s)\n" % (`symmetric_key`, `end`))
+        summary = cryptutil.hmacish(key=symmetric_key, message=end)
+        
+        x = modval.new(sender_key, HARDCODED_RSA_PUBLIC_EXPONENT, signature)
+        x.undo_signature()   # PKop
+        signed_value = x.get_value()
+
+        try:
+            thingie = cryptutil.oaep_decode(signed_value[1:]) # Leave off the initial 0 byte. ### XX check whether it really is 0 and raise bad-encoding error if not.  --Zooko 2000-07-29
+        except cryptutil.OAEPError, le:
+            raise Error, 'bad encryption -- pad badding: padded: %s, Error: %s' % (`signed_value`, `le.args`)
             
-            x = modval.new(sender_key, HARDCODED_RSA_PUBLIC_EXPONENT, signature)
-            x.undo_signature()   # PKop
-            signed_value = x.get_value()
+        if thingie != summary:
+            raise Error, 'bad signature: %s != %s' % (`thingie`, `summary`)
 
-            try:
-                thingie = cryptutil.oaep_decode(signed_value[1:]) # Leave off the initial 0 byte. ### XX check whether it really is 0 and raise bad-encoding error if not.  --Zooko 2000-07-29
-            except cryptutil.OAEPError, le:
-                raise Error, 'bad encryption -- pad badding: padded: %s, Error: %s' % (`signed_value`, `le.args`)
-                
-            if thingie != summary:
-                raise Error, 'bad signature: %s != %s' % (`thingie`, `summary`)
+        return (full_key, full_key_id, id_in, id_out, symmetric_key,)
 
-            self.extres.db_env.nosyncerror_txn_checkpoint(MINS_BETWEEN_DB_CHECKPOINTS)
-            trans = self.extres.db_env.txn_begin()
-            try:
-                # store session info if it's a new one
-                if self.extres.counterparty_map.get(full_key_id, txn=trans, flags=db.DB_RMW) is None :
-                    if self.extres.session_map.get(id_in, txn=trans, flags=db.DB_RMW) is not None :
-                        raise Error, 'a session with the specified incoming id already exists'
-                    assert len(symmetric_key) == SIZE_OF_SYMMETRIC_KEYS
-                    self.extres.session_map.put(id_in, full_key, txn=trans)
-                    self.extres.counterparty_map.put(full_key_id, dumps([id_in, id_out, symmetric_key, None, full_key], 1), txn=trans)
-                else:
-                    # Hmm.. We already had a session for this counterparty.
-                    # this means that most likely we both tried to send each other messages to establish a session
-                    # at the same time or at different times but one message got lost; usually due to the other
-                    # counterparty being offline at the time or having just switched relay servers.
-                    #
-                    # TODO implement this:
-                    #   Accept and store this key and use it in the future.  Keep the current key available
-                    #   as well incase they get the session establishing message we sent them and switch to
-                    #   using the session that we setup ourselves.
-                    # What this would do:
-                    #   prevent the current situation of always sending the header to/from counterparties
-                    #   where initiating session establishing messages have crossed.  This is good because
-                    #   full header messages are a bit larger and require two PKops on the receiver if the
-                    #   header is not currently in its in memory parsed headers cache.
-                    pass
-                result = (full_key, symmetric_key)
-                self.__cached_headers[hash] = result
-                trans.commit()
-                trans = None
-                return result
-            finally:
-                if trans is not None:
-                    trans.abort()
-        except (modval.Error, tripledescbc.Error, xdrlib.Error, EOFError), le:
-            debugprint("got error in mesgen.__parse_header(): %s", args=(le,), v=4, vs="debug")
-            raise Error, le
+    def __store_parsed_header(self, hash, parsed):
+        """
+        Returns (counterparty pub key sexp, symmetric key) throws Error
+        """
+        (full_key, full_key_id, id_in, id_out, symmetric_key,) = parsed
+        self.extres.db_env.nosyncerror_txn_checkpoint(MINS_BETWEEN_DB_CHECKPOINTS)
+        trans = self.extres.db_env.txn_begin()
+        try:
+            # store session info if it's a new one
+            if self.extres.counterparty_map.get(full_key_id, txn=trans, flags=db.DB_RMW) is None :
+                if self.extres.session_map.get(id_in, txn=trans, flags=db.DB_RMW) is not None :
+                    raise Error, 'a session with the specified incoming id already exists'
+                assert len(symmetric_key) == SIZE_OF_SYMMETRIC_KEYS
+                self.extres.session_map.put(id_in, full_key, txn=trans)
+                self.extres.counterparty_map.put(full_key_id, dumps([id_in, id_out, symmetric_key, None, full_key], 1), txn=trans)
+                newsession = true
+            else:
+                # Hmm.. We already had a session for this counterparty.
+                # this means that most likely we both tried to send each other messages to establish a session
+                # at the same time or at different times but one message got lost; usually due to the other
+                # counterparty being offline at the time or having just switched relay servers.
+                #
+                # TODO implement this:
+                #   Accept and store this key and use it in the future.  Keep the current key available
+                #   as well incase they get the session establishing message we sent them and switch to
+                #   using the session that we setup ourselves.
+                # What this would do:
+                #   prevent the current situation of always sending the header to/from counterparties
+                #   where initiating session establishing messages have crossed.  This is good because
+                #   full header messages are a bit larger and require two PKops on the receiver if the
+                #   header is not currently in its in memory parsed headers cache.
+                newsession = false
+            result = (full_key, symmetric_key)
+            self.__cached_headers[hash] = result
+            trans.commit()
+            trans = None
+            if newsession:
+                self.__cached_counterparty_infos[full_key_id] = (id_in, id_out, symmetric_key, None, full_key,)
+                self.__cached_sessions[id_in] = (full_key, full_key_id,)
+            return result
+        finally:
+            if trans is not None:
+                trans.abort()
 
     def store_key(self, full_key):
         """
         @idempotent
         """
-        if self.extres.counterparty_map.has_key(idlib.make_id(full_key, 'key')):
+        key_id = idlib.make_id(full_key, 'key')
+        if self.__cached_counterparty_infos.has_key(key_id) or self.extres.counterparty_map.has_key(key_id):
             return
 
         self.lock.acquire()
@@ -452,13 +590,27 @@ class SessionKeeper:
             self.extres.session_map.put(id_in, full_key, txn=trans)
             trans.commit()
             trans = None
+            self.__cached_counterparty_infos[key_id] = (id_in, id_out, symmetric_key, header, full_key,)
+            self.__cached_sessions[id_in] = (full_key, key_id,)
         finally:
             if trans is not None:
                 trans.abort()
 
+    def _maybe_checkpoint(self):
+        """
+        Checkpoints the db if it has been more than MINS_BETWEEN_DB_CHECKPOINTS minutes since
+        the last time this was called, so that the log doesn't grow without bound on a node
+        which only sends and receives messages.  This is cheap enough to call per message.
+        """
+        now = time.time()
+        if now - self._lastcheckpointtime >= (MINS_BETWEEN_DB_CHECKPOINTS * 60):
+            self._lastcheckpointtime = now
+            self.extres.db_env.nosyncerror_txn_checkpoint(MINS_BETWEEN_DB_CHECKPOINTS)
+
     def get_connect_info(self, counterparty_id):
         self.lock.acquire()
         try:
+            self._maybe_checkpoint()
             return self.__get_connect_info(counterparty_id)
         finally:
             self.lock.release()
@@ -475,14 +627,13 @@ class SessionKeeper:
 
         counterparty_id = idlib.canonicalize(counterparty_id, 'broker')
 
-        self.extres.db_env.nosyncerror_txn_checkpoint(MINS_BETWEEN_DB_CHECKPOINTS)
-        infopickle = self.extres.counterparty_map.get(counterparty_id)
-        if infopickle is None:
+        info = self.__get_counterparty_info(counterparty_id)
+        if info is None:
             raise NoCounterpartyInfo, 'no counterparty information stored'
 
         # if the session has been verifiably set up, send the session id
         # otherwise send the full header
-        session_id_out, symmetric_key, header = loads(infopickle)[1:4]
+        session_id_out, symmetric_key, header = info[1:4]
         if header is None :
             return {'session_id_out': session_id_out, 'symmetric_key': symmetric_key}
         else:
@@ -491,6 +642,7 @@ class SessionKeeper:
     def get_session_info(self, id_in):
         self.lock.acquire()
         try:
+            self._maybe_checkpoint()
             return self.__get_session_info(id_in)
         finally:
             self.lock.release()
@@ -499,18 +651,27 @@ class SessionKeeper:
         """
         Returns (counterparty_pub_key_sexp, symmetric_key, want ack) throws Error
         """
-        self.extres.db_env.nosyncerror_txn_checkpoint(MINS_BETWEEN_DB_CHECKPOINTS)
+        session = self.__cached_sessions.get(id_in)
+        if session is not None:
+            (counterparty_pub_key_sexp, counterparty_id,) = session
+            info = self.__cached_counterparty_infos.get(counterparty_id)
+            if info is not None:
+                self._cachehits = self._cachehits + 1
+                return (counterparty_pub_key_sexp, info[2], info[3] is not None)
+
         trans = self.extres.db_env.txn_begin()
         try:
             counterparty_pub_key_sexp = self.extres.session_map.get(id_in, txn=trans)
             if counterparty_pub_key_sexp is None:
+                self._cachemisses = self._cachemisses + 1
                 raise UnknownSession(id_in, self.get_id())
             counterparty_id = idlib.make_id(counterparty_pub_key_sexp, 'broker')
-            try:
-                symmetric_key, header = loads(self.extres.counterparty_map.get(counterparty_id, txn=trans))[2:4]
-            except TypeError:
+            self.__cached_sessions[id_in] = (counterparty_pub_key_sexp, counterparty_id,)
+            info = self.__get_counterparty_info(counterparty_id, txn=trans)
+            if info is None:
                 # well, we did know about the session, but our counterparty database somehow didn't have an entry
                 raise UnknownSession(id_in, self.get_id())
+            symmetric_key, header = info[2:4]
             return (counterparty_pub_key_sexp, symmetric_key, header is not None)
         finally:
             if trans is not None:
@@ -536,6 +697,7 @@ class SessionKeeper:
         debugprint("__invalidate_session for unverified cid %s, bad_session_id_out %s, stored_session_id_out %s\n", args=(counterparty_id, bad_session_id_out, stored_session_id_out), v=4, vs='mesgen')
         if idlib.equal(stored_session_id_out, bad_session_id_out):
             self.extres.counterparty_map.delete(counterparty_id)
+            self.__uncache_counterparty_info(counterparty_id)
         else:
             raise Error, "someone asked us to invalidate session_id_out %s, but they claimed that that session was with counterparty %s, but we do not have a that session id as our session id for that counterparty.  Not invalidating; we probably connected to broker that is now using a different key from the one we know for the CommStrat" % (`bad_session_id_out`, idlib.to_ascii(counterparty_id))
             # TODO this should be its own class of error, if caught it is -reasonable- (though not absolute in
@@ -590,6 +752,33 @@ class MessageMaker:
             else:
                 self._session_keeper = SessionKeeper(dbparentdir=dbparentdir, dir=None, recoverdb=recoverdb)
 
+        # maps symmetric key to a tripledescbc object keyed with it (the iv is given on each
+        # encrypt() or decrypt() call, so these can be re-used for every message in a session)
+        self._ciphers = Cache.CacheSingleThreaded(MAX_CACHED_CIPHERS)
+        self._cipherhits = 0
+        self._ciphermisses = 0
+
+    def _get_cipher(self, symmetric_key):
+        cipher = self._ciphers.get(symmetric_key)
+        if cipher is not None:
+            self._cipherhits = self._cipherhits + 1
+            return cipher
+        self._ciphermisses = self._ciphermisses + 1
+        cipher = tripledescbc.new(symmetric_key)
+        self._ciphers[symmetric_key] = cipher
+        return cipher
+
+    def get_cache_stats(self):
+        """
+        @returns a dict of the hit and miss counts and current sizes of the session info caches
+            and the cipher cache, for sizing them
+        """
+        stats = self._session_keeper.get_cache_stats()
+        stats['cipher hits'] = self._cipherhits
+        stats['cipher misses'] = self._ciphermisses
+        stats['ciphers'] = len(self._ciphers)
+        return stats
+
     def get_public_key(self):
         return self._session_keeper.get_public_key()
 
@@ -622,6 +811,40 @@ class MessageMaker:
 
         self._session_keeper.store_key(pub_key_sexp)
 
+    def get_uncached_header(self, wired_string):
+        """
+        @returns the full PK header of `wired_string' if it has one that would cost public key
+            operations to parse (because it isn't among the memoized headers), else `None'
+        """
+        if wired_string[:4] != '\000\000\000\000':
+            return None
+        try:
+            u = Unpacker(wired_string)
+            u.unpack_fstring(4)
+            header = u.unpack_string()
+        except (xdrlib.Error, EOFError), le:
+            # `parse()' will report this.
+            return None
+        if self._session_keeper.is_header_cached(header):
+            return None
+        return header
+
+    def undo_header_pk_ops(self, header):
+        """
+        Does the public key operations of parsing `header', which was returned from
+        `get_uncached_header()'.  This may be called from any thread.  The result must be passed
+        to `store_parsed_header()' before `parse()' will be able to use it.
+
+        @returns an opaque object to be passed to `store_parsed_header()'
+        """
+        return self._session_keeper.undo_header_pk_ops(header)
+
+    def store_parsed_header(self, header, parsed):
+        """
+        @param parsed the result of `undo_header_pk_ops(header)'
+        """
+        self._session_keeper.store_parsed_header(header, parsed)
+
     def generate_message(self, recipient_id, message):
         connect_info = self._session_keeper.get_connect_info(recipient_id)
         symmetric_key = connect_info['symmetric_key']
@@ -643,7 +866,7 @@ class MessageMaker:
         mac = cryptutil.hmacish(key=symmetric_key, message=message)
 
         pdec.pack_fstring(SIZE_OF_UNIQS, mac)
-        encrypted = tripledescbc.new(symmetric_key).encrypt(iv, pdec.get_buffer())
+        encrypted = self._get_cipher(symmetric_key).encrypt(iv, pdec.get_buffer())
         p.pack_string(encrypted)
         return p.get_buffer()
 
@@ -672,7 +895,7 @@ class MessageMaker:
                 u.done()
                 
                 counterparty_pub_key_sexp, symmetric_key = self._session_keeper.parse_header(header)
-                decrypted = tripledescbc.new(symmetric_key).decrypt(iv, encrypted)
+                decrypted = self._get_cipher(symmetric_key).decrypt(iv, encrypted)
                 u = Unpacker(decrypted)
                 message = u.unpack_string()
                 mac = u.unpack_fstring(SIZE_OF_UNIQS)
@@ -692,7 +915,7 @@ class MessageMaker:
                 u.done()
                 
                 counterparty_pub_key_sexp, symmetric_key, want_ack = self._session_keeper.get_session_info(session)
-                decrypted = tripledescbc.new(symmetric_key).decrypt(iv, encrypted)
+                decrypted = self._get_cipher(symmetric_key).decrypt(iv, encrypted)
 
                 u = Unpacker(decrypted)
                 message = u.unpack_string()
@@ -1002,6 +1225,7 @@ def test_invalidate_session():
     for m2_session_id_in in mesgen2._session_keeper.extres.session_map.keys():
         print "mesgen deleting session id", `m2_session_id_in`
         mesgen2._session_keeper.extres.session_map.delete(m2_session_id_in)
+    mesgen2._session_keeper._flush_caches()
     # send a message m1 -> m2, but m2 has forgotten the session that will be used
     m1b = mesgen1.generate_message(id2, 'spam1b')
     assert m1b[:4] == '\000\000\000\001', 'message should have used an established session'
@@ -1021,6 +1245,63 @@ def test_invalidate_session():
     counterparty_pub_key_sexp, message = mesgen2.parse(m1a)
     assert idlib.equal(idlib.make_id(counterparty_pub_key_sexp, 'broker'), id1)
 
+def test_session_info_cache():
+    mesgen1 = _help_test_create_MessageMaker()
+    mesgen2 = _help_test_create_MessageMaker()
+    id1 = mesgen1.get_id()
+    id2 = mesgen2.get_id()
+    mesgen1.store_key(mesgen2.get_public_key())
+    counterparty_pub_key_sexp, message = mesgen2.parse(mesgen1.generate_message(id2, 'spam1'))
+    counterparty_pub_key_sexp, message = mesgen1.parse(mesgen2.generate_message(id1, 'spam2'))
+    stats1 = mesgen1.get_cache_stats()
+    stats2 = mesgen2.get_cache_stats()
+    for i in range(10):
+        counterparty_pub_key_sexp, message = mesgen2.parse(mesgen1.generate_message(id2, 'spam%d' % i))
+        assert message == 'spam%d' % i
+    # Each of those took a session info lookup on each side, all of which should have been served from the cache.
+    assert mesgen1.get_cache_stats()['hits'] == stats1['hits'] + 10, "stats1: %s, now: %s" % (hr(stats1), hr(mesgen1.get_cache_stats()))
+    assert mesgen1.get_cache_stats()['misses'] == stats1['misses']
+    assert mesgen2.get_cache_stats()['hits'] == stats2['hits'] + 10, "stats2: %s, now: %s" % (hr(stats2), hr(mesgen2.get_cache_stats()))
+    assert mesgen2.get_cache_stats()['misses'] == stats2['misses']
+    assert mesgen1.get_cache_stats()['cipher misses'] == stats1['cipher misses']
+
+    # After the cache is flushed the info is still in the db.
+    mesgen2._session_keeper._flush_caches()
+    counterparty_pub_key_sexp, message = mesgen2.parse(mesgen1.generate_message(id2, 'spam3'))
+    assert message == 'spam3'
+    assert mesgen2.get_cache_stats()['misses'] > stats2['misses']
+
+def test_undo_header_pk_ops_separately():
+    mesgen1 = _help_test_create_MessageMaker()
+    mesgen2 = _help_test_create_MessageMaker()
+    id1 = mesgen1.get_id()
+    id2 = mesgen2.get_id()
+    mesgen1.store_key(mesgen2.get_public_key())
+    m1 = mesgen1.generate_message(id2, 'spam1')
+    header = mesgen2.get_uncached_header(m1)
+    assert header is not None
+    results = []
+    def pkops(mesgen2=mesgen2, header=header, results=results):
+        results.append(mesgen2.undo_header_pk_ops(header))
+    threads = []
+    for i in range(3):
+        t = threading.Thread(target=pkops)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    assert len(results) == 3
+    assert results[0] == results[1] == results[2]
+    mesgen2.store_parsed_header(header, results[0])
+    assert mesgen2.get_uncached_header(m1) is None
+    counterparty_pub_key_sexp, message = mesgen2.parse(m1)
+    assert idlib.equal(idlib.make_id(counterparty_pub_key_sexp, 'broker'), id1)
+    assert message == 'spam1'
+    # session messages don't have headers to parse
+    m3 = mesgen2.generate_message(id1, 'spam3')
+    assert mesgen2.get_uncached_header(m3) is None
+    assert mesgen1.get_uncached_header(m3) is None
+
 def test_Error():
     mesgen = _help_test_create_MessageMaker()
     x = mesgen.generate_message(mesgen.get_id(), 'spam')
@@ -1071,4 +1352,6 @@ def _test_mesgen_speed(iterations=200):
         assert message == 'spam3'
     stop_time = time.time()
     print "%d loop iterations generating and parsing 3 messages each took %3.2f seconds" % (iterations, stop_time-start_time)
+    print "mesgen1 cache stats: %s" % hr(mesgen1.get_cache_stats())
+    print "mesgen2 cache stats: %s" % hr(mesgen2.get_cache_stats())
 
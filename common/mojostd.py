@@ -1368,12 +1368,27 @@ dictutil.deep_update(confdefaults,
             # If you want to announce that you are listening on a specific port, then fill this in.
             "TRANSACTION_MANAGER_ANNOUNCED_PORT": "",
             "MAX_TIMEOUT" : "3600",
+            # When there are more incoming requests than this in flight, or tasks on the DoQ
+            # are running more than this many seconds late, incoming requests are shed.
+            # See common/AdmissionController.py.
+            "MAX_INCOMING_REQUESTS_IN_FLIGHT": "256",
+            "MAX_QUEUE_DELAY": "2.0",
+            # the number of worker threads for handler funcs added with executor="threads"
+            "HANDLER_POOL_THREADS": "4",
+            # the most bytes of memory to use for all of the in-memory caches together
+            # See common/BudgetCache.py.
+            "CACHE_MEMORY_BUDGET": "16777216",
 
             "COUNTERPARTY": {
                     # This is how many messages the latency is averaged over in dynamic timing collections
                     "AVERAGING_TIMESCALE_v2": "100.0",
                     "COLLECT_DYNAMIC_TIMING": "yes",
                     "USE_DYNAMIC_TIMING": "yes",
+                    # percentile of response times to use as the dynamic timeout
+                    "TIMEOUT_PERCENTILE": "99",
+                    # see MojoTransactionManager.initiate_hedged()
+                    "HEDGE_PERCENTILE": "95",
+                    "HEDGE_BUDGET_PERCENT": "5",
                     # used in reliability and payment computations
                     "MIN_RESPONSE_RELIABILITY_FRACTION": "0.70",
                     "MIN_NUM_MO_DIFFERENCE_FOR_RELIABILITY_CHECK": "10",